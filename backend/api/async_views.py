@@ -0,0 +1,46 @@
+"""
+The hot read endpoints as coroutine views, routed when ASYNC_READ_VIEWS is set for an
+ASGI server. They are the DRF views of api.views, only as_view() differs: dispatch(),
+with its authentication, throttling, querysets, caching and exception handling, runs
+in a thread through sync_to_async, so there is a single implementation to maintain.
+"""
+from functools import update_wrapper
+
+from asgiref.sync import sync_to_async
+
+from .views import (
+    ListCreateCommentView, ListCreateRatingView, RecipeDetailView, RecipeIngredientAPIView, RecipeListCreateView,
+)
+
+
+class AsyncViewMixin:
+    @classmethod
+    def as_view(cls, **initkwargs):
+        sync_view = super().as_view(**initkwargs)
+        threaded_view = sync_to_async(sync_view)
+
+        async def view(request, *args, **kwargs):
+            return await threaded_view(request, *args, **kwargs)
+
+        # keeps cls, initkwargs and DRF's csrf_exempt flag
+        return update_wrapper(view, sync_view)
+
+
+class AsyncRecipeListCreateView(AsyncViewMixin, RecipeListCreateView):
+    pass
+
+
+class AsyncRecipeDetailView(AsyncViewMixin, RecipeDetailView):
+    pass
+
+
+class AsyncListCreateCommentView(AsyncViewMixin, ListCreateCommentView):
+    pass
+
+
+class AsyncListCreateRatingView(AsyncViewMixin, ListCreateRatingView):
+    pass
+
+
+class AsyncRecipeIngredientAPIView(AsyncViewMixin, RecipeIngredientAPIView):
+    pass
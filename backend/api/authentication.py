@@ -0,0 +1,117 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .models import User
+
+
+def auth_state_key(user_id):
+    return f'auth-state:{user_id}'
+
+
+def cache_auth_state(user):
+    """Stores what a token has to be checked against, called whenever a user is saved."""
+    cache.set(
+        auth_state_key(user.pk),
+        (user.is_active, get_md5_hash_password(user.password), user.is_staff, user.is_superuser),
+        timeout=settings.AUTH_USER_CACHE_TIMEOUT
+    )
+
+
+def _auth_state(row):
+    # unknown users are cached too, as False
+    return (row[0], get_md5_hash_password(row[1]), row[2], row[3]) if row else False
+
+
+def _auth_rows(user_id):
+    return User.objects.filter(pk=user_id).values_list('is_active', 'password', 'is_staff', 'is_superuser')
+
+
+def privileges_match(token, state):
+    """Whether the staff and superuser claims of token are still the user's, a demoted admin's aren't."""
+    return (token.get('is_staff', False), token.get('is_superuser', False)) == (state[2], state[3])
+
+
+def get_auth_state(user_id):
+    # a process-local cache never hears of deactivations and password changes made in
+    # other workers, management commands or the admin, see CACHE_SHARED
+    if not settings.CACHE_SHARED:
+        return _auth_state(_auth_rows(user_id).first())
+    state = cache.get(auth_state_key(user_id))
+    if state is None:
+        state = _auth_state(_auth_rows(user_id).first())
+        cache.set(auth_state_key(user_id), state, timeout=settings.AUTH_USER_CACHE_TIMEOUT)
+    return state
+
+
+class ClaimsUser(TokenUser):
+    """
+    The request user, built from the signed claims of the access token instead of the
+    users table. Model permissions are not loaded, only superusers have them.
+    """
+    @property
+    def id(self):
+        return int(self.token[api_settings.USER_ID_CLAIM])
+
+    @property
+    def email(self):
+        return self.token.get('email', '')
+
+    def has_perm(self, perm, obj=None):
+        return self.is_superuser
+
+    def has_perms(self, perm_list, obj=None):
+        return all(self.has_perm(perm, obj) for perm in perm_list)
+
+    def has_module_perms(self, module):
+        return self.is_superuser
+
+    def as_user(self):
+        """An unsaved User with the claimed fields, enough to assign to a foreign key and render."""
+        return User(
+            id=self.id, username=self.username, email=self.email,
+            is_staff=self.is_staff, is_superuser=self.is_superuser,
+        )
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication without a users table lookup per request. The token is checked
+    against the user's active flag, password hash and staff and superuser flags, cached
+    for AUTH_USER_CACHE_TIMEOUT seconds and replaced on every user save, so deactivating
+    or demoting a user or changing the password revokes their tokens right away. That takes a cache every process shares,
+    with a per-process one the state is read from the users table on every request.
+    """
+    def get_user(self, validated_token):
+        return self.check_state(validated_token, get_auth_state(self.get_user_id(validated_token)))
+
+    def get_user_id(self, validated_token):
+        try:
+            return validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_('Token contained no recognizable user identification')) from e
+
+    def check_state(self, validated_token, state):
+        if not state:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+
+        is_active, password_hash = state[:2]
+        if not is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != password_hash:
+            raise AuthenticationFailed(_("The user's password has been changed."), code='password_changed')
+
+        if not privileges_match(validated_token, state):
+            raise AuthenticationFailed(_("The user's permissions have changed."), code='permissions_changed')
+
+        return ClaimsUser(validated_token)
+
+
+def model_user(user):
+    """The request user as a User to assign to foreign keys, whichever authentication class made it."""
+    return user.as_user() if isinstance(user, ClaimsUser) else user
@@ -0,0 +1,128 @@
+import hashlib
+import math
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+
+GENERATION_KEY = 'token-blacklist:generation'
+
+
+def revoked_key(jti):
+    return f'token-blacklist:{jti}'
+
+
+class BloomFilter:
+    """Set membership without false negatives, about 1.2 bytes per key at a 1% error rate."""
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.size / 8))
+
+    def _positions(self, key):
+        # double hashing, two 64 bit halves of one digest stand in for k hash functions
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        a, b = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        return [(a + i * b) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class _LocalBlacklist:
+    # (generation, filter) of this process, rebuilt whenever the shared generation moves on
+    state = (None, None)
+    lock = threading.Lock()
+
+
+def _current_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # lost or never set, a fresh value makes every process rebuild
+        cache.add(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def blacklist_filter():
+    """
+    Bloom filter of the blacklisted jtis that haven't expired yet. Built once per process
+    from the database and again only after a token has been revoked anywhere.
+    """
+    generation = _current_generation()
+    if _LocalBlacklist.state[0] != generation:
+        with _LocalBlacklist.lock:
+            if _LocalBlacklist.state[0] != generation:
+                jtis = list(
+                    BlacklistedToken.objects.filter(token__expires_at__gt=timezone.now())
+                    .values_list('token__jti', flat=True)
+                )
+                bloom = BloomFilter(2 * len(jtis) + 1000)
+                for jti in jtis:
+                    bloom.add(jti)
+                _LocalBlacklist.state = (generation, bloom)
+    return _LocalBlacklist.state[1]
+
+
+def is_blacklisted(jti):
+    """
+    Most tokens are not in the filter and need no query at all. Recently revoked tokens
+    are answered from the cache, the database only sees the filter's false positives.
+    The filter is only rebuilt when a revocation moves the generation in a cache every
+    process shares, without one (see CACHE_SHARED) the database answers every check.
+    """
+    if not settings.CACHE_SHARED:
+        return BlacklistedToken.objects.filter(token__jti=jti).exists()
+    if jti not in blacklist_filter():
+        return False
+    if cache.get(revoked_key(jti)):
+        return True
+    return BlacklistedToken.objects.filter(token__jti=jti).exists()
+
+
+def remember_revoked(outstanding_token):
+    """Caches a newly blacklisted token until it expires and has every process rebuild its filter."""
+    def publish():
+        remaining = (outstanding_token.expires_at - timezone.now()).total_seconds()
+        if remaining > 0:
+            cache.set(revoked_key(outstanding_token.jti), True, timeout=math.ceil(remaining))
+        cache.set(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+
+    transaction.on_commit(publish)
+
+
+def prune_expired_tokens(batch_size=1000, pause=0):
+    """
+    Deletes expired outstanding tokens and their blacklist entries. Each batch is its own
+    short transaction, found by walking the primary key since expired tokens are the
+    oldest ones. Returns the number of outstanding tokens deleted.
+    """
+    now = timezone.now()
+    deleted, last_id = 0, 0
+    while True:
+        ids = list(
+            OutstandingToken.objects.filter(id__gt=last_id, expires_at__lte=now)
+            .order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            # the blacklist entries go with them as a cascade
+            OutstandingToken.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+        last_id = ids[-1]
+        if len(ids) < batch_size:
+            return deleted
+        if pause:
+            time.sleep(pause)
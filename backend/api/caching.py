@@ -0,0 +1,67 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+STATS_KEYS = ('hits', 'misses', 'evictions')
+
+
+def _count(stat):
+    key = f'recipe-cache:{stat}'
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # evicted between add and incr, losing one tick is fine
+        pass
+
+
+def cache_stats():
+    values = cache.get_many([f'recipe-cache:{stat}' for stat in STATS_KEYS])
+    return {stat: values.get(f'recipe-cache:{stat}', 0) for stat in STATS_KEYS}
+
+
+# Entries are stored with the recipe version and never evicted: a stale version is a miss,
+# a deleted recipe is a 404 before the cache is asked, the rest expires after
+# RECIPE_CACHE_TIMEOUT. A recipe has an entry per representation, evicting one is no use.
+def recipe_cache_key(request, pk):
+    # absolute urls (images) depend on the host and sparse representations on the query string
+    representation = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    return f'recipe-detail:{pk}:{representation}'
+
+
+def get_or_render(key, version, render):
+    """
+    Returns the cached representation stored for this version, rendering it on a miss.
+    Only one worker renders an expired or stale key, the others wait for its result
+    for up to RECIPE_CACHE_LOCK_TIMEOUT seconds before rendering on their own.
+    """
+    entry = cache.get(key)
+    if entry is not None and entry[0] == version:
+        _count('hits')
+        return entry[1]
+
+    _count('misses')
+    if entry is not None:
+        _count('evictions')
+
+    lock_key = f'{key}:lock'
+    lock_timeout = settings.RECIPE_CACHE_LOCK_TIMEOUT
+    if cache.add(lock_key, 1, timeout=lock_timeout):
+        try:
+            data = render()
+            cache.set(key, (version, data), timeout=settings.RECIPE_CACHE_TIMEOUT)
+            return data
+        finally:
+            cache.delete(lock_key)
+
+    deadline = time.monotonic() + lock_timeout
+    while time.monotonic() < deadline:
+        time.sleep(0.02)
+        entry = cache.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+    return render()
+
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    if settings.CACHE_SHARED:
+        return []
+    return [Warning(
+        'The default cache is private to each process.',
+        hint=(
+            'Set CACHE_BACKEND and CACHE_LOCATION to a cache every worker shares, such as '
+            'django.core.cache.backends.redis.RedisCache. Until then every authenticated request '
+            'and token refresh reads the database to see revocations made in other processes.'
+        ),
+        id='api.W001',
+    )]
@@ -0,0 +1,82 @@
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.settings import api_settings
+
+from .models import Recipe
+from .sparse import SparseFields
+
+
+def _recipe_validators(request, pk):
+    # etag and last modified functions both ask, look the recipe up once per request
+    if not hasattr(request, '_recipe_validators'):
+        request._recipe_validators = Recipe.objects.filter(pk=pk).values_list('version', 'updated_at').first()
+    return request._recipe_validators
+
+
+def recipe_version(request, pk):
+    validators = _recipe_validators(request, pk)
+    return validators[0] if validators else None
+
+
+def _media_type(request):
+    """The media type DRF's content negotiation will pick for request, these views keep the default renderers."""
+    renderers = [renderer() for renderer in api_settings.DEFAULT_RENDERER_CLASSES]
+    try:
+        _, media_type = api_settings.DEFAULT_CONTENT_NEGOTIATION_CLASS().select_renderer(request, renderers)
+    except NotAcceptable:
+        # answered with a 406 anyway
+        return ''
+    return media_type
+
+
+def _representation(request):
+    # the same rows render differently per renderer and query string, so both are part of the validator
+    return hashlib.md5(f'{_media_type(request)}|{request.get_full_path()}'.encode()).hexdigest()
+
+
+def _recipe_representation(request):
+    # a recipe only varies with the sparse fields, however they're spelled
+    return hashlib.md5(f'{_media_type(request)}|{SparseFields.from_request(request).key()}'.encode()).hexdigest()
+
+
+def recipe_etag(request, pk, **kwargs):
+    validators = _recipe_validators(request, pk)
+    if validators is None:
+        return None
+    return f'recipe-{pk}-{validators[0]}-{_recipe_representation(request)}'
+
+
+def recipe_last_modified(request, pk, **kwargs):
+    validators = _recipe_validators(request, pk)
+    return validators[1] if validators else None
+
+
+def _table_validators(request, model):
+    if not hasattr(request, '_table_validators'):
+        request._table_validators = model.objects.aggregate(count=Count('id'), updated_at=Max('updated_at'))
+    return request._table_validators
+
+
+def table_condition(model):
+    """
+    Conditional GET for a whole table listing. The row count catches deletes, the
+    latest updated_at catches inserts and edits, the query string tells pages apart.
+    """
+    def etag(request, *args, **kwargs):
+        validators = _table_validators(request, model)
+        updated_at = validators['updated_at'].timestamp() if validators['updated_at'] else 0
+        return f'{model._meta.model_name}-{validators["count"]}-{updated_at}-{_representation(request)}'
+
+    def last_modified(request, *args, **kwargs):
+        return _table_validators(request, model)['updated_at']
+
+    return method_decorator(condition(etag_func=etag, last_modified_func=last_modified), name='get')
+
+
+recipe_condition = method_decorator(
+    condition(etag_func=recipe_etag, last_modified_func=recipe_last_modified), name='get'
+)
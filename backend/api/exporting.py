@@ -0,0 +1,152 @@
+import csv
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+
+from .models import Recipe, RecipeIngredient
+
+
+CSV_COLUMNS = [
+    'id', 'name', 'description', 'category', 'author_id', 'author_username', 'created_at', 'updated_at',
+    'prep_time', 'prep_time_unit', 'cook_time', 'cook_time_units', 'servings',
+    'rating_count', 'avg_rating', 'rating_histogram', 'ingredients',
+]
+
+
+def export_queryset():
+    return Recipe.objects.select_related('author', 'category').prefetch_related(
+        Prefetch('recipeingredient_set', queryset=RecipeIngredient.objects.select_related('ingredient'))
+    ).order_by('id')
+
+
+def export_records(chunk_size=2000):
+    """
+    Yields every recipe as a plain dict. Rows come from a server-side cursor in chunks,
+    each chunk gets its authors, categories and ingredients in two extra queries.
+    """
+    for recipe in export_queryset().iterator(chunk_size=chunk_size):
+        yield export_record(recipe)
+
+
+async def aexport_records(chunk_size=2000):
+    """export_records() for ASGI, a chunk is fetched on a worker thread while the loop sends the last."""
+    async for recipe in export_queryset().aiterator(chunk_size=chunk_size):
+        yield export_record(recipe)
+
+
+def export_record(recipe):
+    return {
+        'id': recipe.id,
+        'name': recipe.name,
+        'description': recipe.description,
+        'category': recipe.category.name if recipe.category else None,
+        'author': {'id': recipe.author.id, 'username': recipe.author.username},
+        'created_at': recipe.created_at,
+        'updated_at': recipe.updated_at,
+        'prep_time': recipe.prep_time,
+        'prep_time_unit': recipe.prep_time_unit,
+        'cook_time': recipe.cook_time,
+        'cook_time_units': recipe.cook_time_units,
+        'servings': recipe.servings,
+        'rating_count': recipe.rating_count,
+        'avg_rating': recipe.avg_rating,
+        'rating_histogram': recipe.rating_histogram,
+        'ingredients': [
+            {
+                'id': item.ingredient.id,
+                'name': item.ingredient.name,
+                'quantity': item.quantity,
+                'unit': item.unit,
+                'note': item.note,
+            }
+            for item in recipe.recipeingredient_set.all()
+        ],
+    }
+
+
+class _Line:
+    # csv.writer only needs write(), handing the formatted line back lets it be streamed
+    def write(self, value):
+        return value
+
+
+def ndjson_line(record):
+    return json.dumps(record, cls=DjangoJSONEncoder) + '\n'
+
+
+_csv_writer = csv.writer(_Line())
+CSV_HEADER = _csv_writer.writerow(CSV_COLUMNS)
+
+
+def csv_line(record):
+    author = record.pop('author')
+    record['author_id'], record['author_username'] = author['id'], author['username']
+    record['rating_histogram'] = json.dumps(record['rating_histogram'])
+    record['ingredients'] = json.dumps(record['ingredients'])
+    return _csv_writer.writerow([record[column] for column in CSV_COLUMNS])
+
+
+# format -> (header line, record -> line, content type)
+EXPORT_FORMATS = {
+    'ndjson': ('', ndjson_line, 'application/x-ndjson'),
+    'csv': (CSV_HEADER, csv_line, 'text/csv'),
+}
+
+
+class Chunker:
+    """Batches lines into buffer_size byte chunks, gzip compressing them on the fly if asked."""
+    def __init__(self, gzip=False, buffer_size=64 * 1024):
+        self.compressor = zlib.compressobj(wbits=31) if gzip else None
+        self.buffer_size = buffer_size
+        self.buffer, self.size = [], 0
+
+    def add(self, line):
+        """A chunk once enough lines have been added, None until then."""
+        data = line.encode()
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size < self.buffer_size:
+            return None
+        chunk = b''.join(self.buffer)
+        self.buffer, self.size = [], 0
+        return self.compressor.compress(chunk) if self.compressor else chunk
+
+    def finish(self):
+        chunk = b''.join(self.buffer)
+        if self.compressor:
+            chunk = self.compressor.compress(chunk) + self.compressor.flush()
+        return chunk
+
+
+def encode(records, export_format, gzip=False):
+    """The records in export_format as byte chunks."""
+    header, line, _ = EXPORT_FORMATS[export_format]
+    chunker = Chunker(gzip)
+    chunk = chunker.add(header) if header else None
+    if chunk:
+        yield chunk
+    for record in records:
+        chunk = chunker.add(line(record))
+        if chunk:
+            yield chunk
+    chunk = chunker.finish()
+    if chunk:
+        yield chunk
+
+
+async def aencode(records, export_format, gzip=False):
+    """encode() of async records, an async iterator Django can stream under ASGI without buffering it."""
+    header, line, _ = EXPORT_FORMATS[export_format]
+    chunker = Chunker(gzip)
+    chunk = chunker.add(header) if header else None
+    if chunk:
+        yield chunk
+    async for record in records:
+        chunk = chunker.add(line(record))
+        if chunk:
+            yield chunk
+    chunk = chunker.finish()
+    if chunk:
+        yield chunk
@@ -0,0 +1,103 @@
+import logging
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Now
+from PIL import Image, ImageOps
+
+from .models import ImageJob, Profile, Recipe
+
+
+logger = logging.getLogger(__name__)
+
+# job kind -> (model, image field), the variants live in '<field>_variants'
+IMAGE_TARGETS = {
+    ImageJob.Kind.RECIPE: (Recipe, 'image'),
+    ImageJob.Kind.PROFILE: (Profile, 'profile_picture'),
+}
+
+EXTENSIONS = {'webp': 'webp', 'avif': 'avif'}
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def queue_image(kind, obj, field):
+    """Queues variant rendering unless the current file has been rendered already."""
+    image = getattr(obj, field)
+    if image and getattr(obj, f'{field}_variants').get('source') != image.name:
+        ImageJob.objects.create(kind=kind, object_id=obj.pk, source=image.name)
+
+
+def render_variants(image_file):
+    """
+    Renders every size in IMAGE_VARIANTS in every format of IMAGE_VARIANT_FORMATS.
+    Images over IMAGE_MAX_PIXELS are refused before decoding, JPEGs are decoded straight
+    at the largest size needed. Re-encoding drops EXIF and any other metadata.
+    """
+    sizes = sorted(settings.IMAGE_VARIANTS.items(), key=lambda item: item[1], reverse=True)
+    stem = os.path.splitext(image_file.name)[0]
+
+    with image_file.open('rb'), Image.open(image_file) as image:
+        if image.width * image.height > settings.IMAGE_MAX_PIXELS:
+            raise ImageTooLarge(f'{image.width}x{image.height} is over the {settings.IMAGE_MAX_PIXELS} pixel limit')
+        image.draft('RGB', (sizes[0][1], sizes[0][1]))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    variants = {}
+    for name, size in sizes:
+        # each size is scaled down from the previous, larger one
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        files = {}
+        for image_format in settings.IMAGE_VARIANT_FORMATS:
+            buffer = BytesIO()
+            image.save(buffer, image_format.upper(), quality=settings.IMAGE_VARIANT_QUALITY)
+            path = f'{stem}_{name}.{EXTENSIONS[image_format]}'
+            files[image_format] = default_storage.save(path, ContentFile(buffer.getvalue()))
+        variants[name] = {'width': image.width, 'height': image.height, 'files': files}
+    return {'source': image_file.name, 'variants': variants}
+
+
+def delete_variants(variants):
+    for variant in variants.get('variants', {}).values():
+        for path in variant['files'].values():
+            default_storage.delete(path)
+
+
+def process_image_jobs(batch_size=20):
+    """
+    Renders one batch of queued images. Jobs are claimed with SKIP LOCKED so workers can
+    run side by side, jobs for files that have since been replaced are dropped.
+    """
+    processed = failed = 0
+    with transaction.atomic():
+        jobs = list(ImageJob.objects.select_for_update(skip_locked=True).order_by('id')[:batch_size])
+        for job in jobs:
+            model, field = IMAGE_TARGETS[job.kind]
+            obj = model.objects.filter(pk=job.object_id, **{field: job.source}).first()
+            if obj is None:
+                continue
+            try:
+                variants = render_variants(getattr(obj, field))
+            except (OSError, ValueError, Image.DecompressionBombError) as exc:
+                failed += 1
+                logger.warning('Could not render variants of %s: %s', job.source, exc)
+                continue
+
+            changes = {f'{field}_variants': variants}
+            if model is Recipe:
+                # the variants are part of the recipe representation
+                changes.update(version=F('version') + 1, updated_at=Now())
+            model.objects.filter(pk=obj.pk).update(**changes)
+            delete_variants(getattr(obj, f'{field}_variants'))
+            processed += 1
+
+        ImageJob.objects.filter(pk__in=[job.pk for job in jobs]).delete()
+    return {'processed': processed, 'failed': failed, 'jobs': len(jobs)}
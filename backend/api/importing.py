@@ -0,0 +1,191 @@
+import json
+import time
+
+from django.db import connection, transaction
+from django.db.backends.postgresql.psycopg_any import is_psycopg3
+from rest_framework import serializers
+
+from .models import Category, Ingredient, Recipe, RecipeIngredient
+
+
+class ImportIngredientSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=100)
+    quantity = serializers.IntegerField(min_value=0)
+    unit = serializers.ChoiceField(choices=RecipeIngredient.Unit.choices)
+    note = serializers.CharField(max_length=100, required=False, allow_blank=True, default='')
+
+
+class ImportRecipeSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=200)
+    description = serializers.CharField()
+    category = serializers.CharField(max_length=100, required=False, allow_null=True, default=None)
+    prep_time = serializers.IntegerField(min_value=0)
+    prep_time_unit = serializers.ChoiceField(choices=Recipe.TimeUnits.choices, required=False, default='')
+    cook_time = serializers.IntegerField(min_value=0)
+    cook_time_units = serializers.ChoiceField(choices=Recipe.TimeUnits.choices, required=False, default='')
+    servings = serializers.IntegerField(min_value=0)
+    ingredients = ImportIngredientSerializer(many=True)
+
+    def validate_ingredients(self, value):
+        names = [item['name'] for item in value]
+        if len(set(names)) != len(names):
+            raise serializers.ValidationError('Each ingredient can only be listed once.')
+        return value
+
+
+class RecipeImporter:
+    """
+    Imports NDJSON recipes, one object per line, in chunked transactions. Categories and
+    ingredients are matched by name and created in bulk when missing. With psycopg 3
+    recipes and their ingredients are written with COPY, with psycopg 2 through
+    bulk_create. Only one chunk is held in memory at a time.
+    """
+    max_errors = 100
+
+    def __init__(self, author, chunk_size=1000, progress=None):
+        self.author = author
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.use_copy = is_psycopg3
+        self.categories = {}
+        self.ingredients = {}
+        self.recipes = 0
+        self.recipe_ingredients = 0
+        self.errors = []
+        self.error_count = 0
+        self.started = None
+        self.serializer = ImportRecipeSerializer()
+
+    def run(self, lines):
+        self.started = time.monotonic()
+        chunk = []
+        for number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            row = self.parse(number, line)
+            if row is not None:
+                chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                self.import_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.import_chunk(chunk)
+        return self.stats()
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            'recipes': self.recipes,
+            'recipe_ingredients': self.recipe_ingredients,
+            'errors': self.error_count,
+            'error_samples': self.errors,
+            'seconds': round(elapsed, 3),
+            'recipes_per_second': round(self.recipes / elapsed, 1) if elapsed else 0,
+        }
+
+    def parse(self, number, line):
+        try:
+            if isinstance(line, bytes):
+                line = line.decode()
+            # one serializer for every line, building the fields dominates a fresh instance
+            return self.serializer.run_validation(json.loads(line))
+        # UnicodeDecodeError included
+        except ValueError as exc:
+            self.error(number, str(exc))
+        except serializers.ValidationError as exc:
+            self.error(number, exc.detail)
+        return None
+
+    def error(self, number, detail):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': number, 'error': detail})
+
+    def import_chunk(self, rows):
+        with transaction.atomic():
+            categories = self.resolve(Category, self.categories, {row['category'] for row in rows if row['category']})
+            ingredients = self.resolve(
+                Ingredient, self.ingredients, {item['name'] for row in rows for item in row['ingredients']}
+            )
+            recipe_ids = self.allocate_ids(len(rows))
+
+            recipes, recipe_ingredients = [], []
+            for recipe_id, row in zip(recipe_ids, rows):
+                items = row.pop('ingredients')
+                category = row.pop('category')
+                recipes.append({
+                    **row, 'id': recipe_id, 'author_id': self.author.pk,
+                    'category_id': categories.get(category), 'ingredient_count': len(items),
+                })
+                recipe_ingredients.extend(
+                    {
+                        'recipe_id': recipe_id, 'ingredient_id': ingredients[item['name']],
+                        'quantity': item['quantity'], 'unit': item['unit'], 'note': item['note'],
+                    }
+                    for item in items
+                )
+
+            self.write(Recipe, recipes)
+            self.write(RecipeIngredient, recipe_ingredients)
+            Recipe.objects.filter(pk__in=recipe_ids).refresh_search_vector()
+
+        self.recipes += len(recipes)
+        self.recipe_ingredients += len(recipe_ingredients)
+        if self.progress:
+            self.progress(self.stats())
+
+    def resolve(self, model, known, names):
+        """Maps names to ids, creating the missing rows in one bulk_create."""
+        missing = names - known.keys()
+        if missing:
+            for pk, name in model.objects.filter(name__in=missing).order_by('-id').values_list('id', 'name'):
+                known[name] = pk
+            created = model.objects.bulk_create([model(name=name) for name in missing - known.keys()])
+            known.update((obj.name, obj.pk) for obj in created)
+        return known
+
+    def allocate_ids(self, count):
+        return allocate_ids(Recipe, count)
+
+    def write(self, model, rows):
+        write_rows(model, rows, use_copy=self.use_copy)
+
+
+def allocate_ids(model, count):
+    # COPY can't return generated keys, so the ids are taken from the sequence up front
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+            [model._meta.db_table, count]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def write_rows(model, rows, use_copy=is_psycopg3):
+    """
+    Writes rows of attname -> value, the remaining columns get the model defaults. The
+    primary key is written when the rows carry one, see allocate_ids().
+    """
+    if not rows:
+        return
+    if not use_copy:
+        model.objects.bulk_create([model(**row) for row in rows])
+        return
+
+    with_pk = model._meta.pk.attname in rows[0]
+    fields = [
+        field for field in model._meta.concrete_fields
+        if (with_pk or not field.primary_key) and field.name != 'search_vector'
+    ]
+    # defaults and auto_now values are prepared once per chunk instead of per row
+    template = model()
+    defaults = {
+        field.attname: field.get_db_prep_save(field.pre_save(template, add=True), connection)
+        for field in fields
+    }
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    table = connection.ops.quote_name(model._meta.db_table)
+    with connection.cursor() as cursor:
+        with cursor.cursor.copy(f'COPY {table} ({columns}) FROM STDIN') as copy:
+            for row in rows:
+                copy.write_row([row.get(field.attname, defaults[field.attname]) for field in fields])
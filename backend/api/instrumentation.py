@@ -0,0 +1,226 @@
+"""
+Per-request timings: the number of queries and the time spent in the database, in
+serializers and in rendering. RequestTimingMiddleware sends them as a Server-Timing
+header, logs requests slower than SLOW_REQUEST_SECONDS with their slowest statements,
+and adds them to per-route histograms served by metrics_view in the Prometheus text
+format. The histograms are kept by each process, a scraper needs to reach every worker.
+"""
+import contextvars
+import ipaddress
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound
+from django.utils.crypto import constant_time_compare
+from rest_framework.serializers import ListSerializer
+
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SLOW_STATEMENTS_LOGGED = 5
+METHODS = ('GET', 'HEAD', 'OPTIONS', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class RequestTimings:
+    """What one request has spent so far, in seconds."""
+    def __init__(self):
+        self.started = time.perf_counter()
+        # (duration, sql) of every statement
+        self.queries = []
+        self.db = 0.0
+        self.serializer = 0.0
+        self.render = 0.0
+
+    def server_timing(self, total):
+        return ', '.join((
+            f'db;dur={self.db * 1000:.1f};desc="{len(self.queries)} queries"',
+            f'serializer;dur={self.serializer * 1000:.1f}',
+            f'render;dur={self.render * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ))
+
+
+_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def time_query(execute, sql, params, many, context):
+    timings = _timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+        timings.db += duration
+        timings.queries.append((duration, sql))
+
+
+def install_query_timer(sender, connection, **kwargs):
+    # connection_created is sent on every connect of the same DatabaseWrapper
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+connection_created.connect(install_query_timer, dispatch_uid='api.instrumentation.install_query_timer')
+
+
+class TimedSerializerMixin:
+    """Adds the time spent in to_representation() of the outermost serializer to the request."""
+    def to_representation(self, instance):
+        timings = _timings.get()
+        parent = self.parent
+        if timings is None or not (parent is None or isinstance(parent, ListSerializer) and parent.parent is None):
+            return super().to_representation(instance)
+        start = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            timings.serializer += time.perf_counter() - start
+
+
+def add_render_time(seconds):
+    timings = _timings.get()
+    if timings is not None:
+        timings.render += seconds
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # one more for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    """Request histograms and counters by route, the url pattern the request matched."""
+    histograms = {
+        'api_request_duration_seconds': ('Time to answer a request.', DURATION_BUCKETS),
+        'api_request_db_seconds': ('Time spent waiting for the database.', DURATION_BUCKETS),
+        'api_request_db_queries': ('Number of database queries made.', QUERY_BUCKETS),
+        'api_request_serializer_seconds': ('Time spent in serializers.', DURATION_BUCKETS),
+        'api_request_render_seconds': ('Time spent rendering the response.', DURATION_BUCKETS),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (route, method) -> Histogram
+        self.observed = {name: {} for name in self.histograms}
+        # (route, method, status) -> count
+        self.requests = {}
+
+    def observe(self, route, method, status, total, timings):
+        values = {
+            'api_request_duration_seconds': total,
+            'api_request_db_seconds': timings.db,
+            'api_request_db_queries': len(timings.queries),
+            'api_request_serializer_seconds': timings.serializer,
+            'api_request_render_seconds': timings.render,
+        }
+        labels = (route, method)
+        with self.lock:
+            for name, value in values.items():
+                histogram = self.observed[name].get(labels)
+                if histogram is None:
+                    histogram = self.observed[name][labels] = Histogram(self.histograms[name][1])
+                histogram.observe(value)
+            key = (route, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.observed = {name: {} for name in self.histograms}
+            self.requests = {}
+
+    def render(self):
+        lines = [
+            '# HELP api_requests_total Requests answered.',
+            '# TYPE api_requests_total counter',
+        ]
+        with self.lock:
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append(f'api_requests_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+            for name, (help_text, buckets) in self.histograms.items():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for (route, method), histogram in sorted(self.observed[name].items()):
+                    labels = f'route="{route}",method="{method}"'
+                    cumulative = 0
+                    for bound, count in zip((*buckets, '+Inf'), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{labels}}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def route_of(request):
+    match = getattr(request, 'resolver_match', None)
+    # requests that matched no url share one label, any path can't become a series
+    return '/' + match.route if match is not None and match.route else 'unmatched'
+
+
+def start_request():
+    return _timings.set(RequestTimings())
+
+
+def finish_request(request, response, token):
+    timings = _timings.get()
+    _timings.reset(token)
+    total = time.perf_counter() - timings.started
+
+    response.headers['Server-Timing'] = timings.server_timing(total)
+    route = route_of(request)
+    method = request.method if request.method in METHODS else 'other'
+    metrics.observe(route, method, response.status_code, total, timings)
+    if total >= settings.SLOW_REQUEST_SECONDS:
+        log_slow_request(request, route, total, timings)
+    return response
+
+
+def log_slow_request(request, route, total, timings):
+    slowest = sorted(timings.queries, key=lambda query: query[0], reverse=True)[:SLOW_STATEMENTS_LOGGED]
+    logger.warning(
+        'Slow request %s %s (%s) %.3fs: %d queries in %.3fs, serializer %.3fs, render %.3fs%s',
+        request.method, request.get_full_path(), route, total, len(timings.queries), timings.db,
+        timings.serializer, timings.render,
+        ''.join(f'\n  {duration:.3f}s {sql}' for duration, sql in slowest),
+    )
+
+
+def metrics_allowed(request):
+    token = settings.METRICS_TOKEN
+    if token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in network for network in settings.METRICS_ALLOWED_IPS)
+
+
+def metrics_view(request):
+    """
+    The metrics in the Prometheus text format, for holders of METRICS_TOKEN and clients
+    in METRICS_ALLOWED_IPS. Routes and timings are not for everyone, without either
+    setting the endpoint doesn't exist.
+    """
+    if not settings.METRICS_TOKEN and not settings.METRICS_ALLOWED_IPS:
+        return HttpResponseNotFound()
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,406 @@
+import http.client
+import json
+import os
+import platform
+import random
+import secrets
+import statistics
+import subprocess
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+from django.urls import URLPattern, URLResolver, get_resolver
+from django.views.static import serve
+
+from api.models import Category, Comment, Ingredient, Rating, Recipe, User
+
+from .benchmark_reads import SERVERS, free_port, percentile
+
+
+class Scenario:
+    """
+    Requests of one kind against one route. path and body may hold {recipe}, {category},
+    {comment}, {rating} and {pantry}, filled from ids sampled out of the database for
+    every request, and {username}, {password} and {refresh} of the benchmark user.
+    """
+    def __init__(self, name, method, path, auth=False, body=None, writes=False, expect=(200,)):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.auth = auth
+        self.body = body
+        self.writes = writes
+        self.expect = expect
+
+    def request(self, rng, pools):
+        values = {name: rng.choice(choices) for name, choices in pools.items() if name != 'pantry'}
+        values['pantry'] = ','.join(map(str, rng.sample(pools['pantry'], min(12, len(pools['pantry'])))))
+        body = None
+        if self.body is not None:
+            body = json.dumps({key: value.format(**values) if isinstance(value, str) else value
+                               for key, value in self.body.items()})
+        return self.path.format(**values), body
+
+
+# by url pattern of backend/urls.py
+SCENARIOS = {
+    'metrics': [Scenario('metrics', 'GET', '/metrics')],
+    'api/token': [Scenario('token', 'POST', '/api/token', body={'username': '{username}', 'password': '{password}'})],
+    'api/token/refresh': [Scenario('token-refresh', 'POST', '/api/token/refresh', body={'refresh': '{refresh}'})],
+    'api/recipes/': [
+        Scenario('recipes', 'GET', '/api/recipes/'),
+        Scenario('recipes-top-rated', 'GET', '/api/recipes/?ordering=-avg_rating'),
+        Scenario('recipes-search', 'GET', '/api/recipes/?q=chicken'),
+        Scenario('recipes-sparse', 'GET', '/api/recipes/?fields=id,name,avg_rating'),
+    ],
+    'api/recipes/cookable': [Scenario('recipes-cookable', 'GET', '/api/recipes/cookable?ingredients={pantry}')],
+    'api/recipes/trending': [Scenario('recipes-trending', 'GET', '/api/recipes/trending')],
+    'api/recipes/cache-stats': [Scenario('recipe-cache-stats', 'GET', '/api/recipes/cache-stats', auth=True)],
+    'api/db/pool-stats': [Scenario('db-pool-stats', 'GET', '/api/db/pool-stats', auth=True)],
+    'api/recipes/<int:pk>': [Scenario('recipe', 'GET', '/api/recipes/{recipe}')],
+    'api/recipes/<int:pk>/similar': [Scenario('recipe-similar', 'GET', '/api/recipes/{recipe}/similar')],
+    'api/recipes/<int:pk>/comments': [
+        Scenario('recipe-comments', 'GET', '/api/recipes/{recipe}/comments'),
+        Scenario(
+            'recipe-comment-create', 'POST', '/api/recipes/{recipe}/comments', auth=True,
+            body={'text': 'Benchmark comment'}, writes=True, expect=(201,),
+        ),
+    ],
+    'api/recipes/<int:pk>/ratings': [
+        Scenario('recipe-ratings', 'GET', '/api/recipes/{recipe}/ratings'),
+        Scenario(
+            'recipe-rate', 'POST', '/api/recipes/{recipe}/ratings', auth=True,
+            body={'score': 4}, writes=True, expect=(200, 201),
+        ),
+    ],
+    'api/recipes/<int:pk>/ingredients': [Scenario('recipe-ingredients', 'GET', '/api/recipes/{recipe}/ingredients')],
+    'api/ingredients': [Scenario('ingredients', 'GET', '/api/ingredients')],
+    'api/categories': [Scenario('categories', 'GET', '/api/categories')],
+    'api/categories/<int:pk>': [Scenario('category', 'GET', '/api/categories/{category}')],
+    'api/categories/<int:pk>/trending': [
+        Scenario('category-trending', 'GET', '/api/categories/{category}/trending'),
+    ],
+    'api/comments/<int:pk>': [Scenario('comment', 'GET', '/api/comments/{comment}')],
+    'api/ratings/<int:pk>': [Scenario('rating', 'GET', '/api/ratings/{rating}', auth=True)],
+}
+
+SKIPPED = {
+    'admin/': 'the Django admin',
+    'api/register': 'creates an account and queues an email per request',
+    'api/recipes/import': 'a bulk upload, see manage.py import_recipes',
+    'api/recipes/export': 'streams every recipe, see manage.py export_recipes',
+    'api/activate/<uidb64>/<token>/': 'needs a fresh activation link per request',
+    'api/activate-send': 'queues an email per request',
+}
+
+
+def url_routes():
+    """The url patterns of ROOT_URLCONF, media files left out."""
+    routes = []
+    for pattern in get_resolver().url_patterns:
+        if isinstance(pattern, URLPattern) and pattern.callback is serve:
+            continue
+        if isinstance(pattern, (URLPattern, URLResolver)):
+            routes.append(str(pattern.pattern))
+    return routes
+
+
+def sample_ids(model, count, rng):
+    """Up to count ids spread over the table, without scanning it."""
+    bounds = model.objects.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return []
+    guesses = {rng.randint(bounds['low'], bounds['high']) for _ in range(count * 2)}
+    ids = sorted(model.objects.filter(pk__in=guesses).values_list('pk', flat=True))[:count]
+    return ids or list(model.objects.order_by('pk').values_list('pk', flat=True)[:count])
+
+
+def queries_of(response):
+    # 'db;dur=1.2;desc="3 queries"' from api.instrumentation
+    for metric in response.getheader('Server-Timing', '').split(','):
+        name, *params = metric.strip().split(';')
+        if name == 'db':
+            for param in params:
+                if param.startswith('desc="'):
+                    return int(param[6:].split()[0])
+    return None
+
+
+class Runner:
+    def __init__(self, host, port, headers, pools, seed):
+        self.host = host
+        self.port = port
+        self.headers = headers
+        self.pools = pools
+        self.seed = seed
+
+    def send(self, connection, scenario, rng):
+        path, body = scenario.request(rng, self.pools)
+        headers = {'Accept': 'application/json', **self.headers['common']}
+        if scenario.auth:
+            headers.update(self.headers['auth'])
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        connection.request(scenario.method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response
+
+    def run(self, scenario, concurrency, requests, warmup):
+        latencies, queries, errors = [], [], []
+        lock = threading.Lock()
+
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        rng = random.Random(self.seed)
+        for _ in range(warmup):
+            self.send(connection, scenario, rng)
+        connection.close()
+
+        def client(number, count):
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            rng = random.Random(f'{self.seed}-{scenario.name}-{number}')
+            try:
+                for _ in range(count):
+                    started = time.perf_counter()
+                    try:
+                        response = self.send(connection, scenario, rng)
+                    except (OSError, http.client.HTTPException) as exc:
+                        connection.close()
+                        with lock:
+                            errors.append(type(exc).__name__)
+                        continue
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        if response.status in scenario.expect:
+                            latencies.append(elapsed)
+                            queries.append(queries_of(response))
+                        else:
+                            errors.append(response.status)
+            finally:
+                connection.close()
+
+        counts = [requests // concurrency + (number < requests % concurrency) for number in range(concurrency)]
+        threads = [threading.Thread(target=client, args=(number, count)) for number, count in enumerate(counts)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        counted = [count for count in queries if count is not None]
+        return {
+            'method': scenario.method,
+            'path': scenario.path,
+            'requests': len(latencies) + len(errors),
+            'errors': len(errors),
+            'error_samples': sorted(set(map(str, errors)))[:5],
+            'seconds': round(elapsed, 3),
+            'requests_per_second': round(len(latencies) / elapsed, 1) if elapsed else 0,
+            'mean_ms': round(statistics.mean(latencies) * 1000, 2) if latencies else 0,
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'queries_per_request': round(statistics.mean(counted), 2) if counted else None,
+        }
+
+
+def git_revision():
+    def git(*args):
+        result = subprocess.run(['git', *args], cwd=settings.BASE_DIR, capture_output=True, text=True)
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    commit = git('rev-parse', 'HEAD')
+    return {'commit': commit, 'dirty': bool(git('status', '--porcelain', '--untracked-files=no')) if commit else None}
+
+
+def change(old, new):
+    return (new - old) / old * 100 if old else 0.0
+
+
+class Command(BaseCommand):
+    help = (
+        'Drives every endpoint of backend/urls.py at a fixed concurrency and reports p50/p95/p99 latency, '
+        'throughput and queries per request, written as JSON. Seed the database first, see manage.py seed. '
+        'Writes are left out unless --writes is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='A running server to benchmark, otherwise one is started')
+        parser.add_argument('--server', choices=list(SERVERS), default='wsgi', help='The server to start')
+        parser.add_argument('--workers', type=int, default=2, help='Processes of the started server')
+        parser.add_argument('--threads', type=int, default=4, help='Threads per WSGI worker')
+        parser.add_argument('--concurrency', type=int, default=8, help='Clients sending requests at once')
+        parser.add_argument('--requests', type=int, default=400, help='Requests per scenario')
+        parser.add_argument('--warmup', type=int, default=20, help='Requests per scenario left out of the results')
+        parser.add_argument('--only', nargs='+', metavar='SCENARIO', help='Run these scenarios only')
+        parser.add_argument('--writes', action='store_true', help='Also create comments and ratings')
+        parser.add_argument('--username', default='seed-admin', help='Staff user for the authenticated scenarios')
+        parser.add_argument('--password', default='password')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='JSON file to write, defaults to benchmarks/<time>-<commit>.json')
+        parser.add_argument('--compare', help='Earlier JSON result to compare with')
+        parser.add_argument(
+            '--threshold', type=float, default=10.0, help='Percent of p95 or throughput change flagged by --compare'
+        )
+
+    def handle(self, *args, **options):
+        scenarios = self.scenarios(options)
+        rng = random.Random(options['seed'])
+        pools = {
+            'recipe': sample_ids(Recipe, 1000, rng),
+            'category': sample_ids(Category, 100, rng),
+            'comment': sample_ids(Comment, 1000, rng),
+            'rating': sample_ids(Rating, 1000, rng),
+            'pantry': sample_ids(Ingredient, 200, rng),
+        }
+        empty = [name for name, ids in pools.items() if not ids]
+        if empty:
+            raise CommandError(f"No {', '.join(empty)} rows to request, run manage.py seed first")
+        if not User.objects.filter(username=options['username'], is_staff=True).exists():
+            raise CommandError(f"Staff user {options['username']} does not exist, see manage.py seed --admin")
+
+        server = None
+        metrics_token = settings.METRICS_TOKEN
+        if options['url']:
+            url = urlsplit(options['url'])
+            host, port = url.hostname, url.port or 80
+        else:
+            host, port = '127.0.0.1', free_port()
+            # /metrics is a 404 without a token or an allowed address
+            metrics_token = metrics_token or secrets.token_urlsafe()
+            server = subprocess.Popen(
+                SERVERS[options['server']](options, port), env={
+                    **os.environ, 'METRICS_TOKEN': metrics_token,
+                    'ASYNC_READ_VIEWS': '1' if options['server'] == 'asgi' else '0',
+                }, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+        try:
+            self.wait_until_ready(host, port)
+            tokens = self.login(host, port, options)
+            # the token scenarios send these
+            pools.update(username=[options['username']], password=[options['password']], refresh=[tokens['refresh']])
+            headers = {'common': {}, 'auth': {'Authorization': f"Bearer {tokens['access']}"}}
+            if metrics_token:
+                # only /metrics looks at it without a user
+                headers['common']['Authorization'] = f'Bearer {metrics_token}'
+            runner = Runner(host, port, headers, pools, options['seed'])
+            results = {}
+            for scenario in scenarios:
+                results[scenario.name] = result = runner.run(
+                    scenario, options['concurrency'], options['requests'], options['warmup']
+                )
+                self.report(scenario.name, result)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+        record = {
+            **git_revision(),
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'options': {key: options[key] for key in (
+                'url', 'server', 'workers', 'threads', 'concurrency', 'requests', 'warmup', 'writes', 'seed'
+            )},
+            'dataset': {
+                'recipes': Recipe.objects.count(),
+                'ratings': Rating.objects.count(),
+                'comments': Comment.objects.count(),
+                'users': User.objects.count(),
+            },
+            'results': results,
+            'skipped': SKIPPED,
+        }
+        output = Path(options['output'] or self.default_output(record))
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(record, indent=2) + '\n')
+        self.stdout.write(self.style.SUCCESS(f'Wrote {output}'))
+
+        if options['compare']:
+            self.compare(json.loads(Path(options['compare']).read_text()), record, options['threshold'])
+
+    def scenarios(self, options):
+        routes = url_routes()
+        uncovered = [route for route in routes if route not in SCENARIOS and route not in SKIPPED]
+        if uncovered:
+            raise CommandError(f"No benchmark scenario for {', '.join(uncovered)}, add one to SCENARIOS or SKIPPED")
+        scenarios = [
+            scenario for route in routes for scenario in SCENARIOS.get(route, ())
+            if options['writes'] or not scenario.writes
+        ]
+        if options['only']:
+            unknown = set(options['only']) - {scenario.name for route in SCENARIOS.values() for scenario in route}
+            if unknown:
+                raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+            scenarios = [scenario for scenario in scenarios if scenario.name in options['only']]
+        return scenarios
+
+    def login(self, host, port, options):
+        credentials = {'username': options['username'], 'password': options['password']}
+        connection = http.client.HTTPConnection(host, port, timeout=60)
+        try:
+            connection.request(
+                'POST', '/api/token', body=json.dumps(credentials),
+                headers={'Content-Type': 'application/json', 'Accept': 'application/json'},
+            )
+            response = connection.getresponse()
+            tokens = json.loads(response.read() or b'{}')
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise CommandError(f"Could not log in as {options['username']}: {response.status} {tokens}")
+        return tokens
+
+    def wait_until_ready(self, host, port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                connection = http.client.HTTPConnection(host, port, timeout=5)
+                connection.request('GET', '/api/categories', headers={'Accept': 'application/json'})
+                if connection.getresponse().status == 200:
+                    return
+            except (OSError, http.client.HTTPException):
+                pass
+            finally:
+                connection.close()
+            time.sleep(0.2)
+        raise CommandError(f'Server on {host}:{port} did not answer /api/categories with 200 in {timeout}s')
+
+    def default_output(self, record):
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        commit = (record['commit'] or 'unknown')[:12] + ('-dirty' if record['dirty'] else '')
+        return Path(settings.BASE_DIR) / 'benchmarks' / f'{stamp}-{commit}.json'
+
+    def report(self, name, result):
+        queries = result['queries_per_request']
+        self.stdout.write(
+            f"{name:24} {result['requests_per_second']:8.1f} req/s  p50 {result['p50_ms']:7.1f}ms  "
+            f"p95 {result['p95_ms']:7.1f}ms  p99 {result['p99_ms']:7.1f}ms  "
+            f"{'-' if queries is None else queries:>5} queries  {result['errors']} errors"
+        )
+
+    def compare(self, baseline, record, threshold):
+        self.stdout.write(f"Compared with {(baseline.get('commit') or 'unknown')[:12]} of {baseline.get('created_at')}")
+        for name, result in record['results'].items():
+            old = baseline.get('results', {}).get(name)
+            if old is None:
+                self.stdout.write(f'{name:24} new')
+                continue
+            p95 = change(old['p95_ms'], result['p95_ms'])
+            throughput = change(old['requests_per_second'], result['requests_per_second'])
+            line = f'{name:24} p95 {p95:+6.1f}%  throughput {throughput:+6.1f}%'
+            if old.get('queries_per_request') != result['queries_per_request']:
+                line += f"  queries {old.get('queries_per_request')} -> {result['queries_per_request']}"
+            if p95 > threshold or throughput < -threshold:
+                self.stdout.write(self.style.WARNING(f'{line}  slower'))
+            elif p95 < -threshold or throughput > threshold:
+                self.stdout.write(self.style.SUCCESS(f'{line}  faster'))
+            else:
+                self.stdout.write(line)
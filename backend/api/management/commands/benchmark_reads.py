@@ -0,0 +1,132 @@
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+SERVERS = {
+    # the sync DRF views behind a threaded WSGI server
+    'wsgi': lambda options, port: [
+        sys.executable, '-m', 'gunicorn', 'backend.wsgi:application', '--bind', f'127.0.0.1:{port}',
+        '--workers', str(options['workers']), '--threads', str(options['threads']), '--worker-class', 'gthread',
+    ],
+    # the views of api.async_views behind an ASGI server
+    'asgi': lambda options, port: [
+        sys.executable, '-m', 'uvicorn', 'backend.asgi:application', '--host', '127.0.0.1', '--port', str(port),
+        '--workers', str(options['workers']), '--no-access-log',
+    ],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def fetch(port, path, slow):
+    """One GET over a fresh connection, the request head trickling in over slow seconds."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        head = f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nAccept: application/json\r\nConnection: close\r\n\r\n'.encode()
+        pieces = [head[:len(head) // 2], head[len(head) // 2:]]
+        for piece in pieces:
+            writer.write(piece)
+            await writer.drain()
+            if slow and piece is not pieces[-1]:
+                await asyncio.sleep(slow)
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def run_clients(port, path, clients, requests, slow):
+    latencies, errors = [], 0
+
+    async def client():
+        nonlocal errors
+        for _ in range(requests):
+            started = time.monotonic()
+            try:
+                status = await fetch(port, path, slow)
+            except (OSError, IndexError, ValueError):
+                status = None
+            if status == 200:
+                latencies.append(time.monotonic() - started)
+            else:
+                errors += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    return latencies, errors, time.monotonic() - started
+
+
+def percentile(values, fraction):
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares the WSGI path (sync DRF views, gunicorn gthread) with the ASGI path (async views, uvicorn) '
+        'for one read endpoint under many concurrent slow clients. Both servers use the configured database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/api/recipes/')
+        parser.add_argument('--clients', type=int, default=100, help='Concurrent clients')
+        parser.add_argument('--requests', type=int, default=5, help='Requests per client')
+        parser.add_argument('--slow', type=float, default=0.2, help='Seconds each client takes to send its request')
+        parser.add_argument('--workers', type=int, default=1, help='Server processes per path')
+        parser.add_argument('--threads', type=int, default=4, help='Threads per WSGI worker')
+        parser.add_argument('--servers', nargs='+', choices=list(SERVERS), default=list(SERVERS))
+
+    def handle(self, *args, **options):
+        for name in options['servers']:
+            result = self.benchmark(name, options)
+            self.stdout.write(
+                f"{name}: {result['requests_per_second']:.1f} req/s, p50 {result['p50_ms']:.0f}ms, "
+                f"p99 {result['p99_ms']:.0f}ms, {result['errors']} errors"
+            )
+
+    def benchmark(self, name, options):
+        port = free_port()
+        env = {**os.environ, 'ASYNC_READ_VIEWS': '1' if name == 'asgi' else '0'}
+        server = subprocess.Popen(
+            SERVERS[name](options, port), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            self.wait_until_ready(port, options['path'])
+            latencies, errors, elapsed = asyncio.run(
+                run_clients(port, options['path'], options['clients'], options['requests'], options['slow'])
+            )
+        finally:
+            server.terminate()
+            server.wait()
+
+        return {
+            'requests': len(latencies) + errors,
+            'errors': errors,
+            'seconds': round(elapsed, 3),
+            'requests_per_second': len(latencies) / elapsed if elapsed else 0,
+            'mean_ms': statistics.mean(latencies) * 1000 if latencies else 0,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+
+    def wait_until_ready(self, port, path, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if asyncio.run(fetch(port, path, 0)) == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise CommandError(f'Server on port {port} did not answer {path} with 200 in {timeout}s')
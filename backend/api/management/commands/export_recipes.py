@@ -0,0 +1,28 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from api.exporting import EXPORT_FORMATS, encode, export_records
+
+
+class Command(BaseCommand):
+    help = 'Streams every recipe with its ingredients, rating summary and author as NDJSON or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+        parser.add_argument('--output', default='-', help="File to write, '-' writes stdout")
+        parser.add_argument('--gzip', action='store_true', help='Gzip the output')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Recipes fetched per round trip')
+
+    def handle(self, *args, **options):
+        chunks = encode(export_records(options['chunk_size']), options['format'], gzip=options['gzip'])
+
+        if options['output'] == '-':
+            output = sys.stdout.buffer
+            for chunk in chunks:
+                output.write(chunk)
+            output.flush()
+        else:
+            with open(options['output'], 'wb') as output:
+                for chunk in chunks:
+                    output.write(chunk)
@@ -0,0 +1,38 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.importing import RecipeImporter
+from api.models import User
+
+
+class Command(BaseCommand):
+    help = 'Imports recipes from an NDJSON file (one recipe object per line).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="NDJSON file to import, '-' reads stdin")
+        parser.add_argument('--author', required=True, help='Username the imported recipes belong to')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Recipes per transaction')
+
+    def handle(self, *args, **options):
+        try:
+            author = User.objects.get(username=options['author'])
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['author']} does not exist")
+
+        importer = RecipeImporter(author, chunk_size=options['chunk_size'], progress=self.report)
+        if options['path'] == '-':
+            stats = importer.run(sys.stdin)
+        else:
+            with open(options['path'], encoding='utf-8') as lines:
+                stats = importer.run(lines)
+
+        for sample in stats['error_samples']:
+            self.stderr.write(f"line {sample['line']}: {sample['error']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats['recipes']} recipes with {stats['recipe_ingredients']} ingredients "
+            f"in {stats['seconds']}s ({stats['recipes_per_second']} recipes/s), {stats['errors']} lines skipped"
+        ))
+
+    def report(self, stats):
+        self.stdout.write(f"{stats['recipes']} recipes, {stats['recipes_per_second']} recipes/s")
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.images import process_image_jobs
+from api.models import ImageJob
+
+
+class Command(BaseCommand):
+    help = 'Renders resized WebP/AVIF variants of uploaded recipe images and profile pictures.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--loop', action='store_true', help='Keep polling instead of exiting once the queue is empty')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to sleep between polls with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            processed = failed = 0
+            while True:
+                result = process_image_jobs(options['batch_size'])
+                processed += result['processed']
+                failed += result['failed']
+                if result['jobs'] < options['batch_size']:
+                    break
+
+            elapsed = time.monotonic() - started
+            if processed or failed or not options['loop']:
+                self.stdout.write(
+                    f'processed {processed}, failed {failed} in {elapsed:.2f}s, '
+                    f'queue depth {ImageJob.objects.count()}'
+                )
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
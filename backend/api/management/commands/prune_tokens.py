@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.blacklist import prune_expired_tokens
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired outstanding and blacklisted refresh tokens in small batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0.1, help='Seconds to sleep between batches')
+        parser.add_argument('--loop', action='store_true', help='Keep pruning instead of exiting after one pass')
+        parser.add_argument('--interval', type=float, default=3600, help='Seconds to sleep between passes with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            deleted = prune_expired_tokens(options['batch_size'], options['pause'])
+            elapsed = time.monotonic() - started
+            self.stdout.write(f'deleted {deleted} expired tokens in {elapsed:.2f}s')
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
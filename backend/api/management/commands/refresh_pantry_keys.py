@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.pantry import refresh_pantry_keys
+
+
+class Command(BaseCommand):
+    help = (
+        'Recounts how many recipes use each ingredient and recomputes the pantry keys of the recipes whose '
+        'rarest ingredients that changes, keeping /api/recipes/cookable from reading recipes by their staples.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Recipe ids per transaction')
+        parser.add_argument('--loop', action='store_true', help='Keep refreshing instead of exiting after one pass')
+        parser.add_argument('--interval', type=float, default=86400, help='Seconds to sleep between passes with --loop')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+        while True:
+            started = time.monotonic()
+            stats = refresh_pantry_keys(options['chunk_size'])
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                f"recounted {stats['ingredients']} ingredients, rekeyed {stats['recipes']} recipes in {elapsed:.2f}s"
+            )
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,39 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import similarity
+
+
+class Command(BaseCommand):
+    help = (
+        'Recomputes the similar recipes served at /api/recipes/<pk>/similar for recipes whose category or '
+        'ingredients changed and the recipes those changes affect, or for every recipe with --full. Needs numpy '
+        'and scipy.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Recompute every recipe, after settings changed')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes computing neighbours')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Recipes per worker task and transaction')
+        parser.add_argument('--loop', action='store_true', help='Keep refreshing instead of exiting after one pass')
+        parser.add_argument('--interval', type=float, default=3600, help='Seconds to sleep between passes with --loop')
+
+    def handle(self, *args, **options):
+        if similarity.np is None:
+            raise CommandError('refresh_similar needs numpy and scipy, see requirements.txt')
+        if options['workers'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('--workers and --chunk-size must be at least 1')
+        while True:
+            builder = similarity.NeighbourBuilder(
+                full=options['full'], workers=options['workers'], chunk_size=options['chunk_size'],
+            )
+            stats = builder.run()
+            self.stdout.write(
+                f"rebuilt {stats['rebuilt']} of {stats['recipes']} recipes, {stats['changed']} changed, "
+                f"in {stats['seconds']:.2f}s"
+            )
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
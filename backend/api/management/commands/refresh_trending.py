@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.models import Recipe
+from api.trending import refresh_scores
+
+
+class Command(BaseCommand):
+    help = (
+        'Recounts the trending scores of recipes from the ratings and comments of the last TRENDING_WINDOW_DAYS, '
+        'dropping deleted activity, and clears the cached rankings.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep refreshing instead of exiting after one pass')
+        parser.add_argument('--interval', type=float, default=3600, help='Seconds to sleep between passes with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            refresh_scores()
+            elapsed = time.monotonic() - started
+            scored = Recipe.objects.filter(trending_score__isnull=False).count()
+            self.stdout.write(f'scored {scored} recipes in {elapsed:.2f}s')
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
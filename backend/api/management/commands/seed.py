@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import Profile, User
+from api.seeding import CATEGORIES, DatasetSeeder
+
+
+class Command(BaseCommand):
+    help = (
+        'Adds a synthetic dataset: users, categories, ingredients, and recipes with ingredients, ratings and '
+        'comments. The same --seed gives the same data. 10k recipes take seconds, 1M minutes, for 10M raise '
+        '--users along with --recipes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipes', type=int, default=10_000)
+        parser.add_argument('--users', type=int, help='Defaults to one per 20 recipes, at least 100')
+        parser.add_argument('--ingredients', type=int, default=2000)
+        parser.add_argument('--categories', type=int, default=len(CATEGORIES))
+        parser.add_argument('--ratings', type=float, default=5.0, help='Mean ratings per recipe')
+        parser.add_argument('--comments', type=float, default=1.0, help='Mean comments per recipe')
+        parser.add_argument('--days', type=int, default=3 * 365, help='Recipes are spread over this many days')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--password', default='password', help='Password of every seeded user')
+        parser.add_argument(
+            '--admin', default='seed-admin', help="Superuser with --password to create if missing, '' for none"
+        )
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Recipes per transaction')
+
+    def handle(self, *args, **options):
+        users = options['users'] or max(100, options['recipes'] // 20)
+        if min(options['ingredients'], options['categories']) < 1:
+            raise CommandError('--ingredients and --categories must be at least 1')
+
+        if options['admin'] and not User.objects.filter(username=options['admin']).exists():
+            admin = User.objects.create_superuser(
+                options['admin'], f"{options['admin']}@example.com", options['password']
+            )
+            Profile.objects.create(user=admin)
+
+        seeder = DatasetSeeder(
+            options['recipes'], users, ingredients=options['ingredients'], categories=options['categories'],
+            ratings=options['ratings'], comments=options['comments'], seed=options['seed'],
+            password=options['password'], chunk_size=options['chunk_size'], days=options['days'],
+            progress=self.report,
+        )
+        stats = seeder.run()
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {stats['users']} users and {stats['recipes']} recipes with {stats['recipe_ingredients']} "
+            f"ingredients, {stats['ratings']} ratings and {stats['comments']} comments in {stats['seconds']}s "
+            f"({stats['recipes_per_second']} recipes/s)"
+        ))
+
+    def report(self, stats):
+        self.stdout.write(f"{stats['recipes']} recipes, {stats['recipes_per_second']} recipes/s")
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.services import deliver_outbox, outbox_depth
+
+
+class Command(BaseCommand):
+    help = 'Sends queued outbox emails in batches over one reused mail server connection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--loop', action='store_true', help='Keep polling instead of exiting once the outbox is drained')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to sleep between polls with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            sent = failed = 0
+            while True:
+                result = deliver_outbox(options['batch_size'])
+                sent += result['sent']
+                failed += result['failed']
+                if result['sent'] + result['failed'] < options['batch_size']:
+                    break
+
+            elapsed = time.monotonic() - started
+            if sent or failed or not options['loop']:
+                self.stdout.write(
+                    f"sent {sent}, failed {failed} in {elapsed:.2f}s "
+                    f"({sent / elapsed if elapsed else 0:.1f} emails/s), queue depth {outbox_depth()}"
+                )
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,186 @@
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+from . import instrumentation, routers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_TYPES = (
+    'application/json', 'application/x-ndjson', 'application/javascript', 'application/xml', 'image/svg+xml',
+)
+
+
+def gzip_compressor():
+    compressor = zlib.compressobj(settings.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def brotli_compressor():
+    compressor = brotli.Compressor(quality=settings.COMPRESSION_BROTLI_QUALITY)
+    return compressor.process, compressor.flush, compressor.finish
+
+
+# by preference, brotli only when the package is installed
+COMPRESSORS = {'br': brotli_compressor, 'gzip': gzip_compressor} if brotli else {'gzip': gzip_compressor}
+
+
+def negotiate_encoding(accept_encoding):
+    """The encoding of COMPRESSORS with the highest q value in the Accept-Encoding header, if any."""
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, *params = item.split(';')
+        weight = 1.0
+        for param in params:
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.strip().lower()] = weight
+
+    ranked = sorted(COMPRESSORS, key=lambda coding: -weights.get(coding, weights.get('*', 0.0)))
+    best = ranked[0]
+    return best if weights.get(best, weights.get('*', 0.0)) > 0 else None
+
+
+def is_compressible(content_type):
+    media_type = content_type.split(';')[0].strip().lower()
+    return media_type.startswith('text/') or media_type.endswith(('+json', '+xml')) or media_type in COMPRESSIBLE_TYPES
+
+
+class CompressionMiddleware:
+    """
+    Brotli or gzip compression of text responses, whichever the client prefers, brotli
+    winning ties. Bodies under COMPRESSION_MIN_SIZE bytes aren't worth it and are sent
+    as they are, streaming responses are compressed chunk by chunk and each chunk is
+    flushed so the client can decode it on arrival. Responses that already have a
+    Content-Encoding, like a gzipped export, are left alone. Works under WSGI and ASGI
+    without moving to a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.process_response(request, await self.get_response(request))
+
+    def process_response(self, request, response):
+        if response.has_header('Content-Encoding') or not is_compressible(response.get('Content-Type', '')):
+            return response
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = negotiate_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        compress, flush, finish = COMPRESSORS[encoding]()
+        if response.streaming:
+            response.streaming_content = self.compress_stream(response, compress, flush, finish)
+            # the compressed size isn't known until the end
+            del response.headers['Content-Length']
+        else:
+            content = compress(response.content) + finish()
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+            response.headers['Content-Length'] = str(len(content))
+
+        # a strong ETag promises the same bytes, which a different encoding isn't
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    @staticmethod
+    def compress_stream(response, compress, flush, finish):
+        chunks = response.streaming_content
+        if response.is_async:
+            async def compressed():
+                async for chunk in chunks:
+                    yield compress(chunk) + flush()
+                yield finish()
+        else:
+            def compressed():
+                for chunk in chunks:
+                    yield compress(chunk) + flush()
+                yield finish()
+        return compressed()
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Lets api.routers.ReplicaRouter see the request its queries are made for, and pins
+    the client to the primary after a successful write.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = routers.start_request(request)
+        try:
+            return self.process_response(request, self.get_response(request))
+        finally:
+            routers.end_request(token)
+
+    async def __acall__(self, request):
+        token = routers.start_request(request)
+        try:
+            return self.process_response(request, await self.get_response(request))
+        finally:
+            routers.end_request(token)
+
+    def process_response(self, request, response):
+        if settings.DATABASE_REPLICAS and request.method not in routers.SAFE_METHODS and response.status_code < 400:
+            routers.pin_to_primary(request, response)
+        return response
+
+
+class RequestTimingMiddleware:
+    """
+    Times the request for api.instrumentation, first in MIDDLEWARE so the total covers
+    every other middleware.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = instrumentation.start_request()
+        return instrumentation.finish_request(request, self.get_response(request), token)
+
+    async def __acall__(self, request):
+        token = instrumentation.start_request()
+        return instrumentation.finish_request(request, await self.get_response(request), token)
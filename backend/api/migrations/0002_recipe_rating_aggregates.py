@@ -0,0 +1,73 @@
+# Generated by Django 5.2.6 on 2026-10-17 12:51
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    Recipe = apps.get_model('api', 'Recipe')
+    Rating = apps.get_model('api', 'Rating')
+
+    histogram = {f'rating_{score}_count': Count('id', filter=Q(score=score)) for score in range(1, 6)}
+    aggregates = Rating.objects.values('recipe_id').annotate(
+        rating_count=Count('id'), rating_sum=Sum('score'), **histogram
+    )
+    for row in aggregates.iterator():
+        recipe_id = row.pop('recipe_id')
+        row['avg_rating'] = row['rating_sum'] / row['rating_count']
+        Recipe.objects.filter(pk=recipe_id).update(**row)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='avg_rating',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='rating_1_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='rating_2_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='rating_3_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='rating_4_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='rating_5_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-avg_rating', '-id'], name='recipe_avg_rating_idx'),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.6 on 2026-10-17 12:54
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+BACKFILL_SEARCH_VECTOR = """
+    UPDATE api_recipe AS recipe SET search_vector =
+        setweight(to_tsvector('english', recipe.name), 'A') ||
+        setweight(to_tsvector('english', coalesce(
+            (SELECT category.name FROM api_category AS category WHERE category.id = recipe.category_id), ''
+        )), 'B') ||
+        setweight(to_tsvector('english', coalesce(
+            (SELECT string_agg(ingredient.name, ' ')
+             FROM api_recipeingredient AS recipe_ingredient
+             JOIN api_ingredient AS ingredient ON ingredient.id = recipe_ingredient.ingredient_id
+             WHERE recipe_ingredient.recipe_id = recipe.id), ''
+        )), 'B') ||
+        setweight(to_tsvector('english', recipe.description), 'C')
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_recipe_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='recipe_search_vector_idx'),
+        ),
+        migrations.RunSQL(BACKFILL_SEARCH_VECTOR, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.6 on 2026-10-17 12:56
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_ingredient_count(apps, schema_editor):
+    Recipe = apps.get_model('api', 'Recipe')
+    RecipeIngredient = apps.get_model('api', 'RecipeIngredient')
+
+    Recipe.objects.update(ingredient_count=Coalesce(Subquery(
+        RecipeIngredient.objects.filter(recipe=OuterRef('pk'))
+        .values('recipe').annotate(count=Count('id')).values('count')[:1]
+    ), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_recipe_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='ingredient_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='recipeingredient',
+            index=models.Index(fields=['ingredient', 'recipe'], name='recipeingredient_postings_idx'),
+        ),
+        migrations.RunPython(backfill_ingredient_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.6 on 2026-10-17 12:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_recipe_ingredient_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['recipe', '-created_at', '-id'], name='comment_recipe_created_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rating',
+            index=models.Index(fields=['recipe', '-created_at', '-id'], name='rating_recipe_created_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-created_at', '-id'], name='recipe_created_at_idx'),
+        ),
+    ]
@@ -0,0 +1,112 @@
+# Generated by Django 5.2.6 on 2026-10-17 14:03
+
+from django.db import migrations, models
+from django.db.models import Count, F, Max, Q, Sum
+
+
+# services.rate_recipe: creates or replaces an author's rating of a recipe and applies the
+# change to the recipe aggregates like services.apply_rating_change, in one round trip.
+# Every statement sees the rows committed before it, which a single statement with CTEs
+# doesn't once it had to wait for a concurrent rating. The rating is locked before the
+# recipe, the order a delete takes them in. No row for an unknown recipe.
+CREATE_RATE_RECIPE = """
+    CREATE FUNCTION api_rate_recipe(recipe_pk bigint, author_pk bigint, new_score integer)
+    RETURNS TABLE (rating_id bigint, rating_created_at timestamptz, rating_updated_at timestamptz, old_score integer)
+    LANGUAGE plpgsql AS $$
+    DECLARE
+        rating api_rating%ROWTYPE;
+        old integer;
+    BEGIN
+        LOOP
+            SELECT r.score INTO old FROM api_rating AS r
+            WHERE r.recipe_id = recipe_pk AND r.author_id = author_pk
+            FOR UPDATE;
+            IF FOUND THEN
+                UPDATE api_rating AS r SET score = new_score, updated_at = now()
+                WHERE r.recipe_id = recipe_pk AND r.author_id = author_pk
+                RETURNING r.* INTO rating;
+                EXIT;
+            END IF;
+
+            INSERT INTO api_rating (recipe_id, author_id, score, created_at, updated_at)
+            SELECT recipe.id, author_pk, new_score, now(), now() FROM api_recipe AS recipe WHERE recipe.id = recipe_pk
+            ON CONFLICT (recipe_id, author_id) DO NOTHING
+            RETURNING * INTO rating;
+            EXIT WHEN FOUND;
+            IF NOT EXISTS (SELECT FROM api_recipe AS recipe WHERE recipe.id = recipe_pk) THEN
+                RETURN;
+            END IF;
+            -- the author rated the recipe concurrently, the next SELECT sees that rating
+        END LOOP;
+
+        IF new_score IS DISTINCT FROM old THEN
+            UPDATE api_recipe AS recipe SET
+                version = recipe.version + 1,
+                updated_at = now(),
+                rating_count = recipe.rating_count + (old IS NULL)::int,
+                rating_sum = recipe.rating_sum + new_score - coalesce(old, 0),
+                avg_rating = (recipe.rating_sum + new_score - coalesce(old, 0))::float
+                    / (recipe.rating_count + (old IS NULL)::int),
+                rating_1_count = recipe.rating_1_count + (new_score = 1)::int - (old IS NOT DISTINCT FROM 1)::int,
+                rating_2_count = recipe.rating_2_count + (new_score = 2)::int - (old IS NOT DISTINCT FROM 2)::int,
+                rating_3_count = recipe.rating_3_count + (new_score = 3)::int - (old IS NOT DISTINCT FROM 3)::int,
+                rating_4_count = recipe.rating_4_count + (new_score = 4)::int - (old IS NOT DISTINCT FROM 4)::int,
+                rating_5_count = recipe.rating_5_count + (new_score = 5)::int - (old IS NOT DISTINCT FROM 5)::int
+            WHERE recipe.id = recipe_pk;
+        END IF;
+
+        RETURN QUERY SELECT rating.id, rating.created_at, rating.updated_at, old;
+    END
+    $$
+"""
+
+DROP_RATE_RECIPE = 'DROP FUNCTION api_rate_recipe(bigint, bigint, integer)'
+
+
+def remove_duplicate_ratings(apps, schema_editor):
+    """Keeps the latest of an author's ratings of a recipe and recounts the recipes that had more."""
+    Recipe = apps.get_model('api', 'Recipe')
+    Rating = apps.get_model('api', 'Rating')
+
+    duplicates = (
+        Rating.objects.filter(author__isnull=False).values('recipe_id', 'author_id')
+        .annotate(count=Count('id'), latest=Max('id')).filter(count__gt=1)
+    )
+    recipe_ids = set()
+    for row in duplicates.iterator():
+        Rating.objects.filter(recipe_id=row['recipe_id'], author_id=row['author_id']).exclude(id=row['latest']).delete()
+        recipe_ids.add(row['recipe_id'])
+
+    histogram = {f'rating_{score}_count': Count('id', filter=Q(score=score)) for score in range(1, 6)}
+    aggregates = Rating.objects.filter(recipe_id__in=recipe_ids).values('recipe_id').annotate(
+        rating_count=Count('id'), rating_sum=Sum('score'), **histogram
+    )
+    for row in aggregates.iterator():
+        recipe_id = row.pop('recipe_id')
+        row['avg_rating'] = row['rating_sum'] / row['rating_count']
+        row['version'] = F('version') + 1
+        Recipe.objects.filter(pk=recipe_id).update(**row)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_image_variants'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['category', '-created_at', '-id'], name='recipe_category_created_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['author', '-created_at', '-id'], name='recipe_author_created_at_idx'),
+        ),
+        migrations.RunPython(remove_duplicate_ratings, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='rating',
+            constraint=models.UniqueConstraint(fields=('recipe', 'author'), name='rating_recipe_author_unique'),
+        ),
+        migrations.RunSQL(CREATE_RATE_RECIPE, DROP_RATE_RECIPE),
+    ]
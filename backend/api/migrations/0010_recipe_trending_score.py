@@ -0,0 +1,91 @@
+# Generated by Django 5.2.6 on 2026-10-17 14:31
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+
+previous = import_module('api.migrations.0009_rating_upsert_and_recipe_indexes')
+
+# api_rate_recipe of 0009 that also adds the rating's activity, in the log2 form of
+# api.trending, to the recipe's trending_score
+CREATE_RATE_RECIPE = """
+    CREATE FUNCTION api_rate_recipe(recipe_pk bigint, author_pk bigint, new_score integer, activity double precision)
+    RETURNS TABLE (rating_id bigint, rating_created_at timestamptz, rating_updated_at timestamptz, old_score integer)
+    LANGUAGE plpgsql AS $$
+    DECLARE
+        rating api_rating%ROWTYPE;
+        old integer;
+    BEGIN
+        LOOP
+            SELECT r.score INTO old FROM api_rating AS r
+            WHERE r.recipe_id = recipe_pk AND r.author_id = author_pk
+            FOR UPDATE;
+            IF FOUND THEN
+                UPDATE api_rating AS r SET score = new_score, updated_at = now()
+                WHERE r.recipe_id = recipe_pk AND r.author_id = author_pk
+                RETURNING r.* INTO rating;
+                EXIT;
+            END IF;
+
+            INSERT INTO api_rating (recipe_id, author_id, score, created_at, updated_at)
+            SELECT recipe.id, author_pk, new_score, now(), now() FROM api_recipe AS recipe WHERE recipe.id = recipe_pk
+            ON CONFLICT (recipe_id, author_id) DO NOTHING
+            RETURNING * INTO rating;
+            EXIT WHEN FOUND;
+            IF NOT EXISTS (SELECT FROM api_recipe AS recipe WHERE recipe.id = recipe_pk) THEN
+                RETURN;
+            END IF;
+            -- the author rated the recipe concurrently, the next SELECT sees that rating
+        END LOOP;
+
+        IF new_score IS DISTINCT FROM old THEN
+            UPDATE api_recipe AS recipe SET
+                version = recipe.version + 1,
+                updated_at = now(),
+                rating_count = recipe.rating_count + (old IS NULL)::int,
+                rating_sum = recipe.rating_sum + new_score - coalesce(old, 0),
+                avg_rating = (recipe.rating_sum + new_score - coalesce(old, 0))::float
+                    / (recipe.rating_count + (old IS NULL)::int),
+                rating_1_count = recipe.rating_1_count + (new_score = 1)::int - (old IS NOT DISTINCT FROM 1)::int,
+                rating_2_count = recipe.rating_2_count + (new_score = 2)::int - (old IS NOT DISTINCT FROM 2)::int,
+                rating_3_count = recipe.rating_3_count + (new_score = 3)::int - (old IS NOT DISTINCT FROM 3)::int,
+                rating_4_count = recipe.rating_4_count + (new_score = 4)::int - (old IS NOT DISTINCT FROM 4)::int,
+                rating_5_count = recipe.rating_5_count + (new_score = 5)::int - (old IS NOT DISTINCT FROM 5)::int,
+                trending_score = CASE WHEN recipe.trending_score IS NULL THEN activity
+                    ELSE greatest(recipe.trending_score, activity)
+                        + ln(1 + power(2, -least(abs(recipe.trending_score - activity), 60))) / ln(2) END
+            WHERE recipe.id = recipe_pk;
+        END IF;
+
+        RETURN QUERY SELECT rating.id, rating.created_at, rating.updated_at, old;
+    END
+    $$
+"""
+
+DROP_RATE_RECIPE = 'DROP FUNCTION api_rate_recipe(bigint, bigint, integer, double precision)'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_rating_upsert_and_recipe_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='trending_score',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(condition=models.Q(('trending_score__isnull', False)), fields=['-trending_score', '-id'], name='recipe_trending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(condition=models.Q(('trending_score__isnull', False)), fields=['category', '-trending_score', '-id'], name='recipe_category_trending_idx'),
+        ),
+        migrations.RunSQL(previous.DROP_RATE_RECIPE, previous.CREATE_RATE_RECIPE),
+        migrations.RunSQL(CREATE_RATE_RECIPE, DROP_RATE_RECIPE),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.6 on 2026-10-17 14:39
+
+import django.contrib.postgres.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_recipe_trending_score'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipeNeighbours',
+            fields=[
+                ('recipe', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='neighbours', serialize=False, to='api.recipe')),
+                ('recipe_ids', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), size=None)),
+                ('scores', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), size=None)),
+                ('signature', models.BigIntegerField()),
+                ('built_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,50 @@
+from django.db import migrations
+
+
+# Recipe.ingredient_count, read by pantry matching, has to drop whenever recipe ingredients
+# go away: through RecipeWriteSerializer, an Ingredient's cascade or any other delete. A
+# post_delete receiver would cost every cascade a SELECT of the rows, the trigger counts
+# the deleted rows of one statement in the database instead.
+CREATE_COUNT_TRIGGER = """
+    CREATE FUNCTION api_recipe_ingredients_deleted() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE api_recipe AS recipe SET ingredient_count = greatest(recipe.ingredient_count - deleted.count, 0)
+        FROM (SELECT recipe_id, count(*) AS count FROM deleted_rows GROUP BY recipe_id) AS deleted
+        WHERE recipe.id = deleted.recipe_id;
+        RETURN NULL;
+    END
+    $$;
+
+    CREATE TRIGGER recipeingredient_count_on_delete
+    AFTER DELETE ON api_recipeingredient REFERENCING OLD TABLE AS deleted_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION api_recipe_ingredients_deleted();
+"""
+
+DROP_COUNT_TRIGGER = """
+    DROP TRIGGER recipeingredient_count_on_delete ON api_recipeingredient;
+    DROP FUNCTION api_recipe_ingredients_deleted();
+"""
+
+
+# counts left too high by deletes made before the trigger
+RECOUNT = """
+    UPDATE api_recipe AS recipe SET ingredient_count = counted.count
+    FROM (
+        SELECT recipe.id, count(recipe_ingredient.id) AS count FROM api_recipe AS recipe
+        LEFT JOIN api_recipeingredient AS recipe_ingredient ON recipe_ingredient.recipe_id = recipe.id
+        GROUP BY recipe.id
+    ) AS counted
+    WHERE recipe.id = counted.id AND recipe.ingredient_count <> counted.count
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_recipe_neighbours'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_COUNT_TRIGGER, DROP_COUNT_TRIGGER),
+        migrations.RunSQL(RECOUNT, migrations.RunSQL.noop),
+    ]
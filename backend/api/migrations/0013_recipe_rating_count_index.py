@@ -0,0 +1,17 @@
+# Generated by Django 5.2.6 on 2026-10-17 15:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_recipe_ingredient_count_trigger'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-rating_count', '-id'], name='recipe_rating_count_idx'),
+        ),
+    ]
@@ -0,0 +1,109 @@
+# Generated by Django 5.2.6 on 2026-10-17 15:57
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+# The PANTRY_KEY_COUNT rarest ingredients of a recipe. Volatile, so an UPDATE that waited
+# for a concurrent write to a recipe recomputes its keys from what that write committed.
+CREATE_PANTRY_KEYS = """
+    CREATE FUNCTION api_recipe_pantry_keys(recipe bigint) RETURNS bigint[] LANGUAGE sql VOLATILE AS $$
+        SELECT coalesce(array_agg(rarest.ingredient_id ORDER BY rarest.ingredient_id), '{}') FROM (
+            SELECT recipe_ingredient.ingredient_id
+            FROM api_recipeingredient AS recipe_ingredient
+            JOIN api_ingredient AS ingredient ON ingredient.id = recipe_ingredient.ingredient_id
+            WHERE recipe_ingredient.recipe_id = $1
+            ORDER BY ingredient.recipe_count, recipe_ingredient.ingredient_id
+            LIMIT 4
+        ) AS rarest
+    $$;
+
+    CREATE FUNCTION api_recipe_ingredients_changed() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE api_recipe SET pantry_keys = api_recipe_pantry_keys(id)
+            WHERE id IN (SELECT recipe_id FROM new_rows);
+        ELSE
+            -- bulk_update() of quantities and units moves no ingredient
+            UPDATE api_recipe SET pantry_keys = api_recipe_pantry_keys(id) WHERE id IN (
+                SELECT unnest(ARRAY[old_row.recipe_id, new_row.recipe_id])
+                FROM old_rows AS old_row JOIN new_rows AS new_row ON new_row.id = old_row.id
+                WHERE (old_row.recipe_id, old_row.ingredient_id) IS DISTINCT FROM (new_row.recipe_id, new_row.ingredient_id)
+            );
+        END IF;
+        RETURN NULL;
+    END
+    $$;
+
+    CREATE TRIGGER recipeingredient_keys_on_insert
+    AFTER INSERT ON api_recipeingredient REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION api_recipe_ingredients_changed();
+
+    CREATE TRIGGER recipeingredient_keys_on_update
+    AFTER UPDATE ON api_recipeingredient
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION api_recipe_ingredients_changed();
+
+    -- deletes already update the recipes for ingredient_count, see migration 0012
+    CREATE OR REPLACE FUNCTION api_recipe_ingredients_deleted() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE api_recipe AS recipe SET
+            ingredient_count = greatest(recipe.ingredient_count - deleted.count, 0),
+            pantry_keys = api_recipe_pantry_keys(recipe.id)
+        FROM (SELECT recipe_id, count(*) AS count FROM deleted_rows GROUP BY recipe_id) AS deleted
+        WHERE recipe.id = deleted.recipe_id;
+        RETURN NULL;
+    END
+    $$;
+"""
+
+DROP_PANTRY_KEYS = """
+    CREATE OR REPLACE FUNCTION api_recipe_ingredients_deleted() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE api_recipe AS recipe SET ingredient_count = greatest(recipe.ingredient_count - deleted.count, 0)
+        FROM (SELECT recipe_id, count(*) AS count FROM deleted_rows GROUP BY recipe_id) AS deleted
+        WHERE recipe.id = deleted.recipe_id;
+        RETURN NULL;
+    END
+    $$;
+
+    DROP TRIGGER recipeingredient_keys_on_update ON api_recipeingredient;
+    DROP TRIGGER recipeingredient_keys_on_insert ON api_recipeingredient;
+    DROP FUNCTION api_recipe_ingredients_changed();
+    DROP FUNCTION api_recipe_pantry_keys(bigint);
+"""
+
+BACKFILL_PANTRY_KEYS = """
+    UPDATE api_ingredient AS ingredient SET recipe_count = counted.count
+    FROM (SELECT ingredient_id, count(*) AS count FROM api_recipeingredient GROUP BY ingredient_id) AS counted
+    WHERE ingredient.id = counted.ingredient_id;
+
+    UPDATE api_recipe SET pantry_keys = api_recipe_pantry_keys(id);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_recipe_rating_count_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingredient',
+            name='recipe_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='pantry_keys',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), default=list, editable=False, size=None),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['pantry_keys'], name='recipe_pantry_keys_idx'),
+        ),
+        migrations.RunSQL(CREATE_PANTRY_KEYS, DROP_PANTRY_KEYS),
+        migrations.RunSQL(BACKFILL_PANTRY_KEYS, migrations.RunSQL.noop),
+    ]
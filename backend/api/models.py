@@ -1,6 +1,12 @@
-from django.db import models
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.core.exceptions import EmptyResultSet
+from django.contrib.postgres.search import SearchVectorField
+from django.db import connection, models
+from django.db.models.functions import Coalesce, Now
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.hashers import make_password
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 
@@ -29,6 +35,8 @@ class Profile(models.Model):
     bio = models.TextField(blank=True, null=True)
     website = models.URLField(blank=True, null=True)
     profile_picture = models.ImageField(upload_to=user_profile_picture_path, blank=True, null=True)
+    # resized copies written by api.images, see ImageJob
+    profile_picture_variants = models.JSONField(default=dict, blank=True, editable=False)
 
     def __str__(self):
         return f"{self.user.username}'s profile"
@@ -36,37 +44,171 @@ class Profile(models.Model):
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.name
     
 
 
+SEARCH_CONFIG = 'english'
+
+# name ranks above category and ingredient names, which rank above the description
+SEARCH_VECTOR_SQL = f"""
+    UPDATE api_recipe AS recipe SET search_vector =
+        setweight(to_tsvector('{SEARCH_CONFIG}', recipe.name), 'A') ||
+        setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(
+            (SELECT category.name FROM api_category AS category WHERE category.id = recipe.category_id), ''
+        )), 'B') ||
+        setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(
+            (SELECT string_agg(ingredient.name, ' ')
+             FROM api_recipeingredient AS recipe_ingredient
+             JOIN api_ingredient AS ingredient ON ingredient.id = recipe_ingredient.ingredient_id
+             WHERE recipe_ingredient.recipe_id = recipe.id), ''
+        )), 'B') ||
+        setweight(to_tsvector('{SEARCH_CONFIG}', recipe.description), 'C')
+    WHERE recipe.id IN
+"""
+
+# Recipe.pantry_keys holds this many of a recipe's ingredients, the rarest by
+# Ingredient.recipe_count. A recipe missing at most PANTRY_KEY_COUNT - 1 ingredients of a
+# pantry has one of them in it, so pantry matching only reads the recipes whose keys
+# overlap the pantry, and staples in nearly every recipe are rarely anyone's key.
+# Migration 0014 has the number too.
+PANTRY_KEY_COUNT = 4
+
+
+class RecipeQuerySet(models.QuerySet):
+    def touch(self, **changes):
+        self.update(version=models.F('version') + 1, updated_at=Now(), **changes)
+
+    def refresh_search_vector(self):
+        try:
+            sql, params = self.values('id').query.sql_with_params()
+        except EmptyResultSet:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(f'{SEARCH_VECTOR_SQL} ({sql})', params)
+
+    def refresh_ingredient_count(self):
+        self.update(ingredient_count=Coalesce(models.Subquery(
+            RecipeIngredient.objects.filter(recipe=models.OuterRef('pk'))
+            .values('recipe').annotate(count=models.Count('id')).values('count')[:1]
+        ), 0))
+
+    def with_related(self, author=True, category=False, ingredients=True):
+        # the relations RecipeSerializer renders, in a fixed number of queries,
+        # the category is only rendered as an id unless expanded
+        related = [name for name, wanted in [('author', author), ('category', category)] if wanted]
+        queryset = self.select_related(*related) if related else self
+        if ingredients:
+            queryset = queryset.prefetch_related(
+                models.Prefetch(
+                    'recipeingredient_set',
+                    queryset=RecipeIngredient.objects.select_related('ingredient')
+                )
+            )
+        return queryset
+
+
 class Recipe(models.Model):
     class TimeUnits(models.TextChoices):
         MINUTES = 'minutes'
         HOURS = 'hours'
 
     image = models.ImageField(upload_to='recipe_images/', blank=True, null=True)
+    # resized copies written by api.images, see ImageJob
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True)
     name = models.CharField(max_length=200)
     description = models.TextField()
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='recipes')
     created_at = models.DateField(auto_now_add=True)
-    updated_at = models.DateField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True)
     prep_time = models.PositiveIntegerField()
     prep_time_unit = models.CharField(max_length=10, choices=TimeUnits.choices, blank=True)
     cook_time = models.PositiveIntegerField()
     cook_time_units = models.CharField(max_length=10, choices=TimeUnits.choices, blank=True)
     servings = models.PositiveIntegerField()
 
+    # rating aggregates, kept in sync by services.apply_rating_change
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    avg_rating = models.FloatField(default=0)
+    rating_1_count = models.PositiveIntegerField(default=0)
+    rating_2_count = models.PositiveIntegerField(default=0)
+    rating_3_count = models.PositiveIntegerField(default=0)
+    rating_4_count = models.PositiveIntegerField(default=0)
+    rating_5_count = models.PositiveIntegerField(default=0)
+
+    # size of the ingredient list, pantry matching compares it against the matched postings,
+    # deletes lower it through the trigger of migration 0012
+    ingredient_count = models.PositiveIntegerField(default=0)
+
+    # the rarest ingredients, see PANTRY_KEY_COUNT, kept in sync by the triggers of migration 0014
+    pantry_keys = ArrayField(models.BigIntegerField(), default=list, editable=False)
+
+    # name, category, ingredients and description, kept in sync by api.signals
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    # bumped on every change to the recipe or anything nested under it, backs the ETag
+    version = models.PositiveIntegerField(default=1)
+
+    # time-decayed popularity in the log2 form of api.trending, null without recent activity
+    trending_score = models.FloatField(null=True, editable=False)
+
+    objects = RecipeQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-avg_rating', '-id'], name='recipe_avg_rating_idx'),
+            models.Index(fields=['-rating_count', '-id'], name='recipe_rating_count_idx'),
+            models.Index(fields=['-created_at', '-id'], name='recipe_created_at_idx'),
+            # a category's and an author's newest recipes
+            models.Index(fields=['category', '-created_at', '-id'], name='recipe_category_created_at_idx'),
+            models.Index(fields=['author', '-created_at', '-id'], name='recipe_author_created_at_idx'),
+            GinIndex(fields=['search_vector'], name='recipe_search_vector_idx'),
+            GinIndex(fields=['pantry_keys'], name='recipe_pantry_keys_idx'),
+            # the trending feeds, most recipes have no score
+            models.Index(
+                fields=['-trending_score', '-id'], name='recipe_trending_idx',
+                condition=models.Q(trending_score__isnull=False),
+            ),
+            models.Index(
+                fields=['category', '-trending_score', '-id'], name='recipe_category_trending_idx',
+                condition=models.Q(trending_score__isnull=False),
+            ),
+        ]
+
+    # maintained with atomic UPDATEs, a plain save must not write stale copies back
+    DENORMALIZED_FIELDS = {
+        'rating_count', 'rating_sum', 'avg_rating', 'rating_1_count', 'rating_2_count',
+        'rating_3_count', 'rating_4_count', 'rating_5_count', 'ingredient_count',
+        'search_vector', 'version', 'image_variants', 'trending_score', 'pantry_keys',
+    }
+
     def __str__(self):
         return 'Recipe for ' + self.name
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.DENORMALIZED_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+    @property
+    def rating_histogram(self):
+        return {score: getattr(self, f'rating_{score}_count') for score in Rating.Score.values}
+
 
 class Ingredient(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # recipes using it as of the last manage.py refresh_pantry_keys, only orders pantry keys
+    recipe_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return 'Ingredient ' + self.name
@@ -90,6 +232,10 @@ class RecipeIngredient(models.Model):
 
     class Meta:
         unique_together = ('recipe', 'ingredient')
+        indexes = [
+            # ingredient -> recipes posting lists for pantry matching
+            models.Index(fields=['ingredient', 'recipe'], name='recipeingredient_postings_idx'),
+        ]
 
 
 class Comment(models.Model):
@@ -98,6 +244,11 @@ class Comment(models.Model):
     text = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['recipe', '-created_at', '-id'], name='comment_recipe_created_at_idx'),
+        ]
+
     def __str__(self):
         return self.author.username + "'s " + 'comment'
     
@@ -115,6 +266,75 @@ class Rating(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['recipe', '-created_at', '-id'], name='rating_recipe_created_at_idx'),
+        ]
+        constraints = [
+            # one rating per author and recipe, services.rate_recipe upserts against it
+            models.UniqueConstraint(fields=['recipe', 'author'], name='rating_recipe_author_unique'),
+        ]
+
     def __str__(self):
         return self.author.username + "'s rating for " + self.recipe
-    
\ No newline at end of file
+    
+
+
+class RecipeNeighbours(models.Model):
+    """The recipes most similar to a recipe, best first, written by api.similarity."""
+    recipe = models.OneToOneField(Recipe, on_delete=models.CASCADE, primary_key=True, related_name='neighbours')
+    recipe_ids = ArrayField(models.BigIntegerField())
+    scores = ArrayField(models.FloatField())
+    # of the category and ingredients the neighbours were computed from, see api.similarity
+    signature = models.BigIntegerField()
+    built_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Neighbours of recipe {self.recipe_id}'
+
+
+class OutboxEmail(models.Model):
+    """Emails written in the same transaction as the change that triggers them, sent by send_outbox."""
+    class Status(models.TextChoices):
+        PENDING = 'pending'
+        SENT = 'sent'
+        FAILED = 'failed'
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254)
+    to = models.JSONField()
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['next_attempt_at', 'id'], name='outbox_pending_idx',
+                condition=models.Q(status='pending')
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.to)}"
+
+
+
+class ImageJob(models.Model):
+    """An uploaded image waiting for api.images to render its variants."""
+    class Kind(models.TextChoices):
+        RECIPE = 'recipe'
+        PROFILE = 'profile'
+
+    kind = models.CharField(max_length=10, choices=Kind.choices)
+    object_id = models.PositiveBigIntegerField()
+    # the file the job was queued for, a newer upload makes the job obsolete
+    source = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.kind} {self.object_id}: {self.source}'
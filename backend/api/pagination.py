@@ -0,0 +1,136 @@
+import base64
+import datetime
+import json
+from collections import OrderedDict
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class CreatedAtCursorPagination(PageNumberPagination):
+    """
+    Page numbers by default. Sending ?cursor= (empty for the first page) switches to
+    keyset pages, so every page costs the same no matter how deep it is and rows inserted
+    meanwhile are neither repeated nor skipped. Keyset pages keep the ordering of the
+    queryset, a search's rank or ?ordering=, with id breaking ties, and (-created_at, -id)
+    when it has none. The cursor holds the values of the last row in those fields.
+    Cursor pages skip the count unless ?count=exact or ?count=estimate asks for it.
+    """
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    ordering = ('-created_at', '-id')
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_mode = self.cursor_query_param in request.query_params
+        if not self.cursor_mode:
+            return super().paginate_queryset(queryset.order_by(*self.get_cursor_ordering(queryset)), request, view)
+
+        self.request = request
+        self.count = self.get_cursor_count(queryset.order_by())
+        rows = list(self.get_cursor_slice(queryset))
+        return self.set_cursor_page(rows)
+
+    def get_cursor_ordering(self, queryset):
+        """
+        The ordering of the queryset, or the default one, made total with id in the
+        direction of the first field. Page numbers use it as well, so both agree.
+        """
+        ordering = [name for name in queryset.query.order_by if isinstance(name, str)] or list(self.ordering)
+        if not any(name.lstrip('-') in ('id', 'pk') for name in ordering):
+            ordering.append('-id' if ordering[0].startswith('-') else 'id')
+        return ordering
+
+    def get_cursor_slice(self, queryset):
+        self.cursor_ordering = self.get_cursor_ordering(queryset)
+        queryset = queryset.order_by(*self.cursor_ordering)
+        position = self.decode_cursor(self.request, queryset.model)
+        if position is not None:
+            first, value = self.cursor_ordering[0], position[0]
+            bound = 'lte' if first.startswith('-') else 'gte'
+            # the first condition bounds the index range, the second one only drops ties
+            queryset = queryset.filter(**{f'{first.lstrip("-")}__{bound}': value}).filter(self.after(position))
+        return queryset[:self.get_page_size(self.request) + 1]
+
+    def after(self, position):
+        """Rows past position: equal in the first fields and past it in the next one."""
+        conditions, equal = [], {}
+        for name, value in zip(self.cursor_ordering, position):
+            field = name.lstrip('-')
+            past = 'lt' if name.startswith('-') else 'gt'
+            conditions.append(Q(**equal, **{f'{field}__{past}': value}))
+            equal[field] = value
+        return reduce(or_, conditions)
+
+    def set_cursor_page(self, rows):
+        page_size = self.get_page_size(self.request)
+        self.page = rows[:page_size]
+        self.has_next = len(rows) > page_size
+        return self.page
+
+    def get_cursor_count(self, queryset):
+        mode = self.request.query_params.get(self.count_query_param)
+        if mode == 'exact':
+            return queryset.count()
+        if mode == 'estimate':
+            # the planner's row estimate, one catalog lookup instead of a scan
+            return self.plan_rows(queryset.explain(format='json'))
+        return None
+
+    def plan_rows(self, plan):
+        return int(json.loads(plan)[0]['Plan']['Plan Rows'])
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            # a cursor of another ordering, one taken before ?ordering= changed
+            if not isinstance(values, list) or len(values) != len(self.cursor_ordering):
+                raise ValueError
+            return [self.cursor_value(model, name.lstrip('-'), value) for name, value in zip(self.cursor_ordering, values)]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def cursor_value(self, model, name, value):
+        try:
+            field = model._meta.pk if name == 'pk' else model._meta.get_field(name)
+        except FieldDoesNotExist:
+            # an annotation such as the search rank
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError
+            return value
+        if value is None:
+            raise ValueError
+        return field.to_python(value)
+
+    def encode_cursor(self, obj):
+        values = [getattr(obj, name.lstrip('-')) for name in self.cursor_ordering]
+        position = json.dumps([
+            value.isoformat() if isinstance(value, (datetime.date, datetime.datetime)) else value for value in values
+        ])
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def get_next_link(self):
+        if not self.cursor_mode:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super().get_paginated_response(data)
+        response = OrderedDict([('next', self.get_next_link())])
+        if self.count is not None:
+            response['count'] = self.count
+        response['results'] = data
+        return Response(response)
@@ -0,0 +1,42 @@
+"""
+Pantry keys: Recipe.pantry_keys holds the PANTRY_KEY_COUNT ingredients of a recipe that
+the fewest recipes use, by Ingredient.recipe_count. Triggers on the recipe ingredients
+table recompute a recipe's keys whenever its ingredients change, see migration 0014,
+but the counts they order by only change here. Stale counts never make pantry matching
+miss a recipe, any PANTRY_KEY_COUNT of its ingredients would do, they only make staples
+turn up as keys and the candidates more numerous.
+"""
+from django.db import connection, transaction
+
+from .models import Recipe
+
+
+RECOUNT_SQL = """
+    UPDATE api_ingredient AS ingredient SET recipe_count = coalesce(counted.count, 0)
+    FROM api_ingredient AS current
+    LEFT JOIN (
+        SELECT ingredient_id, count(*) AS count FROM api_recipeingredient GROUP BY ingredient_id
+    ) AS counted ON counted.ingredient_id = current.id
+    WHERE ingredient.id = current.id AND ingredient.recipe_count <> coalesce(counted.count, 0)
+"""
+
+# api_recipe_pantry_keys() reads the ingredients again after waiting for a concurrent write
+REKEY_SQL = """
+    UPDATE api_recipe SET pantry_keys = api_recipe_pantry_keys(id)
+    WHERE id >= %s AND id < %s AND pantry_keys IS DISTINCT FROM api_recipe_pantry_keys(id)
+"""
+
+
+def refresh_pantry_keys(chunk_size=10000):
+    """Recounts Ingredient.recipe_count and rekeys the recipes it reorders, a chunk per transaction."""
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(RECOUNT_SQL)
+        ingredients = cursor.rowcount
+
+    recipes = 0
+    last = Recipe.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    for start in range(0, last + 1, chunk_size):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(REKEY_SQL, [start, start + chunk_size])
+            recipes += cursor.rowcount
+    return {'ingredients': ingredients, 'recipes': recipes}
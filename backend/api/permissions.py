@@ -5,7 +5,8 @@ class IsAuthorOrReadOnly(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return True
 
-        return obj.author == request.user
+        # comparing ids, the request user isn't a model instance and obj.author may not be loaded
+        return obj.author_id == request.user.id
 
 
 class IsAdminOrReadOnly(permissions.BasePermission):
@@ -0,0 +1,36 @@
+from django.db import connections
+
+
+def pool_stats():
+    """
+    Connection pool usage of this process per database alias with a pool. Counters run
+    from the start of the process. saturation is the share of max_size handed out right
+    now, mean_wait_ms averages over every checkout including the ones that didn't wait.
+    """
+    stats = {}
+    for alias in connections:
+        pool = getattr(connections[alias], 'pool', None)
+        if pool is None:
+            continue
+        counters = pool.get_stats()
+        size, available = counters['pool_size'], counters['pool_available']
+        requests = counters.get('requests_num', 0)
+        wait_ms = counters.get('requests_wait_ms', 0)
+        stats[alias] = {
+            'min_size': counters['pool_min'],
+            'max_size': counters['pool_max'],
+            'size': size,
+            'in_use': size - available,
+            'available': available,
+            'saturation': round((size - available) / counters['pool_max'], 3),
+            'waiting': counters.get('requests_waiting', 0),
+            'requests': requests,
+            'queued': counters.get('requests_queued', 0),
+            'wait_ms': wait_ms,
+            'mean_wait_ms': round(wait_ms / requests, 3) if requests else 0,
+            'timeouts': counters.get('requests_errors', 0),
+            'connections_opened': counters.get('connections_num', 0),
+            'connections_lost': counters.get('connections_lost', 0),
+            'bad_returns': counters.get('returns_bad', 0),
+        }
+    return stats
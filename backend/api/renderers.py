@@ -0,0 +1,58 @@
+"""
+JSON rendering and parsing with orjson. The output is the same bytes DRF's JSONRenderer
+writes for everything the api returns, datetimes with a UTC offset end in 'Z', decimals
+and other types orjson doesn't know go through DRF's encoder. The one difference is
+floats outside 1e-4..1e16, orjson writes 1e16 where json writes 1e+16, which parse to
+the same number.
+"""
+import time
+
+import orjson
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from .instrumentation import add_render_time
+
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z | orjson.OPT_PASSTHROUGH_DATACLASS
+
+
+class ORJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        start = time.perf_counter()
+        try:
+            return self.render_json(data, accepted_media_type, renderer_context)
+        finally:
+            add_render_time(time.perf_counter() - start)
+
+    def render_json(self, data, accepted_media_type, renderer_context):
+        if data is None:
+            return b''
+        # indented, ascii only or spaced output is left to json
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if indent is not None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            # integers over 64 bits, aware times, ... json raises or copes like it always did
+            return super().render(data, accepted_media_type, renderer_context)
+        # a strict javascript subset, like JSONRenderer
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+class ORJSONParser(JSONParser):
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        if encoding.lower().replace('_', '-') not in ('utf-8', 'utf8') or not self.strict:
+            return super().parse(stream, media_type, parser_context)
+        try:
+            # orjson refuses NaN and Infinity, as a strict JSONParser does
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
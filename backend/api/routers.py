@@ -0,0 +1,162 @@
+"""
+Reads of safe-method requests go to the replicas in DATABASE_REPLICAS, everything else
+to the primary. A client that has just written is pinned to the primary for
+REPLICA_PIN_SECONDS so it reads its own writes, either by user (for the next tokens it
+sends) or by cookie. Replicas that don't answer or lag more than REPLICA_MAX_LAG seconds
+behind are left out until a later check finds them healthy again.
+"""
+import contextvars
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.utils.functional import SimpleLazyObject, empty
+
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PIN_COOKIE = 'db_pin'
+
+# lag is zero when everything received has been replayed, or on a server that isn't a replica
+LAG_QUERY = """
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+           ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END
+"""
+
+
+def pin_key(user_id):
+    return f'db-pin:{user_id}'
+
+
+class RoutingState:
+    """What the router knows about the request being served."""
+    def __init__(self, request):
+        self.request = request
+        self.pinned = None
+        self.replica = None
+
+
+_state = contextvars.ContextVar('db_routing_state', default=None)
+
+
+def start_request(request):
+    return _state.set(RoutingState(request))
+
+
+def end_request(token):
+    _state.reset(token)
+
+
+def known_user(request):
+    """The user of request if authentication has already happened, without running it."""
+    user = getattr(request, 'user', None)
+    if isinstance(user, SimpleLazyObject) and user._wrapped is empty:
+        return None
+    return user
+
+
+def is_pinned(state):
+    if state.pinned is None:
+        if state.request.COOKIES.get(PIN_COOKIE):
+            state.pinned = True
+        else:
+            user = known_user(state.request)
+            if user is None:
+                # not authenticated yet, decided again on the next query
+                return False
+            state.pinned = bool(user.is_authenticated and cache.get(pin_key(user.id)))
+    return state.pinned
+
+
+def pin_to_primary(request, response):
+    """Sends the reads of whoever made this write to the primary for a while."""
+    seconds = settings.REPLICA_PIN_SECONDS
+    user = known_user(request)
+    if user is not None and user.is_authenticated:
+        cache.set(pin_key(user.id), True, timeout=seconds)
+    response.set_cookie(PIN_COOKIE, '1', max_age=seconds, httponly=True, samesite='Lax')
+
+
+class _ReplicaHealth:
+    # alias -> (healthy, monotonic time of the last check)
+    state = {}
+    # alias -> thread checking it
+    checks = {}
+    lock = threading.Lock()
+
+
+def set_replica_health(alias, healthy):
+    _ReplicaHealth.state[alias] = (healthy, time.monotonic())
+
+
+def check_replica(alias):
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(LAG_QUERY)
+            lag = cursor.fetchone()[0]
+    except DatabaseError:
+        return False
+    finally:
+        connection.close()
+    return lag <= settings.REPLICA_MAX_LAG
+
+
+def start_check(alias):
+    def run():
+        try:
+            set_replica_health(alias, check_replica(alias))
+        finally:
+            with _ReplicaHealth.lock:
+                _ReplicaHealth.checks.pop(alias, None)
+
+    with _ReplicaHealth.lock:
+        if alias not in _ReplicaHealth.checks:
+            thread = _ReplicaHealth.checks[alias] = threading.Thread(target=run, daemon=True)
+            thread.start()
+
+
+def healthy_replicas():
+    """
+    The replicas that passed their last check. A replica is checked again after
+    REPLICA_CHECK_INTERVAL seconds, or REPLICA_RETRY_AFTER seconds once it failed. Checks
+    run in a thread of their own, a replica that doesn't answer keeps no request waiting,
+    and one that hasn't been checked yet isn't used.
+    """
+    now = time.monotonic()
+    healthy = []
+    for alias in settings.DATABASE_REPLICAS:
+        ok, checked_at = _ReplicaHealth.state.get(alias, (False, None))
+        interval = settings.REPLICA_CHECK_INTERVAL if ok else settings.REPLICA_RETRY_AFTER
+        if checked_at is None or now - checked_at >= interval:
+            start_check(alias)
+        if ok:
+            healthy.append(alias)
+    return healthy
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        # management commands and workers, writes, and clients who just wrote read the primary
+        if state is None or not settings.DATABASE_REPLICAS or state.request.method not in SAFE_METHODS:
+            return DEFAULT_DB_ALIAS
+        if is_pinned(state):
+            return DEFAULT_DB_ALIAS
+        if state.replica is None:
+            # one replica per request, so a count and its page agree
+            replicas = healthy_replicas()
+            state.replica = random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
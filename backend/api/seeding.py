@@ -0,0 +1,254 @@
+"""
+Synthetic datasets for benchmarks and load tests. Everything is drawn from one seeded
+random generator, so the same options give the same recipes, ratings and comments.
+The shapes follow what a real recipe site looks like: a few ingredients and categories
+are in most recipes, a few authors write most of them, most recipes have a handful of
+ratings and a few have thousands, and scores lean towards 4 and 5.
+"""
+import math
+import random
+import time
+from datetime import timedelta
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.utils import timezone
+
+from .importing import allocate_ids, write_rows
+from .models import Category, Comment, Ingredient, Profile, Rating, Recipe, RecipeIngredient, User
+from .trending import refresh_scores
+
+
+CATEGORIES = [
+    'Dinner', 'Lunch', 'Breakfast', 'Dessert', 'Salad', 'Soup', 'Snack', 'Side dish', 'Baking', 'Drinks',
+    'Pasta', 'Vegetarian', 'Vegan', 'Seafood', 'Grill', 'Slow cooker', 'Sauces', 'Bread', 'Street food', 'Holiday',
+]
+
+# ingredient names are a food with an optional kind, the plain foods are the most popular
+FOODS = [
+    'salt', 'onion', 'garlic', 'butter', 'olive oil', 'egg', 'flour', 'sugar', 'milk', 'black pepper',
+    'tomato', 'lemon', 'chicken', 'rice', 'potato', 'carrot', 'cheese', 'cream', 'parsley', 'beef',
+    'basil', 'ginger', 'pork', 'spinach', 'mushroom', 'bell pepper', 'honey', 'yogurt', 'bacon', 'salmon',
+    'chickpeas', 'lentils', 'cumin', 'paprika', 'cinnamon', 'vanilla', 'chocolate', 'oats', 'apple', 'banana',
+    'shrimp', 'tofu', 'coconut milk', 'soy sauce', 'vinegar', 'mustard', 'thyme', 'rosemary', 'chili', 'zucchini',
+    'eggplant', 'cabbage', 'broccoli', 'cauliflower', 'peas', 'corn', 'beans', 'noodles', 'pasta', 'bread',
+    'almonds', 'walnuts', 'raisins', 'orange', 'lime', 'avocado', 'cucumber', 'celery', 'leek', 'squash',
+]
+KINDS = [
+    'smoked', 'fresh', 'dried', 'ground', 'roasted', 'red', 'green', 'wild', 'sweet', 'spicy',
+    'white', 'brown', 'baby', 'toasted', 'pickled', 'crushed', 'grated', 'frozen', 'organic', 'aged',
+]
+DISHES = [
+    'stew', 'curry', 'salad', 'soup', 'bake', 'pie', 'stir-fry', 'risotto', 'tacos', 'skillet',
+    'casserole', 'bowl', 'pasta', 'cake', 'muffins', 'pancakes', 'gratin', 'sandwich', 'roast', 'traybake',
+]
+UNITS = RecipeIngredient.Unit.values
+SCORES = Rating.Score.values
+QUANTITIES = (1, 2, 3, 4, 50, 100, 200, 250, 500)
+STYLES = ['Easy', 'Quick', 'Classic', 'Creamy', 'Crispy', 'Spicy', "Grandma's", 'Weeknight', 'Rustic', 'Summer']
+COMMENTS = [
+    'Made this tonight, the whole family loved it.', 'Too salty for my taste.', 'Added extra garlic, perfect.',
+    'Took longer than the recipe says.', 'My new favourite!', 'Would make again with less sugar.',
+    'Great base recipe, I doubled the sauce.', 'Not bad, a bit bland.', 'Easy and delicious.',
+    'Swapped the cream for yogurt and it worked fine.',
+]
+
+
+def zipf_weights(count, exponent):
+    """Cumulative weights of a Zipf distribution over ranks 1..count, the first rank the most likely."""
+    return list(accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def ingredient_names(count):
+    names = list(FOODS)
+    names.extend(f'{kind} {food}' for kind in KINDS for food in FOODS)
+    names.extend(f'{first} {second} {food}' for i, first in enumerate(KINDS) for second in KINDS[i + 1:] for food in FOODS)
+    number = 2
+    while len(names) < count:
+        names.extend(f'{food} {number}' for food in FOODS)
+        number += 1
+    return names[:count]
+
+
+class DatasetSeeder:
+    """
+    Adds users, categories, ingredients, and recipes with their ingredients, ratings
+    and comments to the database in chunked transactions, written with COPY like
+    RecipeImporter does. Recipe aggregates are computed while generating, not
+    recounted afterwards, trending scores are recounted at the end.
+    """
+    def __init__(
+        self, recipes, users, ingredients=2000, categories=len(CATEGORIES), ratings=5.0, comments=1.0,
+        seed=0, password='password', chunk_size=5000, days=3 * 365, progress=None,
+    ):
+        self.recipe_count = recipes
+        self.user_count = users
+        self.ingredient_count = ingredients
+        self.category_count = categories
+        self.mean_ratings = ratings
+        self.mean_comments = comments
+        self.random = random.Random(seed)
+        self.password = password
+        self.chunk_size = chunk_size
+        self.days = days
+        self.progress = progress
+        self.now = timezone.now()
+        self.counts = {'users': 0, 'recipes': 0, 'recipe_ingredients': 0, 'ratings': 0, 'comments': 0}
+        self.started = None
+
+    def run(self):
+        self.started = time.monotonic()
+        with transaction.atomic():
+            self.users = self.create_users()
+            self.categories = self.create_named(Category, CATEGORIES[:self.category_count] + [
+                f'Category {number}' for number in range(len(CATEGORIES) + 1, self.category_count + 1)
+            ])
+            names = ingredient_names(self.ingredient_count)
+            self.ingredients = self.create_named(Ingredient, names)
+            self.ingredient_name = dict(zip(self.ingredients, names))
+            self.ingredient_rank = {ingredient: rank for rank, ingredient in enumerate(self.ingredients)}
+
+        # authors, ingredients and categories by popularity
+        self.author_weights = zipf_weights(len(self.users), 1.0)
+        self.ingredient_weights = zipf_weights(len(self.ingredients), 1.1)
+        self.category_weights = zipf_weights(len(self.categories), 0.8)
+
+        remaining = self.recipe_count
+        while remaining > 0:
+            size = min(self.chunk_size, remaining)
+            self.create_recipes(size)
+            remaining -= size
+            if self.progress:
+                self.progress(self.stats())
+        refresh_scores()
+        return self.stats()
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            **self.counts,
+            'seconds': round(elapsed, 3),
+            'recipes_per_second': round(self.counts['recipes'] / elapsed, 1) if elapsed else 0,
+        }
+
+    def create_users(self):
+        # one hash for everyone, hashing is slower than writing the rows
+        password = make_password(self.password)
+        ids = allocate_ids(User, self.user_count)
+        write_rows(User, [
+            {
+                'id': pk, 'username': f'seed{pk}', 'email': f'seed{pk}@example.com', 'password': password,
+                'is_active': True, 'date_joined': self.now - timedelta(days=self.days),
+            }
+            for pk in ids
+        ])
+        write_rows(Profile, [{'user_id': pk} for pk in ids])
+        self.counts['users'] += len(ids)
+        return ids
+
+    def create_named(self, model, names):
+        """The ids of the rows with these names, created where missing, in the order of names."""
+        known = dict(model.objects.filter(name__in=names).values_list('name', 'id'))
+        created = model.objects.bulk_create([model(name=name) for name in names if name not in known])
+        known.update((obj.name, obj.pk) for obj in created)
+        return [known[name] for name in names]
+
+    def count(self, mean, sigma=1.0):
+        """A count with the given mean and a long tail, most draws are well under it."""
+        if mean <= 0:
+            return 0
+        return int(self.random.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma))
+
+    def when(self, after, bias=1.0):
+        """A time between after and now, bias over 1 leans towards now."""
+        span = (self.now - after).total_seconds()
+        return after + timedelta(seconds=span * self.random.random() ** (1 / bias))
+
+    def create_recipes(self, size):
+        rng = self.random
+        with transaction.atomic():
+            ids = allocate_ids(Recipe, size)
+            recipes, recipe_ingredients, ratings, comments = [], [], [], []
+            for recipe_id in ids:
+                chosen = []
+                wanted = min(len(self.ingredients), max(2, min(20, round(rng.gauss(8, 3)))))
+                while len(chosen) < wanted:
+                    ingredient = rng.choices(self.ingredients, cum_weights=self.ingredient_weights)[0]
+                    if ingredient not in chosen:
+                        chosen.append(ingredient)
+                recipe_ingredients.extend(
+                    {
+                        'recipe_id': recipe_id, 'ingredient_id': ingredient,
+                        'quantity': rng.choice(QUANTITIES), 'unit': rng.choice(UNITS), 'note': '',
+                    }
+                    for ingredient in chosen
+                )
+
+                created_at = self.when(self.now - timedelta(days=self.days))
+                recipe = self.recipe_row(recipe_id, chosen, created_at)
+
+                # a recipe has a quality of its own, its ratings scatter around it
+                quality = rng.gauss(3.9, 0.6)
+                raters = rng.sample(self.users, min(len(self.users), self.count(self.mean_ratings, 1.2)))
+                for author_id in raters:
+                    score = min(5, max(1, round(rng.gauss(quality, 0.9))))
+                    rated_at = self.when(created_at, bias=2.0)
+                    ratings.append({
+                        'recipe_id': recipe_id, 'author_id': author_id, 'score': score,
+                        'created_at': rated_at, 'updated_at': rated_at,
+                    })
+                    recipe['rating_count'] += 1
+                    recipe['rating_sum'] += score
+                    recipe[f'rating_{score}_count'] += 1
+                if recipe['rating_count']:
+                    recipe['avg_rating'] = recipe['rating_sum'] / recipe['rating_count']
+
+                for _ in range(self.count(self.mean_comments)):
+                    comments.append({
+                        'recipe_id': recipe_id, 'author_id': rng.choice(self.users),
+                        'text': rng.choice(COMMENTS), 'created_at': self.when(created_at, bias=2.0),
+                    })
+                recipes.append(recipe)
+
+            write_rows(Recipe, recipes)
+            write_rows(RecipeIngredient, recipe_ingredients)
+            write_rows(Rating, ratings)
+            write_rows(Comment, comments)
+            Recipe.objects.filter(pk__in=ids).refresh_search_vector()
+
+        self.counts['recipes'] += len(recipes)
+        self.counts['recipe_ingredients'] += len(recipe_ingredients)
+        self.counts['ratings'] += len(ratings)
+        self.counts['comments'] += len(comments)
+
+    def recipe_row(self, recipe_id, ingredients, created_at):
+        rng = self.random
+        # named after its least common ingredient, nobody calls a dish after the salt
+        main = max(ingredients, key=self.ingredient_rank.get)
+        others = ', '.join(self.ingredient_name[ingredient] for ingredient in ingredients[:4] if ingredient != main)
+        main = self.ingredient_name[main]
+        dish = rng.choice(DISHES)
+        prep_time = rng.choice((5, 10, 15, 20, 30, 45))
+        cook_time = rng.choice((0, 10, 20, 30, 45, 60, 90, 120, 240))
+        row = {
+            'id': recipe_id,
+            'name': f'{rng.choice(STYLES)} {main} {dish}',
+            'description': f'A {dish} of {main} with {others}. Serve warm.',
+            'author_id': rng.choices(self.users, cum_weights=self.author_weights)[0],
+            'category_id': rng.choices(self.categories, cum_weights=self.category_weights)[0],
+            'created_at': created_at.date(),
+            'updated_at': created_at,
+            'prep_time': prep_time,
+            'prep_time_unit': Recipe.TimeUnits.MINUTES,
+            'cook_time': cook_time // 60 if cook_time >= 120 else cook_time,
+            'cook_time_units': Recipe.TimeUnits.HOURS if cook_time >= 120 else Recipe.TimeUnits.MINUTES,
+            'servings': rng.choice((1, 2, 2, 4, 4, 4, 6, 8, 12)),
+            'ingredient_count': len(ingredients),
+            'rating_count': 0,
+            'rating_sum': 0,
+            'avg_rating': 0.0,
+        }
+        row.update((f'rating_{score}_count', 0) for score in SCORES)
+        return row
+
@@ -1,9 +1,101 @@
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
 from django.utils import timezone
 from rest_framework import serializers
+from rest_framework.exceptions import NotFound
 from rest_framework.generics import get_object_or_404
 from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer as BaseTokenObtainPairSerializer
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer as BaseTokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from .authentication import cache_auth_state, get_auth_state, privileges_match
+from .instrumentation import TimedSerializerMixin
 from .models import User, Profile, Category, Recipe, Ingredient, RecipeIngredient, Comment, Rating
 from django.contrib.auth.password_validation import validate_password
+from .services import rate_recipe
+from .sparse import SparseFieldsMixin
+from .tokens import RefreshToken
+
+
+class ImageVariantsField(serializers.Field):
+    """
+    Absolute urls of the resized variants of an image field, per size and format, plus a
+    srcset per format. None until the image worker has rendered the current file.
+    """
+    def __init__(self, image_field, **kwargs):
+        self.image_field = image_field
+        super().__init__(source='*', read_only=True, **kwargs)
+
+    def to_representation(self, obj):
+        image = getattr(obj, self.image_field)
+        variants = getattr(obj, f'{self.image_field}_variants')
+        if not image or variants.get('source') != image.name:
+            return None
+
+        request = self.context.get('request')
+        def url(path):
+            url = default_storage.url(path)
+            return request.build_absolute_uri(url) if request else url
+
+        representation = {
+            name: {image_format: url(path) for image_format, path in variant['files'].items()}
+            for name, variant in variants['variants'].items()
+        }
+        representation['srcset'] = {
+            image_format: ', '.join(
+                f"{representation[name][image_format]} {variant['width']}w"
+                for name, variant in sorted(variants['variants'].items(), key=lambda item: item[1]['width'])
+            )
+            for image_format in settings.IMAGE_VARIANT_FORMATS
+        }
+        return representation
+
+
+class TokenObtainPairSerializer(BaseTokenObtainPairSerializer):
+    token_class = RefreshToken
+
+    @classmethod
+    def get_token(cls, user):
+        # the user was just loaded to check the password, warm the cache its tokens are checked against
+        cache_auth_state(user)
+        return super().get_token(user)
+
+
+class TokenRefreshSerializer(BaseTokenRefreshSerializer):
+    """
+    Refresh without a users table or blacklist query in the common case, the user's
+    state comes from the same cache as api.authentication and the blacklist check from
+    api.blacklist.
+    """
+    token_class = RefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+
+        user_id = refresh.payload.get(api_settings.USER_ID_CLAIM)
+        if user_id:
+            state = get_auth_state(user_id)
+            # access tokens copy the refresh token's claims, a demoted user has to log in again
+            if (
+                not state or not state[0] or refresh.get(api_settings.REVOKE_TOKEN_CLAIM) != state[1]
+                or not privileges_match(refresh, state)
+            ):
+                raise AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+
+        data = {'access': str(refresh.access_token)}
+
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                refresh.blacklist()
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            refresh.outstand()
+            data['refresh'] = str(refresh)
+
+        return data
 
 
 class RegisterSerializer(serializers.ModelSerializer):
@@ -35,32 +127,33 @@ class RegisterSerializer(serializers.ModelSerializer):
         return user
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'username', 'email']
 
 
-class ProfileSerializer(serializers.ModelSerializer):
+class ProfileSerializer(TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
+    profile_picture_variants = ImageVariantsField('profile_picture')
     class Meta:
         model = Profile
-        fields = ['id', 'user', 'bio', 'website', 'profile_picture']
+        fields = ['id', 'user', 'bio', 'website', 'profile_picture', 'profile_picture_variants']
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = ['id', 'name']
 
 
-class IngredientSerializer(serializers.ModelSerializer):
+class IngredientSerializer(TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Ingredient
         fields = ['id', 'name', 'description']
 
 
-class RecipeIngredientSerializer(serializers.ModelSerializer):
+class RecipeIngredientSerializer(TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     ingredient = IngredientSerializer()
     class Meta:
         model = RecipeIngredient
@@ -68,24 +161,37 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
 
 
 class RecipeIngredientWriteSerializer(serializers.ModelSerializer):
-    ingredient_id = serializers.PrimaryKeyRelatedField(queryset=Ingredient.objects.all())
+    # resolved for the whole list at once in RecipeWriteSerializer.validate
+    ingredient_id = serializers.IntegerField()
     class Meta:
         model = RecipeIngredient
         fields = ['ingredient_id', 'quantity', 'unit', 'note']
 
 
-class RecipeSerializer(serializers.ModelSerializer):
+class RecipeSerializer(TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     category = PrimaryKeyRelatedField(queryset=Category.objects.all())
     ingredients = RecipeIngredientSerializer(many=True, read_only=True, source='recipeingredient_set')
+    rating_histogram = serializers.ReadOnlyField()
+    image_variants = ImageVariantsField('image')
+    # only present on search results
+    rank = serializers.FloatField(read_only=True)
+    headline = serializers.CharField(read_only=True)
+    # only present on pantry matches
+    matched_count = serializers.IntegerField(read_only=True)
+    missing_count = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Recipe
         fields = [
-            'id', 'image', 'category', 'name', 'description', 'author',
+            'id', 'image', 'image_variants', 'category', 'name', 'description', 'author',
             'created_at', 'updated_at', 'prep_time', 'prep_time_unit',
-            'cook_time', 'cook_time_units', 'servings', 'ingredients'
+            'cook_time', 'cook_time_units', 'servings', 'ingredients',
+            'rating_count', 'avg_rating', 'rating_histogram', 'rank', 'headline',
+            'matched_count', 'missing_count'
         ]
+        read_only_fields = ['rating_count', 'avg_rating']
+        expandable_fields = {'category': (CategorySerializer, {})}
 
 
 class RecipeWriteSerializer(serializers.ModelSerializer):
@@ -99,29 +205,99 @@ class RecipeWriteSerializer(serializers.ModelSerializer):
                   'created_at', 'updated_at', 'prep_time', 'prep_time_unit',
                   'cook_time', 'cook_time_units', 'servings', 'ingredients']
 
+    @transaction.atomic
     def create(self, validated_data):
         ingredients_data = validated_data.pop('ingredients')
         recipe = Recipe.objects.create(**validated_data)
 
-        for item in ingredients_data:
-            ingredient = Ingredient.objects.get(id=item['ingredient_id'])
-            RecipeIngredient.objects.create(
+        RecipeIngredient.objects.bulk_create([
+            RecipeIngredient(
                 recipe=recipe,
-                ingredient=ingredient,
+                ingredient_id=item['ingredient_id'],
                 quantity=item['quantity'],
                 unit=item['unit'],
                 note=item.get('note', '')
             )
+            for item in ingredients_data
+        ])
+        # bulk_create skips the post_save receivers that keep these in sync
+        recipes = Recipe.objects.filter(pk=recipe.pk)
+        recipes.refresh_ingredient_count()
+        recipes.refresh_search_vector()
 
         return recipe
 
+    @transaction.atomic
+    def update(self, instance, validated_data):
+        ingredients_data = validated_data.pop('ingredients', None)
+        if ingredients_data is not None:
+            self.update_ingredients(instance, ingredients_data)
+        # saving the recipe bumps its version and refreshes the search vector
+        return super().update(instance, validated_data)
+
+    def update_ingredients(self, recipe, ingredients_data):
+        """
+        Applies the smallest diff between the stored and the submitted ingredient lists:
+        one delete, one bulk_update of the changed rows and one bulk_create of new ones.
+        Rows are matched on ingredient, which keeps (recipe, ingredient) unique.
+        """
+        existing = {item.ingredient_id: item for item in recipe.recipeingredient_set.all()}
+        submitted = {item['ingredient_id']: item for item in ingredients_data}
+
+        removed = [existing[pk].pk for pk in existing.keys() - submitted.keys()]
+        if removed:
+            RecipeIngredient.objects.filter(pk__in=removed).delete()
+
+        changed = []
+        for pk in existing.keys() & submitted.keys():
+            row, item = existing[pk], submitted[pk]
+            values = (item['quantity'], item['unit'], item.get('note', ''))
+            if (row.quantity, row.unit, row.note or '') != values:
+                row.quantity, row.unit, row.note = values
+                changed.append(row)
+        if changed:
+            RecipeIngredient.objects.bulk_update(changed, ['quantity', 'unit', 'note'])
+
+        added = [
+            RecipeIngredient(
+                recipe=recipe,
+                ingredient_id=pk,
+                quantity=submitted[pk]['quantity'],
+                unit=submitted[pk]['unit'],
+                note=submitted[pk].get('note', '')
+            )
+            for pk in submitted.keys() - existing.keys()
+        ]
+        if added:
+            RecipeIngredient.objects.bulk_create(added)
+
+        if removed or added:
+            Recipe.objects.filter(pk=recipe.pk).refresh_ingredient_count()
+
     def validate(self, attrs):
+        # partial updates may leave the ingredient list alone
+        if 'ingredients' not in attrs:
+            return attrs
+
         if len(attrs['ingredients']) < 2:
             raise serializers.ValidationError('You must provide at least 2 ingredients')
+
+        ingredient_ids = [item['ingredient_id'] for item in attrs['ingredients']]
+        if len(set(ingredient_ids)) != len(ingredient_ids):
+            raise serializers.ValidationError({'ingredients': 'Each ingredient can only be listed once.'})
+
+        unknown = sorted(set(ingredient_ids) - Ingredient.objects.in_bulk(ingredient_ids).keys())
+        if unknown:
+            raise serializers.ValidationError(
+                {'ingredients': f"Unknown ingredient ids: {', '.join(map(str, unknown))}."}
+            )
         return attrs
 
+    def to_representation(self, instance):
+        return RecipeSerializer(instance, context=self.context).data
 
-class CommentSerializer(serializers.ModelSerializer):
+
+class CommentSerializer(TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     recipe = serializers.PrimaryKeyRelatedField(read_only=True)
     class Meta:
@@ -129,7 +305,7 @@ class CommentSerializer(serializers.ModelSerializer):
         fields = ['id', 'recipe', 'author', 'text', 'created_at']
 
 
-class RatingSerializer(serializers.ModelSerializer):
+class RatingSerializer(TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     recipe = serializers.PrimaryKeyRelatedField(read_only=True)
     class Meta:
@@ -144,38 +320,24 @@ class RatingWriteSerializer(serializers.ModelSerializer):
 
     def validate(self, attrs):
         user = self.context['request'].user
-        request = self.context['request']
 
         if not user.is_authenticated:
             raise serializers.ValidationError('User is not authenticated')
-
-
-        # recipe id from url
-        recipe_id = self.context['view'].kwargs.get('pk')
-        recipe = get_object_or_404(Recipe, id=recipe_id)
-
-
-        if request.method == 'POST':
-            if Rating.objects.filter(recipe=recipe).filter(author=user).exists():
-                raise serializers.ValidationError('Rating already exists')
-
-        if request.method in ['PUT', 'PATCH']:
-            if Rating.objects.filter(recipe=recipe).filter(author=user).exists():
-                raise serializers.ValidationError('Rating does not exist')
-
-
-        attrs['recipe'] = recipe
         return attrs
 
-
     def create(self, validated_data):
-        return Rating.objects.create(**validated_data)
-
+        # rating a recipe again replaces the score, see ListCreateRatingView.create
+        try:
+            rating, self.created = rate_recipe(
+                validated_data['recipe_id'], validated_data['author_id'], validated_data['score']
+            )
+        except Recipe.DoesNotExist:
+            raise NotFound(f'No {Recipe._meta.object_name} matches the given query.')
+        return rating
 
     def update(self, instance, validated_data):
-        instance.score = validated_data.get('score', instance.score)
-        instance.save()
-        return instance
+        rating, _ = rate_recipe(instance.recipe_id, instance.author_id, validated_data.get('score', instance.score))
+        return rating
 
 
 class SendActivationEmailSerializer(serializers.Serializer):
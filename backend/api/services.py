@@ -1,9 +1,17 @@
-from django.core.mail import EmailMultiAlternatives, send_mail
+from datetime import timedelta
+
+from django.core.mail import EmailMessage, EmailMultiAlternatives, get_connection, send_mail
+from django.db import connection, transaction
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast, Coalesce, Now, NullIf
 from django.utils.http import urlsafe_base64_encode
 from django.utils.translation import gettext_lazy as _
 from django.utils.encoding import force_bytes
 from django.conf import settings
+from django.utils import timezone
+from .models import OutboxEmail, Rating, Recipe
 from .tokens import account_activation_token
+from .trending import activity, rating_weight
 
 
 def send_activation_email(user):
@@ -14,5 +22,127 @@ def send_activation_email(user):
     mail_subject = _("Activate your account")
     mail_body = _(f"Hello! Please activate your account by clicking the link: {activation_link}")
 
-    send_mail(mail_subject, mail_body, settings.DEFAULT_FROM_EMAIL, [user.email], fail_silently=False)
+    queue_email(mail_subject, mail_body, [user.email])
+
+
+def queue_email(subject, body, to):
+    """
+    Writes the email to the outbox as part of the current transaction, send_outbox delivers it.
+    A rolled back transaction takes the email with it, a slow mail server delays nothing.
+    """
+    return OutboxEmail.objects.create(
+        subject=str(subject), body=str(body), from_email=settings.DEFAULT_FROM_EMAIL, to=list(to)
+    )
+
+
+def deliver_outbox(batch_size=100):
+    """
+    Sends one batch of due outbox emails over a single mail server connection. Rows are
+    claimed with SKIP LOCKED, so several workers can drain the outbox side by side.
+    Failures are retried with exponential backoff until OUTBOX_MAX_ATTEMPTS.
+    """
+    now = timezone.now()
+    sent = failed = 0
+    with transaction.atomic():
+        batch = list(
+            OutboxEmail.objects.select_for_update(skip_locked=True)
+            .filter(status=OutboxEmail.Status.PENDING, next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        if not batch:
+            return {'sent': 0, 'failed': 0}
+
+        mail_connection = get_connection(fail_silently=False)
+        try:
+            mail_connection.open()
+            mail_error = None
+        except Exception as exc:
+            # counts as a failed attempt for the whole batch
+            mail_error = exc
+
+        try:
+            for email in batch:
+                email.attempts += 1
+                try:
+                    if mail_error is not None:
+                        raise mail_error
+                    EmailMessage(email.subject, email.body, email.from_email, email.to, connection=mail_connection).send()
+                except Exception as exc:
+                    failed += 1
+                    email.last_error = repr(exc)
+                    if email.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                        email.status = OutboxEmail.Status.FAILED
+                    else:
+                        delay = settings.OUTBOX_RETRY_DELAY * 2 ** (email.attempts - 1)
+                        email.next_attempt_at = now + timedelta(seconds=delay)
+                else:
+                    sent += 1
+                    email.status = OutboxEmail.Status.SENT
+                    email.sent_at = timezone.now()
+        finally:
+            mail_connection.close()
+
+        OutboxEmail.objects.bulk_update(
+            batch, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at']
+        )
+    return {'sent': sent, 'failed': failed}
+
+
+def outbox_depth():
+    return OutboxEmail.objects.filter(status=OutboxEmail.Status.PENDING).count()
+
+
+def apply_rating_change(recipe_id, old_score=None, new_score=None):
+    """
+    Applies a single rating write to the recipe aggregates in one UPDATE.
+    old_score is None for a new rating, new_score is None for a deleted one.
+    """
+    if old_score == new_score:
+        return
+
+    count_delta = (new_score is not None) - (old_score is not None)
+    sum_delta = (new_score or 0) - (old_score or 0)
+
+    changes = {
+        'version': F('version') + 1,
+        'updated_at': Now(),
+        'rating_count': F('rating_count') + count_delta,
+        'rating_sum': F('rating_sum') + sum_delta,
+        # right-hand sides see the pre-update row, so the average matches the new sum and count
+        'avg_rating': Coalesce(
+            Cast(F('rating_sum') + sum_delta, FloatField()) / NullIf(F('rating_count') + count_delta, 0),
+            0.0,
+            output_field=FloatField()
+        ),
+    }
+    if old_score is not None:
+        changes[f'rating_{old_score}_count'] = F(f'rating_{old_score}_count') - 1
+    if new_score is not None:
+        changes[f'rating_{new_score}_count'] = F(f'rating_{new_score}_count') + 1
+
+    Recipe.objects.filter(pk=recipe_id).update(**changes)
+
+
+def rate_recipe(recipe_id, author_id, score):
+    """
+    Creates or replaces the author's rating of the recipe and updates the recipe
+    aggregates and trending score, in one round trip to the api_rate_recipe function
+    of migration 0010.
+    Returns the rating and whether it is new, raises Recipe.DoesNotExist for an
+    unknown recipe.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT * FROM api_rate_recipe(%s, %s, %s, %s)', [recipe_id, author_id, score, activity(rating_weight(score))]
+        )
+        row = cursor.fetchone()
+    if row is None:
+        raise Recipe.DoesNotExist
+    rating_id, created_at, updated_at, old_score = row
 
+    rating = Rating.from_db(
+        connection.alias,
+        ['id', 'recipe_id', 'author_id', 'score', 'created_at', 'updated_at'],
+        [rating_id, int(recipe_id), author_id, score, created_at, updated_at],
+    )
+    return rating, old_score is None
@@ -0,0 +1,104 @@
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from .authentication import auth_state_key, cache_auth_state
+from .blacklist import remember_revoked
+from .images import queue_image
+from .models import Category, ImageJob, Ingredient, Profile, Recipe, RecipeIngredient, User
+
+
+@receiver(post_save, sender=Recipe)
+def refresh_recipe_search_vector(sender, instance, created, **kwargs):
+    recipes = Recipe.objects.filter(pk=instance.pk)
+    if not created:
+        recipes.touch()
+    recipes.refresh_search_vector()
+
+
+# bulk writes and deletes of recipe ingredients refresh the recipe themselves, a post_delete
+# receiver would turn every recipe cascade into one query per row. Whatever deletes them,
+# ingredient_count is lowered by a database trigger, see migration 0012.
+@receiver(post_save, sender=RecipeIngredient)
+def refresh_recipe_ingredient_data(sender, instance, created, **kwargs):
+    recipes = Recipe.objects.filter(pk=instance.recipe_id)
+    if created:
+        recipes.refresh_ingredient_count()
+    recipes.touch()
+    recipes.refresh_search_vector()
+
+
+@receiver(post_save, sender=Category)
+def refresh_category_search_vector(sender, instance, created, **kwargs):
+    if not created:
+        recipes = Recipe.objects.filter(category=instance)
+        recipes.touch()
+        recipes.refresh_search_vector()
+
+
+@receiver(post_save, sender=Ingredient)
+def refresh_ingredient_search_vector(sender, instance, created, **kwargs):
+    if not created:
+        recipes = Recipe.objects.filter(recipeingredient__ingredient=instance)
+        recipes.touch()
+        recipes.refresh_search_vector()
+
+
+# by post_delete the recipes no longer point at the deleted row, the category is set to
+# null and recipe ingredients are gone with a bulk query, so they're looked up beforehand
+@receiver(pre_delete, sender=Category)
+def find_category_recipes(sender, instance, **kwargs):
+    instance._recipe_ids = list(Recipe.objects.filter(category=instance).values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Ingredient)
+def find_ingredient_recipes(sender, instance, **kwargs):
+    instance._recipe_ids = list(
+        Recipe.objects.filter(recipeingredient__ingredient=instance).values_list('pk', flat=True)
+    )
+
+
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Ingredient)
+def refresh_deleted_relation_recipes(sender, instance, **kwargs):
+    recipe_ids = getattr(instance, '_recipe_ids', None)
+    if recipe_ids:
+        recipes = Recipe.objects.filter(pk__in=recipe_ids)
+        recipes.touch()
+        recipes.refresh_search_vector()
+
+
+@receiver(post_save, sender=User)
+def touch_author_recipes(sender, instance, created, update_fields, **kwargs):
+    # recipes embed the author, but most user saves (last_login, activation) don't touch it
+    if created or (update_fields is not None and not {'username', 'email'} & set(update_fields)):
+        return
+    Recipe.objects.filter(author=instance).touch()
+
+
+@receiver(post_save, sender=User)
+def refresh_auth_state(sender, instance, **kwargs):
+    cache_auth_state(instance)
+
+
+@receiver(post_delete, sender=User)
+def forget_auth_state(sender, instance, **kwargs):
+    cache.delete(auth_state_key(instance.pk))
+
+
+# entries are only ever removed once expired, so there is no post_delete counterpart
+@receiver(post_save, sender=BlacklistedToken)
+def publish_blacklisted_token(sender, instance, created, **kwargs):
+    if created:
+        remember_revoked(instance.token)
+
+
+@receiver(post_save, sender=Recipe)
+def queue_recipe_image(sender, instance, **kwargs):
+    queue_image(ImageJob.Kind.RECIPE, instance, 'image')
+
+
+@receiver(post_save, sender=Profile)
+def queue_profile_picture(sender, instance, **kwargs):
+    queue_image(ImageJob.Kind.PROFILE, instance, 'profile_picture')
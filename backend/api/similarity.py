@@ -0,0 +1,231 @@
+"""
+Similar recipes: the recipes sharing the most ingredients with a recipe, rarer ingredients
+counting more. Every recipe is a row of TF-IDF weights over the ingredients, normalized so
+the product of two rows is their cosine similarity, which a shared category multiplies by
+1 + SIMILAR_CATEGORY_BOOST. Comparing a recipe with every other one is far too slow for a
+request, so manage.py refresh_similar stores the SIMILAR_RECIPES best neighbours of every
+recipe in RecipeNeighbours, multiplying the matrix by its transpose a chunk of rows at a
+time across a pool of processes.
+
+A refresh only recomputes the recipes whose category or ingredients changed, found by the
+signature stored with their neighbours, and the recipes those changes move in or out of a
+neighbour list. The ingredient weights drift as recipes come and go, and the settings can
+change, a full refresh now and then recomputes everything.
+
+NumPy and SciPy are only needed to build the neighbours, serving them needs neither.
+"""
+import hashlib
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+
+from .importing import write_rows
+from .models import Recipe, RecipeIngredient, RecipeNeighbours
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+
+# every recipe with its category and ingredients, 0 and -1 for none, in one snapshot
+MATRIX_SQL = f"""
+    SELECT recipe.id, coalesce(recipe.category_id, 0), coalesce(recipe_ingredient.ingredient_id, -1)
+    FROM {Recipe._meta.db_table} AS recipe
+    LEFT JOIN {RecipeIngredient._meta.db_table} AS recipe_ingredient ON recipe_ingredient.recipe_id = recipe.id
+    ORDER BY recipe.id, recipe_ingredient.ingredient_id
+"""
+
+
+class RecipeMatrix:
+    """The TF-IDF rows of every recipe, row i is the recipe ids[i]."""
+    def __init__(self, ids, categories, signatures, matrix):
+        self.ids = ids
+        self.categories = categories
+        self.signatures = signatures
+        self.matrix = matrix
+
+    @classmethod
+    def load(cls, max_document_frequency=None):
+        if max_document_frequency is None:
+            max_document_frequency = settings.SIMILAR_MAX_DOCUMENT_FREQUENCY
+        with connection.cursor() as cursor:
+            cursor.execute(MATRIX_SQL)
+            rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 3)
+
+        ids, starts = np.unique(rows[:, 0], return_index=True)
+        categories = rows[starts, 1]
+        ends = np.append(starts[1:], len(rows))
+        signatures = np.array([signature(rows[start:end, 1:]) for start, end in zip(starts, ends)], dtype=np.int64)
+
+        listed = rows[rows[:, 2] >= 0]
+        positions = np.searchsorted(ids, listed[:, 0])
+        ingredients, columns = np.unique(listed[:, 2], return_inverse=True)
+        count = len(ids)
+        frequency = np.bincount(columns, minlength=len(ingredients))
+        weights = np.log((1 + count) / (1 + frequency))
+        # salt and onions say little about a recipe and would make every product dense
+        weights[frequency > max_document_frequency * count] = 0
+        matrix = sparse.csr_matrix(
+            (weights[columns].astype(np.float32), (positions, columns)), shape=(count, len(ingredients)),
+        )
+        matrix.eliminate_zeros()
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        matrix = sparse.diags((1 / norms).astype(np.float32)) @ matrix
+        return cls(ids, categories, signatures, matrix.tocsr())
+
+
+def signature(rows):
+    """A 64 bit hash of the (category, ingredient) rows of one recipe, sorted by ingredient."""
+    digest = hashlib.blake2b(np.ascontiguousarray(rows).tobytes(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+# set in every worker process by start_worker, forked processes share it copy-on-write
+_worker = {}
+
+
+def start_worker(matrix, categories, count, boost):
+    _worker.update(matrix=matrix, transposed=matrix.T.tocsr(), categories=categories, count=count, boost=boost)
+
+
+def products(rows):
+    """Similarities of the rows with every recipe, boosted, with a recipe's own similarity zeroed."""
+    categories = _worker['categories']
+    product = (_worker['matrix'][rows] @ _worker['transposed']).tocsr()
+    owners = rows[np.repeat(np.arange(len(rows)), np.diff(product.indptr))]
+    product.data[product.indices == owners] = 0
+    if _worker['boost']:
+        shared = (categories[product.indices] == categories[owners]) & (categories[owners] != 0)
+        product.data[shared] *= 1 + _worker['boost']
+    return product
+
+
+def best_neighbours(rows):
+    """For every row, the positions and scores of its best neighbours, best first."""
+    product = products(rows)
+    count = _worker['count']
+    neighbours = []
+    for start, end in zip(product.indptr[:-1], product.indptr[1:]):
+        columns, scores = product.indices[start:end], product.data[start:end]
+        # a popular ingredient list shares something with a good part of all recipes,
+        # partitioning is linear where sorting them all is not
+        if len(scores) > count:
+            best = np.argpartition(scores, -count)[-count:]
+            columns, scores = columns[best], scores[best]
+        keep = scores > 0
+        columns, scores = columns[keep], scores[keep]
+        # ties broken by position so reruns agree
+        order = np.lexsort((columns, -scores))
+        neighbours.append((columns[order], scores[order]))
+    return neighbours
+
+
+def reach(rows):
+    """The best similarity of every recipe with any of the rows."""
+    return products(rows).max(axis=0).toarray().ravel()
+
+
+class NeighbourBuilder:
+    """
+    Recomputes RecipeNeighbours, all of them with full=True, otherwise those of changed
+    recipes and of recipes whose neighbours a change affects. Rows are handed to workers
+    in chunks of chunk_size and written back a chunk per transaction with COPY.
+    """
+    def __init__(self, full=False, workers=1, chunk_size=1000, progress=None):
+        self.full = full
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.count = settings.SIMILAR_RECIPES
+        self.boost = settings.SIMILAR_CATEGORY_BOOST
+        self.counts = {'recipes': 0, 'changed': 0, 'rebuilt': 0}
+        self.started = None
+
+    def run(self):
+        self.started = time.monotonic()
+        recipes = RecipeMatrix.load()
+        self.counts['recipes'] = len(recipes.ids)
+        stored = {} if self.full else {
+            recipe_id: (stored_signature, recipe_ids, scores)
+            for recipe_id, stored_signature, recipe_ids, scores in RecipeNeighbours.objects.values_list(
+                'recipe_id', 'signature', 'recipe_ids', 'scores',
+            ).iterator(chunk_size=self.chunk_size)
+        }
+        changed = np.array([
+            position for position, (recipe_id, current) in enumerate(zip(recipes.ids.tolist(), recipes.signatures.tolist()))
+            if stored.get(recipe_id, (None,))[0] != current
+        ], dtype=np.int64)
+        self.counts['changed'] = len(changed)
+
+        # forked workers must not share the parent's database connections
+        if self.workers > 1:
+            connections.close_all()
+            pool = multiprocessing.get_context('fork').Pool(
+                self.workers, initializer=start_worker,
+                initargs=(recipes.matrix, recipes.categories, self.count, self.boost),
+            )
+        else:
+            start_worker(recipes.matrix, recipes.categories, self.count, self.boost)
+            pool = None
+        try:
+            rebuilt = self.affected(recipes, stored, changed, pool)
+            self.counts['rebuilt'] = len(rebuilt)
+            chunks = [rebuilt[start:start + self.chunk_size] for start in range(0, len(rebuilt), self.chunk_size)]
+            results = pool.imap(best_neighbours, chunks) if pool else map(best_neighbours, chunks)
+            for chunk, neighbours in zip(chunks, results):
+                self.write(recipes, chunk, neighbours)
+                if self.progress:
+                    self.progress(self.stats())
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return self.stats()
+
+    def affected(self, recipes, stored, changed, pool):
+        """The positions of the recipes to recompute."""
+        if not stored or len(changed) == len(recipes.ids):
+            return np.arange(len(recipes.ids))
+        rebuilt = np.zeros(len(recipes.ids), dtype=bool)
+        rebuilt[changed] = True
+
+        # recipes listing a changed or deleted recipe
+        changed_ids = set(recipes.ids[changed].tolist())
+        current = set(recipes.ids.tolist())
+        thresholds = np.zeros(len(recipes.ids), dtype=np.float32)
+        for position, recipe_id in enumerate(recipes.ids.tolist()):
+            _, recipe_ids, scores = stored.get(recipe_id, (None, (), ()))
+            if any(pk in changed_ids or pk not in current for pk in recipe_ids):
+                rebuilt[position] = True
+            elif len(scores) >= self.count:
+                thresholds[position] = scores[-1]
+
+        # and recipes a changed recipe now beats the last neighbour of
+        chunks = [changed[start:start + self.chunk_size] for start in range(0, len(changed), self.chunk_size)]
+        for best in (pool.imap_unordered(reach, chunks) if pool else map(reach, chunks)):
+            rebuilt |= best > thresholds
+        return np.flatnonzero(rebuilt)
+
+    def write(self, recipes, chunk, neighbours):
+        ids = recipes.ids[chunk].tolist()
+        rows = [
+            {
+                'recipe_id': recipe_id, 'recipe_ids': recipes.ids[columns].tolist(),
+                'scores': [round(score, 6) for score in scores.tolist()], 'signature': recipe_signature,
+            }
+            for recipe_id, recipe_signature, (columns, scores) in zip(ids, recipes.signatures[chunk].tolist(), neighbours)
+        ]
+        with transaction.atomic():
+            RecipeNeighbours.objects.filter(recipe_id__in=ids).delete()
+            # deleted since the matrix was loaded
+            existing = set(Recipe.objects.filter(pk__in=ids).values_list('pk', flat=True))
+            write_rows(RecipeNeighbours, [row for row in rows if row['recipe_id'] in existing])
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {**self.counts, 'seconds': round(elapsed, 3)}
@@ -0,0 +1,97 @@
+import json
+
+
+class SparseFields:
+    """
+    What a client asked for with ?fields=, ?omit= and ?expand=. Each is a comma separated
+    list of field names, dotted names reach into nested serializers, so
+    ?fields=name,ingredients.quantity&expand=category returns only the name, the
+    quantities and the category as an object.
+    """
+    params = ('fields', 'omit', 'expand')
+
+    def __init__(self, fields=None, omit=None, expand=None):
+        # trees of field name -> nested tree, an empty tree means the whole field
+        self.fields = fields
+        self.omit = omit or {}
+        self.expand = expand or {}
+
+    @classmethod
+    def from_request(cls, request):
+        if request is None:
+            return cls()
+        query_params = getattr(request, 'query_params', request.GET)
+        trees = {param: cls.parse(query_params.get(param)) for param in cls.params}
+        return cls(**trees)
+
+    @staticmethod
+    def parse(value):
+        if not value:
+            return None
+        tree = {}
+        for path in value.split(','):
+            node = tree
+            for name in path.strip().split('.'):
+                if name:
+                    node = node.setdefault(name, {})
+        return tree
+
+    def key(self):
+        """The same string for every way of writing the same request, for validators and cache keys."""
+        return json.dumps([self.fields, self.omit, self.expand], sort_keys=True, separators=(',', ':'))
+
+    def includes(self, name):
+        if self.omit.get(name) == {}:
+            return False
+        return self.fields is None or name in self.fields
+
+    def expands(self, name):
+        return self.includes(name) and name in self.expand
+
+    def nested(self, name):
+        """The part of the request that applies inside the nested field name."""
+        # naming a field without a nested list asks for all of it
+        fields = (self.fields.get(name) or None) if self.fields is not None else None
+        return SparseFields(fields, self.omit.get(name), self.expand.get(name))
+
+    def select_related(self, queryset, *names):
+        """Joins the relations out of names that will be rendered."""
+        names = [name for name in names if self.includes(name)]
+        return queryset.select_related(*names) if names else queryset
+
+
+class SparseFieldsMixin:
+    """
+    Serializer fields trimmed to a SparseFields. The outermost serializer reads it from
+    the request, nested ones get their part handed down. Fields named in
+    Meta.expandable_fields are swapped for the (serializer class, kwargs) given there
+    when expanded.
+    """
+    def __init__(self, *args, sparse=None, **kwargs):
+        self.sparse = sparse
+        super().__init__(*args, **kwargs)
+
+    def get_sparse_fields(self):
+        if self.sparse is None:
+            self.sparse = SparseFields.from_request(self.context.get('request'))
+        return self.sparse
+
+    def get_fields(self):
+        fields = super().get_fields()
+        sparse = self.get_sparse_fields()
+        expandable = getattr(self.Meta, 'expandable_fields', {})
+
+        selected = {}
+        for name, field in fields.items():
+            if not sparse.includes(name):
+                continue
+            nested = sparse.nested(name)
+            if sparse.expands(name) and name in expandable:
+                serializer_class, kwargs = expandable[name]
+                field = serializer_class(read_only=True, sparse=nested, **kwargs)
+            else:
+                child = getattr(field, 'child', field)
+                if isinstance(child, SparseFieldsMixin):
+                    child.sparse = nested
+            selected[name] = field
+        return selected
@@ -1,3 +1,2092 @@
-from django.test import TestCase
+import base64
+import datetime
+import decimal
+import json
+import zlib
+from ipaddress import ip_network
+from unittest import skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from .models import User, Profile, Category, Recipe, Ingredient, RecipeIngredient, Comment, Rating, OutboxEmail
+from . import similarity
+from .authentication import cache_auth_state
+from .caching import get_or_render
+from .services import apply_rating_change, deliver_outbox
+from .tokens import AccessToken, RefreshToken, account_activation_token
+
+
+PASSWORD = 'Str0ng!Passw0rd'
+
+
+def make_user(username, **kwargs):
+    user = User.objects.create_user(
+        username=username,
+        email=f'{username}@example.com',
+        password=PASSWORD,
+        **kwargs
+    )
+    Profile.objects.create(user=user)
+    return user
+
+
+def make_recipe(author, category, ingredients, name='Pancakes'):
+    recipe = Recipe.objects.create(
+        author=author,
+        category=category,
+        name=name,
+        description='Mix and fry.',
+        prep_time=10,
+        prep_time_unit=Recipe.TimeUnits.MINUTES,
+        cook_time=20,
+        cook_time_units=Recipe.TimeUnits.MINUTES,
+        servings=4,
+    )
+    RecipeIngredient.objects.bulk_create([
+        RecipeIngredient(recipe=recipe, ingredient=ingredient, quantity=100, unit=RecipeIngredient.Unit.GRAMS)
+        for ingredient in ingredients
+    ])
+    recipes = Recipe.objects.filter(pk=recipe.pk)
+    recipes.refresh_ingredient_count()
+    recipes.refresh_search_vector()
+    return recipe
+
+
+def recipe_payload(category, ingredients, name='Omelette'):
+    return {
+        'category': category.id, 'name': name, 'description': 'Whisk and fry.',
+        'prep_time': 5, 'prep_time_unit': 'minutes', 'cook_time': 5, 'cook_time_units': 'minutes',
+        'servings': 1,
+        'ingredients': [
+            {'ingredient_id': ingredient.id, 'quantity': 2, 'unit': RecipeIngredient.Unit.PIECES}
+            for ingredient in ingredients
+        ],
+    }
+
+
+# the tests run in one process, its LocMemCache is as good as a shared one
+@override_settings(CACHE_SHARED=True)
+class ApiTestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = make_user('author')
+        cls.other = make_user('other')
+        cls.admin = make_user('admin', is_superuser=True, is_staff=True)
+        cls.category = Category.objects.create(name='Breakfast')
+        cls.ingredients = [Ingredient.objects.create(name=f'Ingredient {i}') for i in range(5)]
+        cls.recipe = make_recipe(cls.author, cls.category, cls.ingredients)
+        cls.comment = Comment.objects.create(recipe=cls.recipe, author=cls.author, text='Tasty')
+        cls.rating = Rating.objects.create(recipe=cls.recipe, author=cls.author, score=Rating.Score.GOOD)
+        apply_rating_change(cls.recipe.id, new_score=cls.rating.score)
+
+    def setUp(self):
+        cache.clear()
+
+    def authenticate(self, user):
+        # logging in caches what the token is checked against
+        cache_auth_state(user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+
+
+class AuthenticationTests(ApiTestCase):
+    def get_with_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/recipes/cache-stats')
+        return response, [query['sql'] for query in ctx.captured_queries]
+
+    def test_request_user_comes_from_claims(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.admin)}')
+        response, queries = self.get_with_queries()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries), 1)
+        # the active flag and password hash are cached from here on
+        response, queries = self.get_with_queries()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(queries, [])
+
+    def test_login_claims(self):
+        response = self.client.post('/api/token', {'username': 'admin', 'password': PASSWORD})
+        token = AccessToken(response.data['access'])
+        self.assertEqual((token['username'], token['email'], token['is_superuser']), ('admin', 'admin@example.com', True))
+        refreshed = self.client.post('/api/token/refresh', {'refresh': response.data['refresh']})
+        self.assertEqual(AccessToken(refreshed.data['access'])['username'], 'admin')
+
+    def test_deactivation_revokes_tokens(self):
+        self.authenticate(self.admin)
+        self.assertEqual(self.get_with_queries()[0].status_code, status.HTTP_200_OK)
+        self.admin.is_active = False
+        self.admin.save(update_fields=['is_active'])
+        self.assertEqual(self.get_with_queries()[0].status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_password_change_revokes_tokens(self):
+        self.authenticate(self.admin)
+        self.admin.set_password('An0ther!Passw0rd')
+        self.admin.save()
+        self.assertEqual(self.get_with_queries()[0].status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_demotion_revokes_tokens(self):
+        self.authenticate(self.admin)
+        refresh = RefreshToken.for_user(self.admin)
+        self.assertEqual(self.get_with_queries()[0].status_code, status.HTTP_200_OK)
+        self.admin.is_staff = self.admin.is_superuser = False
+        self.admin.save(update_fields=['is_staff', 'is_superuser'])
+        self.assertEqual(self.get_with_queries()[0].status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.post('/api/token/refresh', {'refresh': str(refresh)})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        # a new login carries the current flags
+        self.client.credentials()
+        response = self.client.post('/api/token', {'username': 'admin', 'password': PASSWORD})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.assertEqual(self.get_with_queries()[0].status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_other_authentication_classes(self):
+        # e.g. session authentication for the browsable API, the request user is a User
+        self.client.force_authenticate(user=self.other)
+        response = self.client.post(f'/api/recipes/{self.recipe.id}/comments', {'text': 'Yum'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['author']['username'], self.other.username)
+
+    def test_process_local_cache_is_not_trusted(self):
+        self.authenticate(self.admin)
+        with self.settings(CACHE_SHARED=False):
+            response, queries = self.get_with_queries()
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(queries), 1)
+            # as another process would, without the signal refreshing this one's cache
+            User.objects.filter(pk=self.admin.pk).update(is_active=False)
+            self.assertEqual(self.get_with_queries()[0].status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deleted_user(self):
+        self.authenticate(self.other)
+        self.other.delete()
+        response = self.client.post(f'/api/recipes/{self.recipe.id}/comments', {'text': 'Yum'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_author_permission_compares_ids(self):
+        self.authenticate(self.other)
+        response = self.client.patch(f'/api/comments/{self.comment.id}', {'text': 'Mine now'})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.authenticate(self.author)
+        response = self.client.patch(f'/api/comments/{self.comment.id}', {'text': 'Still mine'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['author']['username'], 'author')
+
+
+class TokenBlacklistTests(ApiTestCase):
+    def refresh(self, token):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post('/api/token/refresh', {'refresh': str(token)})
+        return response, len(ctx.captured_queries)
+
+    def test_refresh_without_queries(self):
+        token = RefreshToken.for_user(self.author)
+        cache_auth_state(self.author)
+        self.assertEqual(self.refresh(token)[0].status_code, status.HTTP_200_OK)
+        # the blacklist filter is built by now
+        response, queries = self.refresh(token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(queries, 0)
+
+    def test_blacklisted_token_is_refused(self):
+        token = RefreshToken.for_user(self.author)
+        self.assertEqual(self.refresh(token)[0].status_code, status.HTTP_200_OK)
+        with self.captureOnCommitCallbacks(execute=True):
+            RefreshToken(str(token)).blacklist()
+        self.assertEqual(self.refresh(token)[0].status_code, status.HTTP_401_UNAUTHORIZED)
+
+        # without the cached revocation the database has the final say
+        cache.clear()
+        self.assertEqual(self.refresh(token)[0].status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.refresh(RefreshToken.for_user(self.author))[0].status_code, status.HTTP_200_OK)
+
+    def test_process_local_cache_is_not_trusted(self):
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+        token = RefreshToken.for_user(self.author)
+        with self.settings(CACHE_SHARED=False):
+            self.assertEqual(self.refresh(token)[0].status_code, status.HTTP_200_OK)
+            # as another process would, its generation bump never reaches this one's cache
+            BlacklistedToken.objects.create(token=OutstandingToken.objects.get(jti=token['jti']))
+            self.assertEqual(self.refresh(token)[0].status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivated_user_cannot_refresh(self):
+        token = RefreshToken.for_user(self.other)
+        self.other.is_active = False
+        self.other.save(update_fields=['is_active'])
+        self.assertEqual(self.refresh(token)[0].status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_bloom_filter(self):
+        from .blacklist import BloomFilter
+
+        bloom = BloomFilter(1000)
+        keys = [f'jti-{i}' for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        false_positives = sum(f'other-{i}' in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_prune_expired_tokens(self):
+        from datetime import timedelta
+        from io import StringIO
+        from django.core.management import call_command
+        from django.utils import timezone
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+        tokens = [RefreshToken.for_user(self.author) for _ in range(5)]
+        for token in tokens[:2]:
+            token.blacklist()
+        OutstandingToken.objects.filter(jti__in=[token['jti'] for token in tokens[1:4]]).update(
+            expires_at=timezone.now() - timedelta(minutes=1)
+        )
+
+        out = StringIO()
+        call_command('prune_tokens', batch_size=2, pause=0, stdout=out)
+        self.assertIn('deleted 3 expired tokens', out.getvalue())
+        self.assertEqual(
+            sorted(OutstandingToken.objects.values_list('jti', flat=True)),
+            sorted([tokens[0]['jti'], tokens[4]['jti']])
+        )
+        self.assertEqual(list(BlacklistedToken.objects.values_list('token__jti', flat=True)), [tokens[0]['jti']])
+
+
+def async_read_urlpatterns():
+    from django.urls import path
+    from . import async_views
+
+    return [
+        path('api/recipes/', async_views.AsyncRecipeListCreateView.as_view()),
+        path('api/recipes/<int:pk>', async_views.AsyncRecipeDetailView.as_view()),
+        path('api/recipes/<int:pk>/comments', async_views.AsyncListCreateCommentView.as_view()),
+        path('api/recipes/<int:pk>/ratings', async_views.AsyncListCreateRatingView.as_view()),
+        path('api/recipes/<int:pk>/ingredients', async_views.AsyncRecipeIngredientAPIView.as_view()),
+    ]
+
+
+# the reads of backend/urls.py with ASYNC_READ_VIEWS=1, which is off by default
+urlpatterns = async_read_urlpatterns()
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncReadTests(ApiTestCase):
+    urls = {
+        'recipes/': ('RecipeListCreateView', {}),
+        'recipes/{pk}': ('RecipeDetailView', {'pk': True}),
+        'recipes/{pk}/comments': ('ListCreateCommentView', {'pk': True}),
+        'recipes/{pk}/ratings': ('ListCreateRatingView', {'pk': True}),
+        'recipes/{pk}/ingredients': ('RecipeIngredientAPIView', {'pk': True}),
+    }
+
+    def test_reads_are_served_async(self):
+        from asyncio import iscoroutinefunction
+        from django.urls import resolve
+
+        for url in self.urls:
+            self.assertTrue(iscoroutinefunction(resolve('/api/' + url.format(pk=self.recipe.id)).func), url)
+
+    def test_same_representation_as_sync_views(self):
+        from rest_framework.test import APIRequestFactory
+        from . import views
+
+        factory = APIRequestFactory()
+        for url, (view_name, kwargs) in self.urls.items():
+            path = '/api/' + url.format(pk=self.recipe.id)
+            kwargs = {'pk': self.recipe.id} if kwargs else {}
+            expected = getattr(views, view_name).as_view()(factory.get(path), **kwargs)
+            expected.render()
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, status.HTTP_200_OK, url)
+            self.assertEqual(response.json(), json.loads(expected.content), url)
+
+    async def test_served_under_asgi(self):
+        for url in self.urls:
+            response = await self.async_client.get('/api/' + url.format(pk=self.recipe.id))
+            self.assertEqual(response.status_code, status.HTTP_200_OK, url)
+
+    def test_missing_recipe(self):
+        for url in self.urls:
+            if '{pk}' in url:
+                response = self.client.get('/api/' + url.format(pk=0))
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, url)
+                self.assertEqual(response.data, {'detail': 'No Recipe matches the given query.'})
+
+    def test_invalid_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer nonsense')
+        response = self.client.get('/api/recipes/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer realm="api"')
+
+    def test_invalid_page(self):
+        self.assertEqual(self.client.get('/api/recipes/', {'page': 5}).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_browsable_api_and_head(self):
+        response = self.client.get(f'/api/recipes/{self.recipe.id}/comments', HTTP_ACCEPT='text/html')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/html'))
+        response = self.client.head(f'/api/recipes/{self.recipe.id}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('ETag', response)
+
+    def test_writes(self):
+        # DRF's csrf exemption carries over to the wrapper
+        self.authenticate(self.other)
+        response = self.client.post(f'/api/recipes/{self.recipe.id}/comments', {'text': 'Yum'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['author']['username'], 'other')
+
+
+class SparseFieldsTests(ApiTestCase):
+    def get(self, url, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data, [query['sql'] for query in ctx.captured_queries]
+
+    def test_fields(self):
+        data, queries = self.get('/api/recipes/', fields='name,image,category')
+        self.assertEqual(set(data['results'][0]), {'name', 'image', 'category'})
+        self.assertEqual(data['results'][0]['category'], self.category.id)
+        # count and page, no author join and no ingredient prefetch
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('auth_user', queries[1])
+
+    def test_omit(self):
+        data, queries = self.get('/api/recipes/', omit='ingredients,author,description')
+        self.assertFalse({'ingredients', 'author', 'description'} & set(data['results'][0]))
+        self.assertIn('rating_histogram', data['results'][0])
+        self.assertEqual(len(queries), 2)
+
+    def test_expand(self):
+        data, queries = self.get('/api/recipes/', fields='id,category', expand='category')
+        self.assertEqual(data['results'][0]['category'], {'id': self.category.id, 'name': 'Breakfast'})
+        self.assertEqual(len(queries), 2)
+        self.assertIn('api_category', queries[1])
+
+    def test_nested(self):
+        data, _ = self.get(
+            f'/api/recipes/{self.recipe.id}', fields='id,ingredients.quantity,ingredients.ingredient.name,author.username'
+        )
+        self.assertEqual(data['author'], {'username': 'author'})
+        self.assertEqual(data['ingredients'][0], {'quantity': 100, 'ingredient': {'name': 'Ingredient 0'}})
+        # cached per representation
+        data, _ = self.get(f'/api/recipes/{self.recipe.id}')
+        self.assertIn('description', data)
+
+    def test_other_endpoints(self):
+        data, queries = self.get(f'/api/recipes/{self.recipe.id}/comments', fields='text')
+        self.assertEqual(data['results'], [{'text': 'Tasty'}])
+        self.assertNotIn('auth_user', queries[-1])
+
+        data, queries = self.get(f'/api/recipes/{self.recipe.id}/ingredients', omit='ingredient,note')
+        self.assertEqual(set(data[0]), {'id', 'quantity', 'unit'})
+        self.assertNotIn('api_ingredient', queries[-1])
+
+        pantry = f'{self.ingredients[0].id},{self.ingredients[1].id}'
+        data, _ = self.get('/api/recipes/cookable', ingredients=pantry, fields='id,missing_count')
+        self.assertEqual(data['results'], [{'id': self.recipe.id, 'missing_count': 3}])
+
+
+class JSONRenderingTests(ApiTestCase):
+    def test_same_bytes_as_json_renderer(self):
+        from .renderers import ORJSONRenderer
+        from rest_framework.renderers import JSONRenderer
+
+        response = self.client.get('/api/recipes/', HTTP_ACCEPT='application/json')
+        self.assertIsInstance(response.accepted_renderer, ORJSONRenderer)
+        data = {
+            **response.data,
+            'created': datetime.datetime(2024, 5, 1, 12, 30, 0, 1500, tzinfo=datetime.timezone.utc),
+            'day': datetime.date(2024, 5, 1),
+            'price': decimal.Decimal('12.50'),
+            'histogram': {1: 0, 5: 2},
+            'text': 'crème brûlée   </script>',
+            'big': 2 ** 70,
+        }
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(response.content, JSONRenderer().render(response.data))
+
+    def test_indent(self):
+        response = self.client.get('/api/recipes/', HTTP_ACCEPT='application/json; indent=2')
+        self.assertIn(b'\n  "count": 1', response.content)
+
+    def test_parser(self):
+        self.authenticate(self.author)
+        response = self.client.post(
+            f'/api/recipes/{self.recipe.id}/comments', '{"text": "Lekker \\u00e9"}', content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['text'], 'Lekker é')
+
+        response = self.client.post(
+            f'/api/recipes/{self.recipe.id}/comments', '{"text": NaN}', content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue(str(response.data['detail']).startswith('JSON parse error'))
+
+
+class CompressionTests(ApiTestCase):
+    def get(self, accept_encoding, url='/api/recipes/'):
+        return self.client.get(url, HTTP_ACCEPT='application/json', HTTP_ACCEPT_ENCODING=accept_encoding)
+
+    def test_negotiation(self):
+        from .middleware import negotiate_encoding
+
+        self.assertEqual(negotiate_encoding('gzip, deflate, br'), 'br')
+        self.assertEqual(negotiate_encoding('br;q=0.5, gzip'), 'gzip')
+        self.assertEqual(negotiate_encoding('*'), 'br')
+        self.assertEqual(negotiate_encoding('br;q=0, *;q=0.1'), 'gzip')
+        self.assertIsNone(negotiate_encoding('identity'))
+        self.assertIsNone(negotiate_encoding(''))
+
+    def test_gzip(self):
+        import gzip
+
+        plain = self.get('')
+        response = self.get('gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertLess(len(response.content), len(plain.content))
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', plain['Vary'])
+
+    def test_brotli(self):
+        import brotli
+
+        response = self.get('gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.content), self.get('').content)
+
+    def test_small_body(self):
+        response = self.get('gzip', f'/api/recipes/{self.recipe.id}/comments?fields=text')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    @override_settings(COMPRESSION_MIN_SIZE=200)
+    def test_weak_etag(self):
+        response = self.get('gzip', f'/api/recipes/{self.recipe.id}')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue(response['ETag'].startswith('W/"'))
+        # the weak ETag still matches
+        response = self.client.get(
+            f'/api/recipes/{self.recipe.id}', HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag']
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_streaming(self):
+        import gzip
+        from django.http import StreamingHttpResponse
+        from django.test import RequestFactory
+        from .middleware import CompressionMiddleware
+
+        lines = [f'{{"line": {i}}}\n'.encode() for i in range(100)]
+        middleware = CompressionMiddleware(lambda request: StreamingHttpResponse(iter(lines), content_type='application/x-ndjson'))
+        response = middleware(RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertFalse(response.has_header('Content-Length'))
+        chunks = list(response.streaming_content)
+        # every chunk is flushed, what has arrived so far decodes
+        self.assertEqual(zlib.decompressobj(31).decompress(b''.join(chunks[:2])), lines[0] + lines[1])
+        self.assertEqual(gzip.decompress(b''.join(chunks)), b''.join(lines))
+
+    def test_already_encoded_and_binary(self):
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from .middleware import CompressionMiddleware
+
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip')
+        png = CompressionMiddleware(lambda request: HttpResponse(b'\0' * 4096, content_type='image/png'))(request)
+        self.assertFalse(png.has_header('Content-Encoding'))
+
+        response = self.client.get('/api/recipes/export', HTTP_ACCEPT_ENCODING='br')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.authenticate(self.admin)
+        response = self.client.get('/api/recipes/export', HTTP_ACCEPT_ENCODING='gzip')
+        # the export compresses itself
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+
+class RequestTimingTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        from .instrumentation import metrics
+
+        metrics.reset()
+
+    def server_timing(self, response):
+        return {
+            name: dict(param.split('=', 1) for param in params)
+            for name, *params in (metric.strip().split(';') for metric in response['Server-Timing'].split(','))
+        }
+
+    def test_server_timing(self):
+        response = self.client.get('/api/recipes/', HTTP_ACCEPT='application/json')
+        timing = self.server_timing(response)
+        self.assertEqual(set(timing), {'db', 'serializer', 'render', 'total'})
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/recipes/', HTTP_ACCEPT='application/json')
+        self.assertEqual(timing['db']['desc'], f'"{len(queries)} queries"')
+        self.assertGreater(float(timing['serializer']['dur']) + float(timing['render']['dur']), 0)
+        self.assertGreaterEqual(float(timing['total']['dur']), float(timing['db']['dur']))
+
+    @override_settings(SLOW_REQUEST_SECONDS=0)
+    def test_slow_request_log(self):
+        with self.assertLogs('api.instrumentation', 'WARNING') as logs:
+            self.client.get(f'/api/recipes/{self.recipe.id}/comments')
+        self.assertIn(f'Slow request GET /api/recipes/{self.recipe.id}/comments (/api/recipes/<int:pk>/comments)', logs.output[0])
+        self.assertIn('FROM "api_comment"', logs.output[0])
+
+    @override_settings(METRICS_ALLOWED_IPS=[ip_network('127.0.0.0/8')])
+    def test_metrics(self):
+        self.client.get(f'/api/recipes/{self.recipe.id}')
+        self.client.get(f'/api/recipes/{self.recipe.id + 1000}')
+        self.client.get('/no/such/page')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        labels = 'route="/api/recipes/<int:pk>",method="GET"'
+        self.assertIn(f'api_requests_total{{{labels},status="200"}} 1', body)
+        self.assertIn(f'api_requests_total{{{labels},status="404"}} 1', body)
+        self.assertIn('api_requests_total{route="unmatched",method="GET",status="404"} 1', body)
+        self.assertIn(f'api_request_duration_seconds_count{{{labels}}} 2', body)
+        self.assertIn(f'api_request_db_queries_bucket{{{labels},le="+Inf"}} 2', body)
+        self.assertIn('# TYPE api_request_serializer_seconds histogram', body)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_metrics_denied_by_default(self):
+        self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(
+            self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, status.HTTP_404_NOT_FOUND
+        )
+
+    @override_settings(METRICS_TOKEN='secret', METRICS_ALLOWED_IPS=[ip_network('10.0.0.0/8'), ip_network('::1')])
+    def test_metrics_allowed_ips(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='::1').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'])
+class ReplicaRoutingTests(ApiTestCase):
+    def setUp(self):
+        from .routers import _ReplicaHealth, set_replica_health
+
+        super().setUp()
+        _ReplicaHealth.state.clear()
+        set_replica_health('replica1', True)
+
+    def route(self, request):
+        from .routers import ReplicaRouter, end_request, start_request
+
+        token = start_request(request)
+        try:
+            return ReplicaRouter().db_for_read(Recipe)
+        finally:
+            end_request(token)
+
+    def get(self, user=None, **kwargs):
+        from django.test import RequestFactory
+
+        request = RequestFactory().get('/api/recipes/', **kwargs)
+        if user is not None:
+            request.user = user
+        return request
+
+    def test_reads_go_to_replicas(self):
+        from django.test import RequestFactory
+        from .routers import ReplicaRouter
+
+        self.assertEqual(self.route(self.get()), 'replica1')
+        self.assertEqual(self.route(RequestFactory().post('/api/recipes/')), 'default')
+        # outside of a request
+        self.assertEqual(ReplicaRouter().db_for_read(Recipe), 'default')
+        self.assertEqual(ReplicaRouter().db_for_write(Recipe), 'default')
+
+    def test_unhealthy_replica(self):
+        from .routers import set_replica_health
+
+        set_replica_health('replica1', False)
+        self.assertEqual(self.route(self.get()), 'default')
+
+    def test_read_your_writes(self):
+        self.authenticate(self.author)
+        response = self.client.post(f'/api/recipes/{self.recipe.id}/comments', {'text': 'Again'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.cookies['db_pin']['max-age'], 5)
+
+        self.assertEqual(self.route(self.get(user=self.author)), 'default')
+        self.assertEqual(self.route(self.get(user=self.other)), 'replica1')
+        self.assertEqual(self.route(self.get(HTTP_COOKIE='db_pin=1')), 'default')
+
+        # failed writes don't pin
+        self.authenticate(self.other)
+        response = self.client.post(f'/api/recipes/{self.recipe.id}/comments', {})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertNotIn('db_pin', response.cookies)
+        self.assertEqual(self.route(self.get(user=self.other)), 'replica1')
+
+    @override_settings(DATABASE_REPLICAS=['default'], REPLICA_CHECK_INTERVAL=0, REPLICA_RETRY_AFTER=0)
+    def test_health_check(self):
+        from .routers import _ReplicaHealth, healthy_replicas
+
+        def check():
+            replicas = healthy_replicas()
+            thread = _ReplicaHealth.checks.get('default')
+            if thread is not None:
+                thread.join()
+            return replicas
+
+        # not used before the first check has passed
+        self.assertEqual(check(), [])
+        # a server that isn't a replica has no lag
+        self.assertEqual(check(), ['default'])
+        with override_settings(REPLICA_MAX_LAG=-1):
+            check()
+            self.assertEqual(check(), [])
+
+
+class QueryBudgetTests(ApiTestCase):
+    """
+    Every endpoint in backend/urls.py gets a fixed query budget. List endpoints
+    must stay within it no matter how many rows end up on the page.
+    """
+
+    def assertQueryBudget(self, budget, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as ctx:
+            response = func(*args, **kwargs)
+        # savepoints only show up because every test runs inside a transaction
+        queries = [query['sql'] for query in ctx.captured_queries if not query['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        self.assertLessEqual(
+            len(queries), budget,
+            f'{len(queries)} queries over a budget of {budget}:\n' + '\n'.join(queries)
+        )
+        return response
+
+    def fill_page(self):
+        for i in range(12):
+            user = make_user(f'user{i}')
+            recipe = make_recipe(user, self.category, self.ingredients, name=f'Recipe {i}')
+            Comment.objects.create(recipe=self.recipe, author=user, text='Nice')
+            Rating.objects.create(recipe=self.recipe, author=user, score=Rating.Score.OKAY)
+            Comment.objects.create(recipe=recipe, author=user, text='Mine')
+
+    def test_register(self):
+        data = {'username': 'newbie', 'email': 'newbie@example.com', 'password1': PASSWORD, 'password2': PASSWORD}
+        response = self.assertQueryBudget(5, self.client.post, '/api/register', data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_token_obtain(self):
+        data = {'username': 'author', 'password': PASSWORD}
+        response = self.assertQueryBudget(2, self.client.post, '/api/token', data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_token_refresh(self):
+        refresh = str(RefreshToken.for_user(self.author))
+        response = self.assertQueryBudget(2, self.client.post, '/api/token/refresh', {'refresh': refresh})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_recipe_list(self):
+        self.fill_page()
+        response = self.assertQueryBudget(3, self.client.get, '/api/recipes/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_recipe_search(self):
+        self.fill_page()
+        response = self.assertQueryBudget(3, self.client.get, '/api/recipes/', {'q': 'recipe', 'highlight': '1'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_cookable(self):
+        self.fill_page()
+        pantry = ','.join(str(ingredient.id) for ingredient in self.ingredients)
+        response = self.assertQueryBudget(3, self.client.get, '/api/recipes/cookable', {'ingredients': pantry})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_recipe_list_cursor(self):
+        self.fill_page()
+        first = self.client.get('/api/recipes/', {'cursor': ''})
+        response = self.assertQueryBudget(2, self.client.get, first.data['next'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_recipe_create(self):
+        self.authenticate(self.author)
+        extra = [Ingredient.objects.create(name=f'Extra {i}') for i in range(25)]
+        data = recipe_payload(self.category, self.ingredients + extra)
+        response = self.assertQueryBudget(9, self.client.post, '/api/recipes/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['ingredients']), 30)
+
+    def test_recipe_detail(self):
+        response = self.assertQueryBudget(3, self.client.get, f'/api/recipes/{self.recipe.id}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['ingredients']), len(self.ingredients))
+
+    def test_recipe_detail_cached(self):
+        self.client.get(f'/api/recipes/{self.recipe.id}')
+        response = self.assertQueryBudget(1, self.client.get, f'/api/recipes/{self.recipe.id}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['ingredients']), len(self.ingredients))
+
+    def test_recipe_update(self):
+        self.authenticate(self.author)
+        response = self.assertQueryBudget(
+            7, self.client.patch, f'/api/recipes/{self.recipe.id}', {'name': 'Crepes'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_recipe_delete(self):
+        self.authenticate(self.author)
+        # the recipe and its ingredients, then a DELETE per table holding rows of the recipe
+        response = self.assertQueryBudget(7, self.client.delete, f'/api/recipes/{self.recipe.id}')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_comment_list(self):
+        self.fill_page()
+        response = self.assertQueryBudget(3, self.client.get, f'/api/recipes/{self.recipe.id}/comments')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_comment_create(self):
+        self.authenticate(self.other)
+        response = self.assertQueryBudget(
+            3, self.client.post, f'/api/recipes/{self.recipe.id}/comments', {'text': 'Yum'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_rating_list(self):
+        self.fill_page()
+        response = self.assertQueryBudget(3, self.client.get, f'/api/recipes/{self.recipe.id}/ratings')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_rating_create(self):
+        self.authenticate(self.other)
+        response = self.assertQueryBudget(
+            1, self.client.post, f'/api/recipes/{self.recipe.id}/ratings', {'score': 5}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_recipe_ingredients(self):
+        response = self.assertQueryBudget(2, self.client.get, f'/api/recipes/{self.recipe.id}/ingredients')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), len(self.ingredients))
+
+    def test_ingredient_list(self):
+        response = self.assertQueryBudget(3, self.client.get, '/api/ingredients')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_category_list(self):
+        response = self.assertQueryBudget(3, self.client.get, '/api/categories')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_category_detail(self):
+        response = self.assertQueryBudget(1, self.client.get, f'/api/categories/{self.category.id}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_category_update(self):
+        self.authenticate(self.admin)
+        response = self.assertQueryBudget(
+            4, self.client.patch, f'/api/categories/{self.category.id}', {'name': 'Brunch'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_comment_detail(self):
+        response = self.assertQueryBudget(1, self.client.get, f'/api/comments/{self.comment.id}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_comment_update(self):
+        self.authenticate(self.author)
+        response = self.assertQueryBudget(
+            3, self.client.patch, f'/api/comments/{self.comment.id}', {'text': 'Very tasty'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_rating_detail(self):
+        self.authenticate(self.author)
+        response = self.assertQueryBudget(1, self.client.get, f'/api/ratings/{self.rating.id}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_rating_delete(self):
+        self.authenticate(self.author)
+        response = self.assertQueryBudget(4, self.client.delete, f'/api/ratings/{self.rating.id}')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_rating_update(self):
+        self.authenticate(self.author)
+        response = self.assertQueryBudget(2, self.client.patch, f'/api/ratings/{self.rating.id}', {'score': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_activate(self):
+        user = make_user('inactive', is_active=False)
+        uid = urlsafe_base64_encode(force_bytes(user.pk))
+        token = account_activation_token.make_token(user)
+        response = self.assertQueryBudget(2, self.client.get, f'/api/activate/{uid}/{token}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_activate_send(self):
+        make_user('inactive', is_active=False)
+        response = self.assertQueryBudget(
+            2, self.client.post, '/api/activate-send', {'email': 'inactive@example.com'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class RatingAggregateTests(ApiTestCase):
+    def assertAggregates(self, count, avg, histogram):
+        recipe = Recipe.objects.get(pk=self.recipe.pk)
+        self.assertEqual(recipe.rating_count, count)
+        self.assertAlmostEqual(recipe.avg_rating, avg)
+        self.assertEqual(recipe.rating_histogram, histogram)
+
+    def test_create_update_delete(self):
+        self.authenticate(self.other)
+        response = self.client.post(f'/api/recipes/{self.recipe.id}/ratings', {'score': 1})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertAggregates(2, 2.5, {1: 1, 2: 0, 3: 0, 4: 1, 5: 0})
+
+        rating_id = Rating.objects.get(recipe=self.recipe, author=self.other).id
+        response = self.client.patch(f'/api/ratings/{rating_id}', {'score': 5})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertAggregates(2, 4.5, {1: 0, 2: 0, 3: 0, 4: 1, 5: 1})
+
+        response = self.client.delete(f'/api/ratings/{rating_id}')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertAggregates(1, 4.0, {1: 0, 2: 0, 3: 0, 4: 1, 5: 0})
+
+        self.authenticate(self.author)
+        self.client.delete(f'/api/ratings/{self.rating.id}')
+        self.assertAggregates(0, 0.0, {1: 0, 2: 0, 3: 0, 4: 0, 5: 0})
+
+    def test_rating_again_replaces_score(self):
+        self.authenticate(self.author)
+        response = self.client.post(f'/api/recipes/{self.recipe.id}/ratings', {'score': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Rating.objects.get(recipe=self.recipe, author=self.author).score, 2)
+        self.assertAggregates(1, 2.0, {1: 0, 2: 1, 3: 0, 4: 0, 5: 0})
+
+        # the same score again leaves the recipe alone
+        version = Recipe.objects.get(pk=self.recipe.pk).version
+        response = self.client.post(f'/api/recipes/{self.recipe.id}/ratings', {'score': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe.pk).version, version)
+
+    def test_unknown_recipe(self):
+        self.authenticate(self.other)
+        response = self.client.post('/api/recipes/999999/ratings', {'score': 2})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(Rating.objects.filter(author=self.other).exists())
+
+    def test_unique_per_author(self):
+        from django.db import IntegrityError, transaction
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Rating.objects.create(recipe=self.recipe, author=self.author, score=Rating.Score.BAD)
+
+    def test_update_keeps_recipe(self):
+        self.authenticate(self.author)
+        response = self.client.put(f'/api/ratings/{self.rating.id}', {'score': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['score'], 3)
+        self.assertEqual(Rating.objects.get(pk=self.rating.pk).recipe_id, self.recipe.id)
+
+    def test_serialized_on_recipe(self):
+        response = self.client.get(f'/api/recipes/{self.recipe.id}')
+        self.assertEqual(response.data['rating_count'], 1)
+        self.assertEqual(response.data['avg_rating'], 4.0)
+        self.assertEqual(response.data['rating_histogram'], {1: 0, 2: 0, 3: 0, 4: 1, 5: 0})
+
+    def test_order_by_avg_rating(self):
+        top = make_recipe(self.other, self.category, self.ingredients, name='Top')
+        Rating.objects.create(recipe=top, author=self.author, score=5)
+        apply_rating_change(top.id, new_score=5)
+        unrated = make_recipe(self.other, self.category, self.ingredients, name='Unrated')
+
+        response = self.client.get('/api/recipes/?ordering=-avg_rating')
+        ids = [recipe['id'] for recipe in response.data['results']]
+        self.assertEqual(ids, [top.id, self.recipe.id, unrated.id])
+
+
+class RecipeSearchTests(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.dinner = Category.objects.create(name='Dinner')
+        cls.basil = Ingredient.objects.create(name='Basil')
+        cls.pesto = make_recipe(cls.author, cls.dinner, [cls.basil], name='Pesto pasta')
+        cls.soup = make_recipe(cls.author, cls.category, cls.ingredients, name='Tomato soup')
+        cls.soup.description = 'A soup finished with pesto.'
+        cls.soup.save()
+
+    def search(self, query, **params):
+        response = self.client.get('/api/recipes/', {'q': query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_ranked_by_relevance(self):
+        self.assertEqual(self.search('pesto'), [self.pesto.id, self.soup.id])
+
+    def test_matches_category_and_ingredients(self):
+        self.assertEqual(self.search('dinner'), [self.pesto.id])
+        self.assertEqual(self.search('basil'), [self.pesto.id])
+
+    def test_follows_renames(self):
+        self.basil.name = 'Parsley'
+        self.basil.save()
+        self.dinner.name = 'Supper'
+        self.dinner.save()
+        self.assertEqual(self.search('basil'), [])
+        self.assertEqual(self.search('parsley supper'), [self.pesto.id])
+
+    def test_highlight(self):
+        response = self.client.get('/api/recipes/', {'q': 'pesto', 'highlight': '1'})
+        soup = next(recipe for recipe in response.data['results'] if recipe['id'] == self.soup.id)
+        self.assertIn('<mark>pesto</mark>', soup['headline'])
+        self.assertGreater(soup['rank'], 0)
+
+    def test_highlight_escapes_html(self):
+        self.soup.description = 'Pesto <script>alert("x")</script> & <img src=x onerror=alert(1)> it\'s good'
+        self.soup.save()
+        response = self.client.get('/api/recipes/', {'q': 'pesto', 'highlight': '1'})
+        soup = next(recipe for recipe in response.data['results'] if recipe['id'] == self.soup.id)
+        self.assertTrue(soup['headline'].startswith(
+            '<mark>Pesto</mark> &lt;script&gt;alert(&quot;x&quot;)&lt;/script'
+        ))
+        self.assertNotRegex(soup['headline'].replace('<mark>', '').replace('</mark>', ''), '[<>"\']')
+
+    def test_plain_list_has_no_search_fields(self):
+        response = self.client.get('/api/recipes/')
+        self.assertNotIn('rank', response.data['results'][0])
+        self.assertNotIn('headline', response.data['results'][0])
+
+
+class TrendingTests(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.dinner = Category.objects.create(name='Dinner')
+        cls.stew = make_recipe(cls.author, cls.dinner, cls.ingredients, name='Stew')
+        cls.salad = make_recipe(cls.author, cls.category, cls.ingredients, name='Salad')
+
+    def trending(self, url='/api/recipes/trending', **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [recipe['id'] for recipe in response.data]
+
+    def score(self, recipe):
+        from .trending import decayed_score
+
+        return decayed_score(Recipe.objects.get(pk=recipe.pk).trending_score)
+
+    def test_activity_adds_up(self):
+        from .trending import COMMENT_WEIGHT
+
+        self.authenticate(self.other)
+        self.client.post(f'/api/recipes/{self.stew.id}/ratings', {'score': 5})
+        self.assertAlmostEqual(self.score(self.stew), 1.0, places=3)
+        self.client.post(f'/api/recipes/{self.stew.id}/comments', {'text': 'Lovely'})
+        self.assertAlmostEqual(self.score(self.stew), 1.0 + COMMENT_WEIGHT, places=3)
+        self.assertEqual(self.score(self.salad), 0.0)
+
+    def test_decay(self):
+        import time
+        from .trending import activity, add_activity, decayed_score
+
+        half_life = settings.TRENDING_HALF_LIFE_HOURS * 3600
+        now = time.time()
+        recipes = Recipe.objects.filter(pk=self.stew.pk)
+        recipes.update(trending_score=add_activity(activity(1.0, now - 2 * half_life)))
+        recipes.update(trending_score=add_activity(activity(1.0, now - half_life)))
+        # far apart terms don't overflow or underflow
+        recipes.update(trending_score=add_activity(activity(1.0, now - 1000 * half_life)))
+        self.assertAlmostEqual(decayed_score(recipes.get().trending_score, now), 0.25 + 0.5)
+
+    def test_feeds(self):
+        self.authenticate(self.other)
+        self.client.post(f'/api/recipes/{self.salad.id}/ratings', {'score': 2})
+        self.client.post(f'/api/recipes/{self.stew.id}/ratings', {'score': 5})
+        self.assertEqual(self.trending(), [self.stew.id, self.salad.id])
+        self.assertEqual(self.trending(limit=1), [self.stew.id])
+        self.assertEqual(self.trending(f'/api/categories/{self.dinner.id}/trending'), [self.stew.id])
+        self.assertEqual(self.trending(f'/api/categories/{self.category.id}/trending'), [self.salad.id])
+        response = self.client.get('/api/categories/0/trending')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/api/recipes/trending', {'limit': 'x'}).status_code, 400)
+
+    def test_cached_ranking(self):
+        self.authenticate(self.other)
+        self.client.post(f'/api/recipes/{self.salad.id}/ratings', {'score': 3})
+        self.assertEqual(self.trending(), [self.salad.id])
+        self.client.post(f'/api/recipes/{self.stew.id}/ratings', {'score': 5})
+        # the recipes and their ingredients, the ranking comes from the cache
+        with self.assertNumQueries(2):
+            self.assertEqual(self.trending(), [self.salad.id])
+        cache.clear()
+        self.assertEqual(self.trending(), [self.stew.id, self.salad.id])
+
+    def test_refresh(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        self.authenticate(self.other)
+        self.client.post(f'/api/recipes/{self.stew.id}/ratings', {'score': 5})
+        self.client.post(f'/api/recipes/{self.stew.id}/comments', {'text': 'Lovely'})
+        self.client.post(f'/api/recipes/{self.salad.id}/ratings', {'score': 4})
+        incremental = self.score(self.stew)
+        self.assertEqual(self.trending(), [self.stew.id, self.salad.id])
+
+        # a deleted rating only leaves the score on the next refresh
+        Rating.objects.filter(recipe=self.salad).delete()
+        out = StringIO()
+        call_command('refresh_trending', stdout=out)
+        # the fixture's rating and comment count too, they were written around the api
+        self.assertIn('scored 2 recipes', out.getvalue())
+        self.assertAlmostEqual(self.score(self.stew), incremental, places=3)
+        self.assertIsNone(Recipe.objects.get(pk=self.salad.pk).trending_score)
+        self.assertEqual(self.trending(), [self.stew.id, self.recipe.id])
+
+
+class SimilarRecipeTests(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.dinner = Category.objects.create(name='Dinner')
+        cls.saffron = Ingredient.objects.create(name='Saffron')
+        cls.near = make_recipe(cls.author, cls.category, cls.ingredients[:4], name='Crepes')
+        cls.far = make_recipe(cls.author, cls.dinner, cls.ingredients[3:] + [cls.saffron], name='Paella')
+        cls.apart = make_recipe(cls.author, cls.dinner, [Ingredient.objects.create(name='Tea')], name='Tea')
+
+    def similar(self, recipe):
+        response = self.client.get(f'/api/recipes/{recipe.id}/similar')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['id'] for item in response.data]
+
+    def build(self, **kwargs):
+        # with four recipes every ingredient is common
+        with self.settings(SIMILAR_MAX_DOCUMENT_FREQUENCY=1.0):
+            return similarity.NeighbourBuilder(**kwargs).run()
+
+    def test_stored_neighbours(self):
+        from .models import RecipeNeighbours
+
+        self.assertEqual(self.similar(self.recipe), [])
+        RecipeNeighbours.objects.create(
+            recipe=self.recipe, recipe_ids=[self.far.id, 0, self.near.id], scores=[0.9, 0.8, 0.7], signature=0,
+        )
+        # the neighbours, then the recipes and their ingredients
+        with self.assertNumQueries(3):
+            self.assertEqual(self.similar(self.recipe), [self.far.id, self.near.id])
+        response = self.client.get('/api/recipes/0/similar')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @skipUnless(similarity.np is not None, 'numpy and scipy are not installed')
+    def test_build(self):
+        stats = self.build()
+        self.assertEqual((stats['recipes'], stats['changed'], stats['rebuilt']), (4, 4, 4))
+        self.assertEqual(self.similar(self.recipe), [self.near.id, self.far.id])
+        self.assertEqual(self.similar(self.far), [self.recipe.id, self.near.id])
+        self.assertEqual(self.similar(self.apart), [])
+        self.assertEqual(self.build()['rebuilt'], 0)
+
+        # far no longer shares anything, so the recipes listing it are rebuilt too
+        RecipeIngredient.objects.filter(recipe=self.far).exclude(ingredient=self.saffron).delete()
+        stats = self.build()
+        self.assertEqual((stats['changed'], stats['rebuilt']), (1, 3))
+        self.assertEqual(self.similar(self.recipe), [self.near.id])
+        self.assertEqual(self.similar(self.far), [])
+
+        # a new recipe enters the lists it beats
+        twin = make_recipe(self.author, self.category, self.ingredients, name='Pancakes again')
+        stats = self.build()
+        self.assertEqual((stats['changed'], stats['rebuilt']), (1, 3))
+        self.assertEqual(self.similar(self.recipe), [twin.id, self.near.id])
+
+        self.near.delete()
+        self.build()
+        self.assertEqual(self.similar(self.recipe), [twin.id])
+
+    @skipUnless(similarity.np is not None, 'numpy and scipy are not installed')
+    def test_category_boost(self):
+        # both as similar to apart, without the boost the tie goes to the older recipe
+        tea = Ingredient.objects.get(name='Tea')
+        breakfast_tea = make_recipe(self.author, self.category, [tea], name='Breakfast tea')
+        iced_tea = make_recipe(self.author, self.dinner, [tea], name='Iced tea')
+        with self.settings(SIMILAR_CATEGORY_BOOST=0):
+            self.build(full=True)
+        self.assertEqual(self.similar(self.apart), [breakfast_tea.id, iced_tea.id])
+        self.build(full=True)
+        self.assertEqual(self.similar(self.apart), [iced_tea.id, breakfast_tea.id])
+
+    @skipUnless(similarity.np is not None, 'numpy and scipy are not installed')
+    def test_command(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        out = StringIO()
+        with self.settings(SIMILAR_MAX_DOCUMENT_FREQUENCY=1.0):
+            call_command('refresh_similar', '--workers', '1', stdout=out)
+        self.assertIn('rebuilt 4 of 4 recipes, 4 changed', out.getvalue())
+
+
+class CookableRecipeTests(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.eggs, cls.milk, cls.flour, cls.salt = cls.ingredients[:4]
+        cls.omelette = make_recipe(cls.author, cls.category, [cls.eggs, cls.salt], name='Omelette')
+        cls.custard = make_recipe(cls.author, cls.category, [cls.eggs, cls.milk, cls.flour], name='Custard')
+        cls.unrelated = make_recipe(cls.author, cls.category, [Ingredient.objects.create(name='Rice')], name='Rice')
+
+    def cookable(self, *ingredients, **params):
+        pantry = ','.join(str(ingredient.id) for ingredient in ingredients)
+        return self.client.get('/api/recipes/cookable', {'ingredients': pantry, **params})
+
+    def test_ranked_by_missing_ingredients(self):
+        response = self.cookable(self.eggs, self.salt, self.milk)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = [(recipe['id'], recipe['matched_count'], recipe['missing_count']) for recipe in response.data['results']]
+        self.assertEqual(results, [
+            (self.omelette.id, 2, 0),
+            (self.custard.id, 2, 1),
+            (self.recipe.id, 3, 2),
+        ])
+
+    def test_max_missing(self):
+        response = self.cookable(self.eggs, self.salt, self.milk, max_missing=1)
+        self.assertEqual([recipe['id'] for recipe in response.data['results']], [self.omelette.id, self.custard.id])
+
+    def test_follows_new_ingredients(self):
+        RecipeIngredient.objects.create(recipe=self.omelette, ingredient=self.milk, quantity=50, unit='ml')
+        response = self.cookable(self.eggs, self.salt)
+        omelette = response.data['results'][0]
+        self.assertEqual((omelette['id'], omelette['missing_count']), (self.omelette.id, 1))
+
+    def test_follows_deleted_ingredients(self):
+        RecipeIngredient.objects.get(recipe=self.custard, ingredient=self.flour).delete()
+        RecipeIngredient.objects.filter(recipe=self.recipe, ingredient=self.flour).delete()
+        self.salt.delete()
+        counts = dict(Recipe.objects.filter(
+            pk__in=[self.omelette.id, self.custard.id, self.recipe.id],
+        ).values_list('pk', 'ingredient_count'))
+        self.assertEqual(counts, {self.omelette.id: 1, self.custard.id: 2, self.recipe.id: 3})
+        response = self.cookable(self.eggs, self.milk)
+        missing = {recipe['id']: recipe['missing_count'] for recipe in response.data['results']}
+        self.assertEqual(missing, {self.omelette.id: 0, self.custard.id: 0, self.recipe.id: 1})
+
+    def keys(self, recipe):
+        return set(Recipe.objects.get(pk=recipe.pk).pantry_keys)
+
+    def test_keys_follow_ingredients(self):
+        self.assertEqual(self.keys(self.custard), {self.eggs.id, self.milk.id, self.flour.id})
+        RecipeIngredient.objects.create(recipe=self.custard, ingredient=self.salt, quantity=1, unit='g')
+        self.assertEqual(self.keys(self.custard), {self.eggs.id, self.milk.id, self.flour.id, self.salt.id})
+        RecipeIngredient.objects.filter(recipe=self.custard, ingredient=self.flour).update(ingredient=self.ingredients[4])
+        self.assertEqual(self.keys(self.custard), {self.eggs.id, self.milk.id, self.salt.id, self.ingredients[4].id})
+        self.milk.delete()
+        self.assertEqual(self.keys(self.custard), {self.eggs.id, self.salt.id, self.ingredients[4].id})
+
+    def test_staples_are_not_keys(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        # eggs are in 3 of the 4 recipes, the 5 ingredient recipe is keyed by its 4 rarest
+        self.assertIn(self.eggs.id, self.keys(self.recipe))
+        out = StringIO()
+        call_command('refresh_pantry_keys', stdout=out)
+        self.assertIn('rekeyed 1 recipes', out.getvalue())
+        self.assertEqual(self.keys(self.recipe), {ingredient.id for ingredient in self.ingredients[1:5]})
+        self.assertEqual(Ingredient.objects.get(pk=self.eggs.pk).recipe_count, 3)
+
+        # and still found through its other ingredients
+        response = self.cookable(self.eggs, self.milk, self.flour, self.salt)
+        missing = {recipe['id']: recipe['missing_count'] for recipe in response.data['results']}
+        self.assertEqual(missing, {self.omelette.id: 0, self.custard.id: 0, self.recipe.id: 1})
+
+    def test_missing_at_most_three_by_default(self):
+        rice = Ingredient.objects.get(name='Rice')
+        self.assertEqual(
+            [recipe['id'] for recipe in self.cookable(rice, self.eggs).data['results']],
+            [self.unrelated.id, self.omelette.id, self.custard.id],
+        )
+        # the recipe misses 4 of its 5 ingredients
+        self.assertNotIn(self.recipe.id, [recipe['id'] for recipe in self.cookable(self.eggs).data['results']])
+        self.assertEqual(self.cookable(self.eggs, max_missing=4).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.cookable(self.eggs, max_missing=-1).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_invalid_pantry(self):
+        self.assertEqual(self.client.get('/api/recipes/cookable').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            self.client.get('/api/recipes/cookable', {'ingredients': 'eggs'}).status_code,
+            status.HTTP_400_BAD_REQUEST
+        )
+
+
+class CursorPaginationTests(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(24):
+            # searches rank some above others, and ratings tie in groups
+            recipe = make_recipe(cls.author, cls.category, cls.ingredients[:1], name=f'Recipe {i}' + ' recipe' * (i % 3))
+            Recipe.objects.filter(pk=recipe.pk).update(avg_rating=i % 4)
+            Comment.objects.create(recipe=cls.recipe, author=cls.other, text=f'Comment {i}')
+
+    def collect(self, url, **params):
+        ids, response = [], self.client.get(url, {'cursor': '', **params})
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [row['id'] for row in response.data['results']]
+            if response.data['next'] is None:
+                return ids
+            response = self.client.get(response.data['next'])
+
+    def walk_pages(self, url, **params):
+        ids, response = [], self.client.get(url, params)
+        while True:
+            ids += [row['id'] for row in response.data['results']]
+            if response.data['next'] is None:
+                return ids
+            response = self.client.get(response.data['next'])
+
+    def test_walks_every_recipe_once(self):
+        ids = self.collect('/api/recipes/')
+        self.assertEqual(ids, list(Recipe.objects.order_by('-created_at', '-id').values_list('id', flat=True)))
+
+    def test_walks_every_comment_once(self):
+        ids = self.collect(f'/api/recipes/{self.recipe.id}/comments')
+        self.assertEqual(len(ids), 25)
+        self.assertEqual(len(set(ids)), 25)
+
+    def test_inserts_do_not_shift_pages(self):
+        first = self.client.get('/api/recipes/', {'cursor': ''})
+        make_recipe(self.author, self.category, self.ingredients[:1], name='Newest')
+        second = self.client.get(first.data['next'])
+        first_ids = {row['id'] for row in first.data['results']}
+        self.assertFalse(first_ids & {row['id'] for row in second.data['results']})
+
+    def test_count_is_optional(self):
+        self.assertNotIn('count', self.client.get('/api/recipes/', {'cursor': ''}).data)
+        self.assertEqual(self.client.get('/api/recipes/', {'cursor': '', 'count': 'exact'}).data['count'], 25)
+        self.assertIsInstance(self.client.get('/api/recipes/', {'cursor': '', 'count': 'estimate'}).data['count'], int)
+
+    def test_page_numbers_by_default(self):
+        response = self.client.get('/api/recipes/', {'page': 3})
+        self.assertEqual(response.data['count'], 25)
+        self.assertEqual(len(response.data['results']), 5)
+
+    def test_keeps_the_ordering(self):
+        for params in [{'ordering': '-avg_rating'}, {'ordering': 'avg_rating'}, {'q': 'recipe'},
+                       {'q': 'recipe', 'ordering': '-rating_count'}]:
+            with self.subTest(**params):
+                ids = self.collect('/api/recipes/', **params)
+                self.assertEqual(len(ids), len(set(ids)))
+                self.assertEqual(ids, self.walk_pages('/api/recipes/', **params))
+        ranked = self.collect('/api/recipes/', q='recipe')
+        self.assertNotEqual(ranked, self.collect('/api/recipes/'))
+
+    def test_invalid_cursor(self):
+        def cursor(values):
+            return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+        for value in ['garbage', cursor(['not-a-date', 1]), cursor([None, 1]), cursor(['2024-01-01']), cursor(5)]:
+            with self.subTest(cursor=value):
+                response = self.client.get('/api/recipes/', {'cursor': value})
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get('/api/recipes/', {'cursor': cursor(['x', 1]), 'q': 'recipe'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ConditionalGetTests(ApiTestCase):
+    def assertNotModified(self, url, etag):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def assertModified(self, url, etag):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response['ETag']
+
+    def test_recipe_detail(self):
+        url = f'/api/recipes/{self.recipe.id}'
+        response = self.client.get(url)
+        self.assertIn('Last-Modified', response)
+        self.assertFalse(response['ETag'].startswith('W/'))
+        with self.assertNumQueries(1):
+            self.assertNotModified(url, response['ETag'])
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code,
+            status.HTTP_304_NOT_MODIFIED
+        )
+
+    def test_recipe_etag_per_representation(self):
+        url = f'/api/recipes/{self.recipe.id}'
+        etag = self.client.get(url)['ETag']
+        html = self.client.get(url, HTTP_ACCEPT='text/html', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(html.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(html['ETag'], etag)
+        self.assertModified(f'{url}?format=api', etag)
+
+        sparse = self.client.get(url, {'fields': 'id,name'})['ETag']
+        self.assertNotEqual(sparse, etag)
+        self.assertModified(f'{url}?fields=id', sparse)
+        # the same projection spelled differently
+        self.assertNotModified(f'{url}?fields=name,id', sparse)
+        self.assertNotModified(f'{url}?fields=name,id&utm_source=feed', sparse)
+
+    def test_nested_writes_bump_recipe(self):
+        url = f'/api/recipes/{self.recipe.id}/ingredients'
+        etag = self.client.get(url)['ETag']
+
+        self.authenticate(self.other)
+        self.client.post(f'/api/recipes/{self.recipe.id}/ratings', {'score': 3})
+        etag = self.assertModified(url, etag)
+
+        self.client.post(f'/api/recipes/{self.recipe.id}/comments', {'text': 'Lovely'})
+        etag = self.assertModified(url, etag)
+
+        RecipeIngredient.objects.filter(recipe=self.recipe).first().save()
+        etag = self.assertModified(url, etag)
+
+        ingredient = self.ingredients[0]
+        ingredient.name = 'Renamed'
+        ingredient.save()
+        etag = self.assertModified(url, etag)
+        self.assertNotModified(url, etag)
+
+    def test_recipe_save_keeps_aggregates(self):
+        stale = Recipe.objects.get(pk=self.recipe.pk)
+        apply_rating_change(self.recipe.id, new_score=5)
+        stale.name = 'Renamed'
+        stale.save()
+        recipe = Recipe.objects.get(pk=self.recipe.pk)
+        self.assertEqual((recipe.name, recipe.rating_count), ('Renamed', 2))
+
+    def test_table_listings(self):
+        for url, obj in (('/api/categories', self.category), ('/api/ingredients', self.ingredients[0])):
+            etag = self.client.get(url)['ETag']
+            self.assertNotModified(url, etag)
+            obj.name = 'Renamed'
+            obj.save()
+            etag = self.assertModified(url, etag)
+            obj.delete()
+            self.assertModified(url, etag)
+
+
+class RecipeCacheTests(ApiTestCase):
+    def get_recipe(self):
+        response = self.client.get(f'/api/recipes/{self.recipe.id}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def stats(self):
+        self.authenticate(self.admin)
+        response = self.client.get('/api/recipes/cache-stats')
+        self.client.credentials()
+        return response.data
+
+    def test_hits_and_misses(self):
+        self.get_recipe()
+        self.get_recipe()
+        self.assertEqual(self.stats(), {'hits': 1, 'misses': 1, 'evictions': 0})
+
+    def test_stats_are_admin_only(self):
+        self.authenticate(self.author)
+        self.assertEqual(self.client.get('/api/recipes/cache-stats').status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_invalidated_by_related_changes(self):
+        self.get_recipe()
+
+        self.author.username = 'chef'
+        self.author.save()
+        self.assertEqual(self.get_recipe()['author']['username'], 'chef')
+
+        ingredient = self.ingredients[0]
+        ingredient.name = 'Saffron'
+        ingredient.save()
+        self.assertIn('Saffron', [item['ingredient']['name'] for item in self.get_recipe()['ingredients']])
+
+        self.category.name = 'Brunch'
+        self.category.save()
+        self.get_recipe()
+
+        self.assertEqual(self.stats(), {'hits': 0, 'misses': 4, 'evictions': 3})
+
+    def test_invalidated_by_deleted_category(self):
+        self.assertEqual(self.get_recipe()['category'], self.category.id)
+        self.category.delete()
+        self.assertIsNone(self.get_recipe()['category'])
+        self.assertEqual(self.stats(), {'hits': 0, 'misses': 2, 'evictions': 1})
+
+    def test_deleted_recipe_is_not_served(self):
+        self.get_recipe()
+        self.assertEqual(self.client.get(f'/api/recipes/{self.recipe.id}', {'fields': 'id,name'}).status_code, status.HTTP_200_OK)
+        self.authenticate(self.author)
+        self.assertEqual(self.client.delete(f'/api/recipes/{self.recipe.id}').status_code, status.HTTP_204_NO_CONTENT)
+        self.client.credentials()
+        self.assertEqual(self.client.get(f'/api/recipes/{self.recipe.id}').status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(f'/api/recipes/{self.recipe.id}', {'fields': 'id,name'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_invalidated_by_deleted_ingredient(self):
+        saffron = Ingredient.objects.create(name='Saffron')
+        RecipeIngredient.objects.create(recipe=self.recipe, ingredient=saffron, quantity=1, unit='g')
+        self.assertIn('Saffron', [item['ingredient']['name'] for item in self.get_recipe()['ingredients']])
+        self.assertEqual(self.client.get('/api/recipes/', {'q': 'saffron'}).data['count'], 1)
+
+        saffron.delete()
+        self.assertNotIn('Saffron', [item['ingredient']['name'] for item in self.get_recipe()['ingredients']])
+        self.assertEqual(self.client.get('/api/recipes/', {'q': 'saffron'}).data['count'], 0)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe.id).ingredient_count, len(self.ingredients))
+        self.assertEqual(self.stats(), {'hits': 0, 'misses': 2, 'evictions': 1})
+
+    def test_last_login_keeps_cache(self):
+        self.get_recipe()
+        self.author.save(update_fields=['last_login'])
+        self.get_recipe()
+        self.assertEqual(self.stats()['hits'], 1)
+
+    def test_waits_for_concurrent_render(self):
+        import threading
+
+        cache.add('key:lock', 1)
+        threading.Timer(0.1, cache.set, args=('key', (1, 'rendered elsewhere'))).start()
+        self.assertEqual(get_or_render('key', 1, lambda: self.fail('rendered twice')), 'rendered elsewhere')
+
+
+class RecipeCreateTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.authenticate(self.author)
+
+    def test_nested_create(self):
+        response = self.client.post('/api/recipes/', recipe_payload(self.category, self.ingredients[:3]), format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        recipe = Recipe.objects.get(pk=response.data['id'])
+        self.assertEqual(recipe.author, self.author)
+        self.assertEqual(recipe.ingredient_count, 3)
+        self.assertEqual(
+            sorted(item['ingredient']['id'] for item in response.data['ingredients']),
+            [ingredient.id for ingredient in self.ingredients[:3]]
+        )
+        self.assertEqual(self.client.get('/api/recipes/', {'q': 'ingredient'}).data['count'], 2)
+
+    def test_unknown_ingredients(self):
+        data = recipe_payload(self.category, self.ingredients[:2])
+        data['ingredients'][0]['ingredient_id'] = 999998
+        data['ingredients'][1]['ingredient_id'] = 999999
+        response = self.client.post('/api/recipes/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['ingredients'], ['Unknown ingredient ids: 999998, 999999.'])
+        self.assertFalse(Recipe.objects.filter(name='Omelette').exists())
+
+    def test_duplicate_ingredients(self):
+        data = recipe_payload(self.category, [self.ingredients[0], self.ingredients[0]])
+        response = self.client.post('/api/recipes/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_needs_two_ingredients(self):
+        response = self.client.post('/api/recipes/', recipe_payload(self.category, self.ingredients[:1]), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RecipeUpdateTests(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.pantry = [Ingredient.objects.create(name=f'Spice {i}') for i in range(40)]
+        cls.big = make_recipe(cls.author, cls.category, cls.pantry, name='Curry')
+
+    def setUp(self):
+        super().setUp()
+        self.authenticate(self.author)
+
+    def put(self, recipe, ingredients, **changes):
+        data = recipe_payload(self.category, [], name=recipe.name)
+        data['ingredients'] = ingredients
+        data.update(changes)
+        return self.client.put(f'/api/recipes/{recipe.id}', data, format='json')
+
+    def ingredient_rows(self, recipe):
+        return [
+            {'ingredient_id': item.ingredient_id, 'quantity': item.quantity, 'unit': item.unit, 'note': item.note or ''}
+            for item in RecipeIngredient.objects.filter(recipe=recipe).order_by('ingredient_id')
+        ]
+
+    def test_single_quantity_touches_one_row(self):
+        rows = self.ingredient_rows(self.big)
+        rows[7]['quantity'] = 250
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.put(self.big, rows)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        writes = [
+            query['sql'] for query in ctx.captured_queries
+            if query['sql'].startswith(('INSERT INTO "api_recipeingredient"', 'UPDATE "api_recipeingredient"',
+                                        'DELETE FROM "api_recipeingredient"'))
+        ]
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0].startswith('UPDATE'))
+        self.assertEqual(self.ingredient_rows(self.big), rows)
+
+    def test_add_remove_and_change(self):
+        rows = self.ingredient_rows(self.recipe)
+        del rows[0]
+        rows[0]['note'] = 'finely chopped'
+        rows.append({'ingredient_id': self.pantry[0].id, 'quantity': 1, 'unit': 'tsp', 'note': ''})
+        response = self.put(self.recipe, rows, name='Spiced pancakes')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['ingredients']), 5)
+        self.assertEqual(response.data['name'], 'Spiced pancakes')
+        self.assertEqual(self.ingredient_rows(self.recipe), sorted(rows, key=lambda row: row['ingredient_id']))
+        self.assertEqual(Recipe.objects.get(pk=self.recipe.pk).ingredient_count, 5)
+        self.assertEqual(self.client.get('/api/recipes/', {'q': 'spice'}).data['count'], 2)
+
+    def test_keeps_comments_and_ratings(self):
+        rows = self.ingredient_rows(self.recipe)[:2]
+        self.assertEqual(self.put(self.recipe, rows).status_code, status.HTTP_200_OK)
+        self.assertTrue(Comment.objects.filter(pk=self.comment.pk).exists())
+        self.assertTrue(Rating.objects.filter(pk=self.rating.pk).exists())
+
+    def test_patch_without_ingredients(self):
+        response = self.client.patch(f'/api/recipes/{self.recipe.id}', {'servings': 8}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['servings'], 8)
+        self.assertEqual(len(response.data['ingredients']), len(self.ingredients))
+
+    def test_only_author_can_edit(self):
+        self.authenticate(self.other)
+        response = self.client.patch(f'/api/recipes/{self.recipe.id}', {'servings': 8}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class RecipeImportTests(ApiTestCase):
+    def lines(self, count, category='Imported'):
+        import json
+
+        for i in range(count):
+            yield json.dumps({
+                'name': f'Imported {i}', 'description': 'From a partner feed.', 'category': category,
+                'prep_time': 5, 'prep_time_unit': 'minutes', 'cook_time': 10, 'cook_time_units': 'minutes',
+                'servings': 2,
+                'ingredients': [
+                    {'name': 'Ingredient 0', 'quantity': 1, 'unit': 'pcs'},
+                    {'name': f'Rare {i % 3}', 'quantity': 5, 'unit': 'g', 'note': 'optional'},
+                ],
+            }) + '\n'
+
+    def test_command(self):
+        import tempfile
+        from io import StringIO
+        from django.core.management import call_command
+
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson') as feed:
+            feed.writelines(self.lines(25))
+            feed.write('{"name": "broken"}\n')
+            feed.flush()
+            out, err = StringIO(), StringIO()
+            call_command('import_recipes', feed.name, author='admin', chunk_size=10, stdout=out, stderr=err)
+
+        self.assertIn('Imported 25 recipes with 50 ingredients', out.getvalue())
+        self.assertIn('recipes/s', out.getvalue())
+        self.assertIn('line 26', err.getvalue())
+
+        imported = Recipe.objects.filter(name__startswith='Imported')
+        self.assertEqual(imported.count(), 25)
+        self.assertEqual(Category.objects.filter(name='Imported').count(), 1)
+        self.assertEqual(Ingredient.objects.filter(name='Ingredient 0').count(), 1)
+        self.assertEqual(Ingredient.objects.filter(name__startswith='Rare').count(), 3)
+        self.assertEqual(set(imported.values_list('ingredient_count', flat=True)), {2})
+        # COPY fires the pantry key triggers too
+        self.assertFalse(imported.filter(pantry_keys=[]).exists())
+        self.assertEqual(self.client.get('/api/recipes/', {'q': 'partner'}).data['count'], 25)
+
+    def test_endpoint(self):
+        body = ''.join(self.lines(5, category='Breakfast'))
+        self.authenticate(self.admin)
+        response = self.client.post('/api/recipes/import', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['recipes'], response.data['errors']), (5, 0))
+        self.assertEqual(Category.objects.filter(name='Breakfast').count(), 1)
+        recipe = Recipe.objects.get(name='Imported 0')
+        self.assertEqual((recipe.author, recipe.category), (self.admin, self.category))
+        self.assertEqual(len(self.client.get(f'/api/recipes/{recipe.id}').data['ingredients']), 2)
+
+    def test_endpoint_rejects_undecodable_lines(self):
+        lines = list(self.lines(3))
+        body = (lines[0] + '{"name": "Cr\xe8me"}\n').encode() + b'{"name": "Cr\xe8me"}\n' + ''.join(lines[1:]).encode()
+        self.authenticate(self.admin)
+        response = self.client.post('/api/recipes/import', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['recipes'], response.data['errors']), (3, 2))
+        self.assertEqual([error['line'] for error in response.data['error_samples']], [2, 3])
+        self.assertIn('utf-8', response.data['error_samples'][1]['error'])
+
+    def test_endpoint_accepts_chunked_body(self):
+        self.authenticate(self.admin)
+        # a chunked upload has no Content-Length, the server ends wsgi.input itself
+        response = self.client.post(
+            '/api/recipes/import', ''.join(self.lines(4)), content_type='application/x-ndjson',
+            CONTENT_LENGTH='', **{'wsgi.input_terminated': True},
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['recipes'], response.data['errors']), (4, 0))
+
+        response = self.client.post(
+            '/api/recipes/import', ''.join(self.lines(4)), content_type='application/x-ndjson', CONTENT_LENGTH='',
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_endpoint_is_admin_only(self):
+        self.authenticate(self.author)
+        response = self.client.post('/api/recipes/import', ''.join(self.lines(1)), content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(Recipe.objects.filter(name__startswith='Imported').exists())
+
+
+class RecipeExportTests(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(9):
+            make_recipe(cls.other, None if i % 2 else cls.category, cls.ingredients[:i % 4 + 2], name=f'Export {i}')
+
+    def export(self, *args):
+        import tempfile
+        from django.core.management import call_command
+
+        with tempfile.NamedTemporaryFile(suffix='.out') as output:
+            call_command('export_recipes', '--output', output.name, *args)
+            return output.read()
+
+    def test_ndjson(self):
+        import json
+
+        records = [json.loads(line) for line in self.export('--chunk-size', '3').decode().splitlines()]
+        self.assertEqual([record['id'] for record in records], list(Recipe.objects.order_by('id').values_list('id', flat=True)))
+        first = records[0]
+        self.assertEqual(first['author'], {'id': self.author.id, 'username': 'author'})
+        self.assertEqual(first['category'], 'Breakfast')
+        self.assertEqual((first['rating_count'], first['avg_rating']), (1, 4.0))
+        self.assertEqual(len(first['ingredients']), 5)
+
+    def test_csv_gzip(self):
+        import csv
+        import gzip
+        import io
+        from .exporting import CSV_COLUMNS
+
+        rows = list(csv.reader(io.StringIO(gzip.decompress(self.export('--format', 'csv', '--gzip')).decode())))
+        self.assertEqual(rows[0], CSV_COLUMNS)
+        self.assertEqual(len(rows), 11)
+
+    def test_queries_per_chunk(self):
+        from .exporting import export_records
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(len(list(export_records(chunk_size=5))), 10)
+        # a cursor fetch plus two prefetches per chunk
+        self.assertLessEqual(len(ctx.captured_queries), 2 * 3 + 1)
+
+    def test_endpoint_streams_gzip(self):
+        import gzip
+
+        self.authenticate(self.admin)
+        response = self.client.get('/api/recipes/export', HTTP_ACCEPT_ENCODING='gzip, br;q=0.5')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        body = gzip.decompress(b''.join(response.streaming_content)).decode()
+        self.assertEqual(len(body.splitlines()), 10)
+
+    def test_endpoint_honours_q_values(self):
+        self.authenticate(self.admin)
+        for accept_encoding in ['gzip;q=0', 'x-gzip', 'identity, gzip;q=0']:
+            with self.subTest(accept_encoding=accept_encoding):
+                response = self.client.get('/api/recipes/export', HTTP_ACCEPT_ENCODING=accept_encoding)
+                self.assertNotIn('Content-Encoding', response)
+                self.assertIn('Accept-Encoding', response['Vary'])
+                self.assertEqual(len(b''.join(response.streaming_content).decode().splitlines()), 10)
+
+    async def test_endpoint_streams_asynchronously_under_asgi(self):
+        import gzip
+        import brotli
+        from asgiref.sync import sync_to_async
+
+        await sync_to_async(cache_auth_state)(self.admin)
+        headers = {'Authorization': f'Bearer {AccessToken.for_user(self.admin)}'}
+        # the view gzips itself, brotli goes through CompressionMiddleware's async stream
+        for accept_encoding in ['gzip', 'br', 'identity']:
+            with self.subTest(accept_encoding=accept_encoding):
+                response = await self.async_client.get(
+                    '/api/recipes/export', {'type': 'csv'}, headers={**headers, 'Accept-Encoding': accept_encoding}
+                )
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertTrue(response.is_async)
+                body = b''.join([chunk async for chunk in response.streaming_content])
+                if accept_encoding == 'gzip':
+                    body = gzip.decompress(body)
+                elif accept_encoding == 'br':
+                    self.assertEqual(response['Content-Encoding'], 'br')
+                    body = brotli.decompress(body)
+                self.assertEqual(len(body.decode().splitlines()), 11)
+
+    def test_endpoint_is_admin_only(self):
+        self.authenticate(self.author)
+        self.assertEqual(self.client.get('/api/recipes/export').status_code, status.HTTP_403_FORBIDDEN)
+
+
+class SeedTests(ApiTestCase):
+    def seed(self, **options):
+        from io import StringIO
+        from django.core.management import call_command
+
+        out = StringIO()
+        call_command('seed', recipes=40, users=20, ingredients=60, chunk_size=15, stdout=out, **options)
+        return out.getvalue()
+
+    def test_seed(self):
+        from django.db.models import Count, Sum
+
+        before = set(Recipe.objects.values_list('id', flat=True))
+        out = self.seed()
+        self.assertIn('Seeded 20 users and 40 recipes', out)
+        self.assertTrue(User.objects.get(username='seed-admin').is_superuser)
+        self.assertEqual(Profile.objects.filter(user__username__startswith='seed').count(), 21)
+
+        recipes = Recipe.objects.exclude(id__in=before)
+        self.assertEqual(recipes.count(), 40)
+        # the aggregates written with the recipes match their rows
+        ratings = {
+            row['recipe']: row for row in
+            Rating.objects.filter(recipe__in=recipes).values('recipe').annotate(count=Count('id'), total=Sum('score'))
+        }
+        self.assertGreater(len(ratings), 0)
+        for recipe in recipes.annotate(ingredients=Count('recipeingredient')):
+            row = ratings.get(recipe.id, {'count': 0, 'total': 0})
+            self.assertEqual((recipe.rating_count, recipe.rating_sum), (row['count'], row['total']))
+            self.assertEqual(sum(recipe.rating_histogram.values()), row['count'])
+            self.assertEqual(recipe.ingredient_count, recipe.ingredients)
+            self.assertIsNotNone(recipe.search_vector)
+        response = self.client.get('/api/recipes/', {'ordering': '-avg_rating'})
+        self.assertEqual(response.data['count'], 41)
+
+    def test_same_seed_same_data(self):
+        def dataset():
+            recipes = Recipe.objects.exclude(id__in=seen).order_by('id')
+            seen.update(recipes.values_list('id', flat=True))
+            return [
+                (recipe.name, recipe.servings, recipe.rating_count, recipe.avg_rating)
+                for recipe in recipes
+            ]
+
+        seen = set(Recipe.objects.values_list('id', flat=True))
+        self.seed(seed=7)
+        first = dataset()
+        self.seed(seed=7)
+        self.assertEqual(dataset(), first)
+        self.seed(seed=8)
+        self.assertNotEqual(dataset(), first)
+
+
+class BenchmarkTests(ApiTestCase):
+    def test_every_route_has_a_scenario(self):
+        from .management.commands.benchmark import SCENARIOS, SKIPPED, url_routes
+
+        routes = url_routes()
+        self.assertIn('api/recipes/<int:pk>', routes)
+        self.assertEqual([route for route in routes if route not in SCENARIOS and route not in SKIPPED], [])
+        self.assertEqual(set(SCENARIOS) | set(SKIPPED), set(routes))
+
+    def test_scenario_request(self):
+        import random
+        from .management.commands.benchmark import SCENARIOS
+
+        pools = {'recipe': [5], 'pantry': [1, 2, 3], 'username': ['cook'], 'password': ['secret']}
+        rating = SCENARIOS['api/recipes/<int:pk>/ratings'][1]
+        self.assertEqual(rating.request(random.Random(0), pools), ('/api/recipes/5/ratings', '{"score": 4}'))
+        path, body = SCENARIOS['api/recipes/cookable'][0].request(random.Random(0), pools)
+        self.assertEqual(sorted(path.split('=')[1].split(',')), ['1', '2', '3'])
+        self.assertEqual(
+            json.loads(SCENARIOS['api/token'][0].request(random.Random(0), pools)[1]),
+            {'username': 'cook', 'password': 'secret'},
+        )
+
+
+class FlakyEmailBackend(LocmemEmailBackend):
+    def send_messages(self, messages):
+        raise ConnectionError('mail server unavailable')
+
+
+class OutboxTests(ApiTestCase):
+    def register(self):
+        data = {'username': 'newbie', 'email': 'newbie@example.com', 'password1': PASSWORD, 'password2': PASSWORD}
+        return self.client.post('/api/register', data)
+
+    def test_register_queues_instead_of_sending(self):
+        self.assertEqual(self.register().status_code, status.HTTP_201_CREATED)
+        self.assertEqual(mail.outbox, [])
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.to, ['newbie@example.com'])
+        self.assertIn('/api/activate/', email.body)
+
+    def test_delivers_batch_over_one_connection(self):
+        from unittest import mock
+
+        for i in range(3):
+            make_user(f'pending{i}', is_active=False)
+            self.client.post('/api/activate-send', {'email': f'pending{i}@example.com'})
+
+        with mock.patch.object(LocmemEmailBackend, 'open', autospec=True, return_value=True) as opened:
+            self.assertEqual(deliver_outbox(batch_size=10), {'sent': 3, 'failed': 0})
+        self.assertEqual(opened.call_count, 1)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), [f'pending{i}@example.com' for i in range(3)])
+        self.assertFalse(OutboxEmail.objects.filter(status=OutboxEmail.Status.PENDING).exists())
+        self.assertEqual(deliver_outbox(), {'sent': 0, 'failed': 0})
+
+    @override_settings(EMAIL_BACKEND='api.tests.FlakyEmailBackend', OUTBOX_MAX_ATTEMPTS=2, OUTBOX_RETRY_DELAY=60)
+    def test_retries_with_backoff(self):
+        from datetime import timedelta
+        from django.utils import timezone
+
+        self.register()
+        self.assertEqual(deliver_outbox(), {'sent': 0, 'failed': 1})
+        email = OutboxEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.Status.PENDING, 1))
+        self.assertGreater(email.next_attempt_at, timezone.now() + timedelta(seconds=50))
+        self.assertIn('mail server unavailable', email.last_error)
+
+        # not due yet
+        self.assertEqual(deliver_outbox(), {'sent': 0, 'failed': 0})
+
+        OutboxEmail.objects.update(next_attempt_at=timezone.now())
+        deliver_outbox()
+        self.assertEqual(OutboxEmail.objects.get().status, OutboxEmail.Status.FAILED)
+
+    def test_command_reports_queue(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        self.register()
+        out = StringIO()
+        call_command('send_outbox', stdout=out)
+        self.assertIn('sent 1, failed 0', out.getvalue())
+        self.assertIn('queue depth 0', out.getvalue())
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class ImageVariantTests(ApiTestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root, IMAGE_VARIANTS={'thumbnail': 16, 'medium': 64})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, name='photo.jpg', size=(200, 100)):
+        from io import BytesIO
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from PIL import Image
+
+        image = Image.new('RGB', size, 'red')
+        exif = image.getexif()
+        exif[0x010F] = 'Camera maker'
+        buffer = BytesIO()
+        image.save(buffer, 'JPEG', exif=exif)
+        self.recipe.image = SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+        self.recipe.save()
+        return self.recipe.image.name
+
+    def test_upload_queues_job(self):
+        from .models import ImageJob
+
+        source = self.upload()
+        job = ImageJob.objects.get()
+        self.assertEqual((job.kind, job.object_id, job.source), (ImageJob.Kind.RECIPE, self.recipe.pk, source))
+
+    def test_renders_variants_without_metadata(self):
+        from django.core.files.storage import default_storage
+        from PIL import Image
+        from .images import process_image_jobs
+        from .models import ImageJob
+
+        source = self.upload()
+        version = Recipe.objects.get(pk=self.recipe.pk).version
+        self.assertEqual(process_image_jobs(), {'processed': 1, 'failed': 0, 'jobs': 1})
+        self.assertFalse(ImageJob.objects.exists())
+
+        recipe = Recipe.objects.get(pk=self.recipe.pk)
+        self.assertEqual(recipe.version, version + 1)
+        self.assertEqual(recipe.image_variants['source'], source)
+        thumbnail = recipe.image_variants['variants']['thumbnail']
+        self.assertEqual((thumbnail['width'], thumbnail['height']), (16, 8))
+        self.assertEqual(set(thumbnail['files']), {'avif', 'webp'})
+        with default_storage.open(thumbnail['files']['webp']) as file, Image.open(file) as image:
+            self.assertEqual(image.format, 'WEBP')
+            self.assertEqual(len(image.getexif()), 0)
+
+        response = self.client.get(f'/api/recipes/{self.recipe.pk}')
+        variants = response.data['image_variants']
+        self.assertTrue(variants['medium']['webp'].startswith('http://testserver/media/recipe_images/'))
+        self.assertEqual(
+            variants['srcset']['avif'], f"{variants['thumbnail']['avif']} 16w, {variants['medium']['avif']} 64w"
+        )
+
+    def test_replaced_image_drops_stale_job_and_variants(self):
+        from django.core.files.storage import default_storage
+        from .images import process_image_jobs
+
+        self.upload('first.jpg')
+        process_image_jobs()
+        old_files = Recipe.objects.get(pk=self.recipe.pk).image_variants['variants']['thumbnail']['files']
+
+        self.recipe.refresh_from_db()
+        self.upload('second.jpg')
+        response = self.client.get(f'/api/recipes/{self.recipe.pk}')
+        self.assertIsNone(response.data['image_variants'])
+
+        self.recipe.refresh_from_db()
+        self.upload('third.jpg')
+        self.assertEqual(process_image_jobs(), {'processed': 1, 'failed': 0, 'jobs': 2})
+        recipe = Recipe.objects.get(pk=self.recipe.pk)
+        self.assertEqual(recipe.image_variants['source'], recipe.image.name)
+        self.assertTrue(recipe.image.name.startswith('recipe_images/third'))
+        self.assertFalse(any(default_storage.exists(path) for path in old_files.values()))
+
+    @override_settings(IMAGE_MAX_PIXELS=1000)
+    def test_refuses_oversized_images(self):
+        from .images import process_image_jobs
+
+        self.upload()
+        self.assertEqual(process_image_jobs(), {'processed': 0, 'failed': 1, 'jobs': 1})
+        self.assertEqual(Recipe.objects.get(pk=self.recipe.pk).image_variants, {})
+
+    def test_command(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        self.upload()
+        out = StringIO()
+        call_command('process_images', stdout=out)
+        self.assertIn('processed 1, failed 0', out.getvalue())
+        self.assertIn('queue depth 0', out.getvalue())
+
+
+class ConcurrentRatingTests(TransactionTestCase):
+    def test_concurrent_creates(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from django.db import connections
+        from rest_framework.test import APIClient
+
+        category = Category.objects.create(name='Dinner')
+        author = make_user('author')
+        recipe = make_recipe(author, category, [Ingredient.objects.create(name='Rice')])
+        users = [make_user(f'rater{i}') for i in range(8)]
+
+        def rate(user):
+            try:
+                client = APIClient()
+                client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+                return client.post(f'/api/recipes/{recipe.id}/ratings', {'score': user.id % 5 + 1}).status_code
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            statuses = list(pool.map(rate, users))
+
+        self.assertEqual(statuses, [status.HTTP_201_CREATED] * len(users))
+        recipe.refresh_from_db()
+        scores = list(Rating.objects.filter(recipe=recipe).values_list('score', flat=True))
+        self.assertEqual(recipe.rating_count, len(scores))
+        self.assertEqual(recipe.rating_sum, sum(scores))
+        self.assertAlmostEqual(recipe.avg_rating, sum(scores) / len(scores))
+
+
+    def test_concurrent_ratings_by_one_author(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from django.db import connections
+        from .services import rate_recipe
+
+        category = Category.objects.create(name='Dinner')
+        author = make_user('author')
+        recipe = make_recipe(author, category, [Ingredient.objects.create(name='Rice')])
+
+        def rate(score):
+            try:
+                return rate_recipe(recipe.id, author.id, score)[1]
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            created = list(pool.map(rate, [1, 2, 3, 4, 5, 1, 2, 3] * 3))
+
+        self.assertEqual(created.count(True), 1)
+        rating = Rating.objects.get(recipe=recipe, author=author)
+        recipe.refresh_from_db()
+        self.assertEqual((recipe.rating_count, recipe.rating_sum), (1, rating.score))
+        self.assertEqual(sum(recipe.rating_histogram.values()), 1)
+        self.assertEqual(recipe.rating_histogram[rating.score], 1)
+
+
+class ConnectionPoolTests(TransactionTestCase):
+    def test_connections_are_reused(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from django.db import connections
+        from .pooling import pool_stats
+
+        def query(_):
+            try:
+                with connections['default'].cursor() as cursor:
+                    cursor.execute('SELECT pg_sleep(0.02)')
+            finally:
+                # hands the connection back to the pool
+                connections['default'].close()
+
+        before = pool_stats()['default']
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            list(executor.map(query, range(30)))
+        after = pool_stats()['default']
+
+        self.assertGreaterEqual(after['requests'] - before['requests'], 30)
+        self.assertLess(after['connections_opened'] - before['connections_opened'], 30)
+        self.assertLessEqual(after['size'], after['max_size'])
+        self.assertEqual(after['timeouts'], before['timeouts'])
+
+    def test_stats_view(self):
+        from rest_framework.test import APIClient
+
+        admin = make_user('admin', is_staff=True, is_superuser=True)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(admin)}')
+        response = client.get('/api/db/pool-stats')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreaterEqual(response.data['default']['in_use'], 1)
+        self.assertIn('mean_wait_ms', response.data['default'])
+
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(make_user("other"))}')
+        self.assertEqual(client.get('/api/db/pool-stats').status_code, status.HTTP_403_FORBIDDEN)
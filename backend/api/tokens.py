@@ -1,7 +1,36 @@
 from django.contrib.auth.tokens import PasswordResetTokenGenerator
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt import tokens
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+
+from .blacklist import is_blacklisted
 
 class AccountActivationTokenGenerator(PasswordResetTokenGenerator):
     def _make_hash_value(self, user, timestamp):
         return f"{user.pk}{timestamp}{user.is_active}"
 
 account_activation_token = AccountActivationTokenGenerator()
+
+
+# claims api.authentication builds the request user from, refreshed access tokens copy them
+USER_CLAIMS = ('username', 'email', 'is_staff', 'is_superuser')
+
+
+class UserClaimsMixin:
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        for claim in USER_CLAIMS:
+            token[claim] = getattr(user, claim)
+        return token
+
+
+class AccessToken(UserClaimsMixin, tokens.AccessToken):
+    pass
+
+
+class RefreshToken(UserClaimsMixin, tokens.RefreshToken):
+    def check_blacklist(self):
+        if is_blacklisted(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError(_('Token is blacklisted'))
@@ -0,0 +1,112 @@
+"""
+Time-decayed popularity of recipes. Every rating and comment adds its weight to the
+recipe's score, and halves in worth every TRENDING_HALF_LIFE_HOURS. Recipe.trending_score
+holds log2 of the sum of weight * 2 ** (hours since 1970 / half-life) over that activity,
+so it never has to be decayed: ranking by it ranks by the decayed score at any moment,
+and a write adds to it with one UPDATE. Deleted ratings and comments aren't taken back
+until manage.py refresh_trending recounts the scores over the last TRENDING_WINDOW_DAYS,
+which also has to run after the half-life changes.
+"""
+import math
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Case, F, FloatField, Value, When
+from django.db.models.functions import Abs, Greatest, Least, Ln, Power
+
+from .models import Category, Comment, Rating, Recipe
+
+
+COMMENT_WEIGHT = 0.5
+LN_2 = math.log(2)
+# beyond this the smaller term can't change a double, and float8 power() would underflow
+MAX_DIFFERENCE = 60
+
+
+def rating_weight(score):
+    # a 5 counts twice a comment, a 1 a fifth of a 5
+    return score / 5
+
+
+def activity(weight, at=None):
+    """The weight of activity at the unix time at, now by default, in the log2 form of trending_score."""
+    hours = (time.time() if at is None else at) / 3600
+    return math.log2(weight) + hours / settings.TRENDING_HALF_LIFE_HOURS
+
+
+def add_activity(value):
+    """trending_score plus the activity, log2(2 ** score + 2 ** value) written so no term overflows."""
+    value = Value(value)
+    return Case(
+        When(trending_score__isnull=True, then=value),
+        default=Greatest(F('trending_score'), value) + Ln(
+            Value(1.0) + Power(Value(2.0), -Least(Abs(F('trending_score') - value), Value(float(MAX_DIFFERENCE))))
+        ) / Value(LN_2),
+        output_field=FloatField(),
+    )
+
+
+def decayed_score(trending_score, at=None):
+    """What a trending_score is worth at the unix time at, in weights of activity at that time."""
+    if trending_score is None:
+        return 0.0
+    hours = (time.time() if at is None else at) / 3600
+    return 2 ** (trending_score - hours / settings.TRENDING_HALF_LIFE_HOURS)
+
+
+# the sum is taken relative to now, which keeps every power() in range
+REFRESH_SQL = f"""
+    WITH activity AS (
+        SELECT recipe_id, ln(score / 5.0) / ln(2) AS weight, extract(epoch FROM updated_at) AS at
+        FROM {Rating._meta.db_table} WHERE updated_at >= %(since)s
+        UNION ALL
+        SELECT recipe_id, {math.log2(COMMENT_WEIGHT)}, extract(epoch FROM created_at)
+        FROM {Comment._meta.db_table} WHERE created_at >= %(since)s
+    ), scores AS (
+        SELECT recipe_id,
+               ln(sum(power(2, weight + (at - %(now)s) / 3600 / %(half_life)s))) / ln(2)
+               + %(now)s / 3600 / %(half_life)s AS score
+        FROM activity GROUP BY recipe_id
+    ), scored AS (
+        UPDATE {Recipe._meta.db_table} AS recipe SET trending_score = scores.score
+        FROM scores WHERE recipe.id = scores.recipe_id
+        RETURNING recipe.id
+    )
+    UPDATE {Recipe._meta.db_table} SET trending_score = NULL
+    WHERE trending_score IS NOT NULL AND id NOT IN (SELECT id FROM scored)
+"""
+
+
+def refresh_scores():
+    """Recounts every trending_score from the ratings and comments of the window."""
+    now = time.time()
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(REFRESH_SQL, {
+            'now': now,
+            'since': datetime.fromtimestamp(now - settings.TRENDING_WINDOW_DAYS * 24 * 3600, tz=timezone.utc),
+            'half_life': settings.TRENDING_HALF_LIFE_HOURS,
+        })
+    cache.delete_many([ranking_key(None), *(ranking_key(pk) for pk in Category.objects.values_list('pk', flat=True))])
+
+
+def ranking_key(category_id):
+    return f'trending:{"all" if category_id is None else category_id}'
+
+
+def ranking(category_id=None):
+    """
+    The ids of the TRENDING_SIZE highest scored recipes, of one category if given, cached
+    for TRENDING_CACHE_SECONDS.
+    """
+    key = ranking_key(category_id)
+    ids = cache.get(key)
+    if ids is None:
+        recipes = Recipe.objects.filter(trending_score__isnull=False)
+        if category_id is not None:
+            recipes = recipes.filter(category_id=category_id)
+        ids = list(recipes.order_by('-trending_score', '-id').values_list('id', flat=True)[:settings.TRENDING_SIZE])
+        cache.set(key, ids, timeout=settings.TRENDING_CACHE_SECONDS)
+    return ids
@@ -1,19 +1,59 @@
 import datetime
 from datetime import timedelta, timezone
 
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
+from django.core.handlers.asgi import ASGIRequest
 from django.db import transaction
+from django.db.models import Count, F, FloatField, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Coalesce, Replace
+from django.http import StreamingHttpResponse
+from rest_framework.exceptions import ValidationError
+from django.utils.cache import patch_vary_headers
 from django.utils.http import urlsafe_base64_decode
-from rest_framework import permissions, status
+from rest_framework import filters, permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from .serializers import *
+from .models import PANTRY_KEY_COUNT, SEARCH_CONFIG, RecipeNeighbours
+from .pagination import CreatedAtCursorPagination
+from .conditional import recipe_condition, recipe_version, table_condition
+from .authentication import model_user
+from .caching import cache_stats, get_or_render, recipe_cache_key
+from .importing import RecipeImporter
+from .middleware import negotiate_encoding
+from .exporting import EXPORT_FORMATS, aencode, aexport_records, encode, export_records
 from rest_framework import generics
+from .pooling import pool_stats
 from .permissions import IsAuthorOrReadOnly, IsAdminOrReadOnly
-from .services import send_activation_email
+from .services import apply_rating_change, send_activation_email
+from .sparse import SparseFields
 from .tokens import account_activation_token
+from .trending import COMMENT_WEIGHT, activity, add_activity, ranking
 from django.conf import settings
 
 
+# the characters html.escape() replaces, ampersands first
+HTML_ESCAPES = [('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'), ("'", '&#x27;')]
+
+
+def escaped_html(expression):
+    """The text of expression escaped for HTML in the database, so ts_headline() marks up escaped text."""
+    for char, entity in HTML_ESCAPES:
+        expression = Replace(expression, Value(char), Value(entity))
+    return expression
+
+
+def recipes_for(request):
+    """Recipe.objects.with_related() limited to the relations the request gets rendered."""
+    sparse = SparseFields.from_request(request)
+    return Recipe.objects.with_related(
+        author=sparse.includes('author'),
+        category=sparse.expands('category'),
+        ingredients=sparse.includes('ingredients'),
+    )
+
+
+@table_condition(Category)
 class CategoryListView(generics.ListAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
@@ -25,34 +65,189 @@ class CategoryDetailView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsAdminOrReadOnly]
 
 
+@recipe_condition
 class RecipeDetailView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly, IsAuthorOrReadOnly]
 
+    def get_queryset(self):
+        return recipes_for(self.request)
+
+    def get_serializer_class(self):
+        if self.request.method in ['PUT', 'PATCH']:
+            return RecipeWriteSerializer
+        return RecipeSerializer
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = self.kwargs['pk']
+        version = recipe_version(request, pk)
+        if version is None:
+            return super().retrieve(request, *args, **kwargs)
+        data = get_or_render(
+            recipe_cache_key(request, pk), version,
+            lambda: self.get_serializer(self.get_object()).data
+        )
+        return Response(data)
+
+    def perform_update(self, serializer):
+        recipe = serializer.save()
+        # UpdateModelMixin drops the prefetch cache after saving, reload it in one go
+        serializer.instance = self.get_queryset().get(pk=recipe.pk)
+
 
 class ListCreateCommentView(generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     serializer_class = CommentSerializer
+    pagination_class = CreatedAtCursorPagination
 
     def get_queryset(self):
         recipe = get_object_or_404(Recipe, id=self.kwargs['pk'])
-        return Comment.objects.filter(recipe=recipe)
+        return SparseFields.from_request(self.request).select_related(Comment.objects.filter(recipe=recipe), 'author')
 
     def perform_create(self, serializer):
         recipe = get_object_or_404(Recipe, id=self.kwargs['pk'])
-        serializer.save(author=self.request.user, recipe=recipe)
+        serializer.save(author=model_user(self.request.user), recipe=recipe)
+        Recipe.objects.filter(pk=recipe.pk).touch(trending_score=add_activity(activity(COMMENT_WEIGHT)))
 
 
 class RecipeListCreateView(generics.ListCreateAPIView):
-    queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    pagination_class = CreatedAtCursorPagination
+    filter_backends = [filters.OrderingFilter]
+    ordering_fields = ['avg_rating', 'rating_count', 'created_at']
+
+    def get_serializer_class(self):
+        if self.request.method == 'POST':
+            return RecipeWriteSerializer
+        return RecipeSerializer
+
+    def get_queryset(self):
+        queryset = recipes_for(self.request)
+        search = self.request.query_params.get('q')
+        if not search:
+            return queryset
+
+        query = SearchQuery(search, search_type='websearch', config=SEARCH_CONFIG)
+        # ts_rank() is a real, read back as a double it would never equal itself in a cursor
+        queryset = queryset.filter(search_vector=query).annotate(
+            rank=Cast(SearchRank(F('search_vector'), query), FloatField())
+        ).order_by('-rank', '-id')
+        if self.request.query_params.get('highlight'):
+            # the headline is HTML, only the <mark> tags may come through unescaped
+            queryset = queryset.annotate(
+                headline=SearchHeadline(
+                    escaped_html(F('description')), query, config=SEARCH_CONFIG,
+                    start_sel='<mark>', stop_sel='</mark>', max_words=30, min_words=10
+                )
+            )
+        return queryset
 
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        recipe = serializer.save(author=model_user(self.request.user))
+        # respond with the full read representation without lazy loading the ingredients
+        serializer.instance = recipes_for(self.request).get(pk=recipe.pk)
+
+
+class CookableRecipeListView(generics.ListAPIView):
+    """
+    Recipes that use any of the given pantry ingredients and miss at most ?max_missing=
+    of their ingredients, PANTRY_KEY_COUNT - 1 and the most by default, fully cookable
+    first. Only recipes whose pantry keys overlap the pantry are read, through a GIN
+    index, so staples don't pull in the whole catalog. Their matches are counted from the
+    postings of those recipes, missing counts come from the stored Recipe.ingredient_count.
+    """
+    serializer_class = RecipeSerializer
+    permission_classes = [permissions.AllowAny]
+
+    def get_pantry(self):
+        try:
+            pantry = {int(pk) for pk in self.request.query_params.get('ingredients', '').split(',') if pk}
+        except ValueError:
+            raise ValidationError({'ingredients': 'Expected a comma separated list of ingredient ids.'})
+        if not pantry:
+            raise ValidationError({'ingredients': 'Provide at least one ingredient id.'})
+        return pantry
+
+    def get_max_missing(self):
+        most = PANTRY_KEY_COUNT - 1
+        try:
+            max_missing = int(self.request.query_params.get('max_missing', most))
+        except ValueError:
+            raise ValidationError({'max_missing': 'Expected a number.'})
+        if not 0 <= max_missing <= most:
+            raise ValidationError({'max_missing': f'Expected a number from 0 to {most}.'})
+        return max_missing
+
+    def get_queryset(self):
+        pantry = sorted(self.get_pantry())
+        matched = RecipeIngredient.objects.filter(
+            recipe=OuterRef('pk'), ingredient_id__in=pantry
+        ).values('recipe').annotate(count=Count('id')).values('count')
+        return recipes_for(self.request).filter(pantry_keys__overlap=pantry).annotate(
+            matched_count=Coalesce(Subquery(matched), 0),
+        ).annotate(
+            missing_count=F('ingredient_count') - F('matched_count'),
+        ).filter(
+            missing_count__lte=self.get_max_missing(),
+        ).order_by('missing_count', '-matched_count', '-id')
+
+
+class TrendingRecipeListView(generics.ListAPIView):
+    """
+    The recipes with the most ratings and comments lately, better scores counting more,
+    from the cached ranking of api.trending. ?limit= takes up to TRENDING_SIZE.
+    """
+    serializer_class = RecipeSerializer
+    permission_classes = [permissions.AllowAny]
+    pagination_class = None
+
+    def get_ranking(self):
+        return ranking()
+
+    def get_limit(self):
+        try:
+            limit = int(self.request.query_params.get('limit', settings.TRENDING_PAGE_SIZE))
+        except ValueError:
+            raise ValidationError({'limit': 'Expected a number.'})
+        return min(max(limit, 1), settings.TRENDING_SIZE)
+
+    def get_queryset(self):
+        ids = self.get_ranking()[:self.get_limit()]
+        recipes = recipes_for(self.request).in_bulk(ids)
+        # deleted since the ranking was cached
+        return [recipes[pk] for pk in ids if pk in recipes]
+
+
+class CategoryTrendingRecipeListView(TrendingRecipeListView):
+    """The top of the trending ranking within one category."""
+    def get_ranking(self):
+        ids = ranking(self.kwargs['pk'])
+        if not ids:
+            get_object_or_404(Category, pk=self.kwargs['pk'])
+        return ids
+
+
+class SimilarRecipeListView(generics.ListAPIView):
+    """
+    The recipes most like this one by their ingredients, best first, from the neighbours
+    stored by manage.py refresh_similar. Empty until it has run since the recipe was created.
+    """
+    serializer_class = RecipeSerializer
+    permission_classes = [permissions.AllowAny]
+    pagination_class = None
+
+    def get_queryset(self):
+        ids = RecipeNeighbours.objects.filter(recipe_id=self.kwargs['pk']).values_list('recipe_ids', flat=True).first()
+        if ids is None:
+            get_object_or_404(Recipe, pk=self.kwargs['pk'])
+            return []
+        recipes = recipes_for(self.request).in_bulk(ids)
+        # deleted since the neighbours were built
+        return [recipes[pk] for pk in ids if pk in recipes]
 
 
+@table_condition(Ingredient)
 class IngredientListView(generics.ListAPIView):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
@@ -60,30 +255,46 @@ class IngredientListView(generics.ListAPIView):
 
 
 class CommentDetailView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Comment.objects.all()
+    queryset = Comment.objects.select_related('author')
     serializer_class = CommentSerializer
     permission_classes = [IsAuthorOrReadOnly]
 
+    def perform_update(self, serializer):
+        comment = serializer.save()
+        Recipe.objects.filter(pk=comment.recipe_id).touch()
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        Recipe.objects.filter(pk=instance.recipe_id).touch()
+
 
 class ListCreateRatingView(generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticatedOrReadOnly, IsAuthorOrReadOnly]
+    pagination_class = CreatedAtCursorPagination
 
     def get_queryset(self):
         recipe = get_object_or_404(Recipe, id=self.kwargs['pk'])
-        return Rating.objects.filter(recipe=recipe)
+        return SparseFields.from_request(self.request).select_related(Rating.objects.filter(recipe=recipe), 'author')
 
     def get_serializer_class(self):
         if self.request.method == 'POST':
             return RatingWriteSerializer
         return RatingSerializer
 
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        if not self.rating_created:
+            # rated before, the score has been replaced
+            response.status_code = status.HTTP_200_OK
+        return response
+
     def perform_create(self, serializer):
-        recipe = get_object_or_404(Recipe, id=self.kwargs['pk'])
-        serializer.save(author=self.request.user, recipe=recipe)
+        serializer.save(author_id=self.request.user.id, recipe_id=self.kwargs['pk'])
+        self.rating_created = serializer.created
 
 
 class ReadUpdateDeleteRatingView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Rating.objects.all()
+    queryset = Rating.objects.select_related('author')
     permission_classes = [permissions.IsAuthenticated, IsAuthorOrReadOnly]
 
     def get_serializer_class(self):
@@ -91,25 +302,119 @@ class ReadUpdateDeleteRatingView(generics.RetrieveUpdateDestroyAPIView):
             return RatingSerializer
         return RatingWriteSerializer
 
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        score = Rating.objects.select_for_update().filter(pk=instance.pk).values_list('score', flat=True).first()
+        if score is None:
+            # deleted by a concurrent request that already updated the aggregates
+            return
+        instance.delete()
+        apply_rating_change(instance.recipe_id, old_score=score)
+
 
 class RatingView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Rating.objects.all()
+    queryset = Rating.objects.select_related('author')
     serializer_class = RatingSerializer
     permission_classes = [IsAuthorOrReadOnly]
 
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        serializer.save(author=model_user(self.request.user))
 
 
+@recipe_condition
 class RecipeIngredientAPIView(APIView):
     permission_classes = [permissions.AllowAny]
     def get(self, request, *args, **kwargs):
-        recipe = get_object_or_404(Recipe, id=self.kwargs['pk'])
-        recipe_ingredients = RecipeIngredient.objects.filter(recipe=recipe)
-        serializer = RecipeIngredientSerializer(recipe_ingredients, many=True)
+        pk = self.kwargs['pk']
+        # the conditional GET looked the recipe up already
+        if recipe_version(request, pk) is None:
+            get_object_or_404(Recipe, id=pk)
+        recipe_ingredients = SparseFields.from_request(request).select_related(
+            RecipeIngredient.objects.filter(recipe_id=pk), 'ingredient'
+        )
+        serializer = RecipeIngredientSerializer(recipe_ingredients, many=True, context={'request': request})
         return Response(serializer.data)
 
 
+def request_body(request):
+    """
+    The body of request as a file, None when there is none. DRF's request.stream is None
+    without a Content-Length, but a chunked upload has none. ASGI servers delimit the body
+    themselves, WSGI servers that do so flag wsgi.input_terminated.
+    """
+    if request.stream is not None:
+        return request.stream
+    django_request = request._request
+    if isinstance(django_request, ASGIRequest):
+        return django_request
+    if django_request.META.get('wsgi.input_terminated'):
+        return django_request.META['wsgi.input']
+    return None
+
+
+class RecipeImportView(APIView):
+    """
+    Streams an NDJSON request body (one recipe per line) into the database. The body is
+    read line by line instead of through request.data, so its size doesn't matter and it
+    may come chunked, memory is bounded by the chunk of recipes being imported.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def post(self, request, *args, **kwargs):
+        try:
+            chunk_size = max(int(request.query_params.get('chunk_size', 1000)), 1)
+        except ValueError:
+            raise ValidationError({'chunk_size': 'Expected a number.'})
+        body = request_body(request)
+        if body is None:
+            raise ValidationError('Expected an NDJSON request body.')
+
+        stats = RecipeImporter(request.user, chunk_size=chunk_size).run(iter(body.readline, b''))
+        return Response(stats, status=status.HTTP_201_CREATED)
+
+
+class RecipeExportView(APIView):
+    """
+    Streams the whole catalog as NDJSON (default) or CSV with ?type=csv. When gzip is the
+    encoding the client prefers it is compressed here, a chunk of records at a time, brotli
+    is left to CompressionMiddleware. Under ASGI the body is an async iterator, Django
+    would read a sync one to the end before sending the first byte.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        export_type = request.query_params.get('type', 'ndjson')
+        if export_type not in EXPORT_FORMATS:
+            raise ValidationError({'type': f"Expected one of: {', '.join(EXPORT_FORMATS)}."})
+        content_type = EXPORT_FORMATS[export_type][2]
+
+        gzip = negotiate_encoding(request.META.get('HTTP_ACCEPT_ENCODING', '')) == 'gzip'
+        if isinstance(request._request, ASGIRequest):
+            chunks = aencode(aexport_records(), export_type, gzip=gzip)
+        else:
+            chunks = encode(export_records(), export_type, gzip=gzip)
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="recipes.{export_type}"'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if gzip:
+            response['Content-Encoding'] = 'gzip'
+        return response
+
+
+class RecipeCacheStatsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(cache_stats())
+
+
+class DatabasePoolStatsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(pool_stats())
+
+
 class RegisterApiView(generics.CreateAPIView):
     queryset = User.objects.all()
     permission_classes = [permissions.AllowAny]
@@ -142,7 +447,7 @@ class ActivateUserView(APIView):
 
         if account_activation_token.check_token(user, token):
             user.is_active = True
-            user.save()
+            user.save(update_fields=['is_active'])
             return Response({'message': 'Account activated successfully.'})
         else:
             return Response({'message': 'Activation link is invalid.'})
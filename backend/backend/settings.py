@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 from pathlib import Path
 import os
 from datetime import timedelta
+from ipaddress import ip_network
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -38,6 +39,10 @@ EMAIL_USE_TLS = False
 EMAIL_USE_SSL = False
 EMAIL_HOST_USER = ''
 
+# api.services.deliver_outbox retries after OUTBOX_RETRY_DELAY seconds, doubling each attempt
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_DELAY = 60
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -45,6 +50,7 @@ INSTALLED_APPS = [
     'rest_framework',
     'rest_framework_simplejwt.token_blacklist',
     'django.contrib.admin',
+    'django.contrib.postgres',
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
@@ -59,12 +65,24 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'api.authentication.CachedJWTAuthentication',
     ),
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'api.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
 MIDDLEWARE = [
+    'api.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'api.middleware.CompressionMiddleware',
+    'api.middleware.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -73,6 +91,21 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# api.middleware.CompressionMiddleware, brotli is used when the package is installed
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_GZIP_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5
+
+# api.middleware.RequestTimingMiddleware, slower requests are logged with their slowest
+# statements. /metrics answers 'Authorization: Bearer <METRICS_TOKEN>' and the addresses
+# or networks of METRICS_ALLOWED_IPS=10.0.0.0/8,..., with neither configured it is a 404
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 1))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = [
+    ip_network(network.strip(), strict=False)
+    for network in filter(None, os.environ.get('METRICS_ALLOWED_IPS', '').split(','))
+]
+
 ROOT_URLCONF = 'backend.urls'
 
 TEMPLATES = [
@@ -97,6 +130,20 @@ WSGI_APPLICATION = 'backend.wsgi.application'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
 
+# a psycopg_pool connection pool per process, see api.pooling.pool_stats for how busy it is
+DB_POOL = os.environ.get('DB_POOL', '1') == '1'
+DB_POOL_OPTIONS = {
+    'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', 2)),
+    'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+    # seconds a request waits for a connection before failing
+    'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+    # requests allowed to queue for a connection, 0 is unlimited
+    'max_waiting': int(os.environ.get('DB_POOL_MAX_WAITING', 0)),
+    # idle connections over min_size are closed after max_idle, all of them are renewed after max_lifetime
+    'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', 300)),
+    'max_lifetime': float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800)),
+}
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -105,8 +152,54 @@ DATABASES = {
         'PASSWORD': os.environ.get('DB_PASSWORD', 'mypassword'),
         'HOST': os.environ.get('DB_HOST', 'db'),
         'PORT': '5432',
+        # without the pool connections are kept for DB_CONN_MAX_AGE seconds instead
+        'CONN_MAX_AGE': 0 if DB_POOL else int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+        # a connection is checked before it's handed out, dead ones are replaced
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 5)),
+            **({'pool': DB_POOL_OPTIONS} if DB_POOL else {}),
+        },
+    }
+}
+
+# read replicas as DB_REPLICAS=host[/name],... with the primary's credentials, see api.routers
+for number, replica in enumerate(filter(None, os.environ.get('DB_REPLICAS', '').split(',')), start=1):
+    host, _, name = replica.strip().partition('/')
+    DATABASES[f'replica{number}'] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'NAME': name or DATABASES['default']['NAME'],
+        'OPTIONS': dict(DATABASES['default']['OPTIONS']),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['api.routers.ReplicaRouter']
+# seconds a client reads from the primary after a write, to see it
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 5))
+# replicas are checked every REPLICA_CHECK_INTERVAL seconds, and left out when they don't
+# answer or lag over REPLICA_MAX_LAG seconds until a check REPLICA_RETRY_AFTER seconds later passes
+REPLICA_CHECK_INTERVAL = 5
+REPLICA_RETRY_AFTER = 30
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 10))
+
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'cuisine-app'),
     }
 }
+# LocMemCache is private to its process, what one worker caches or deletes the others never
+# see. Deployments with more than one process set CACHE_BACKEND to a shared cache like
+# django.core.cache.backends.redis.RedisCache, until then api.authentication and
+# api.blacklist check revocations against the database instead of trusting the cache.
+CACHE_SHARED = not CACHES['default']['BACKEND'].endswith('LocMemCache')
+
+# rendered recipe detail responses, keyed by recipe version
+RECIPE_CACHE_TIMEOUT = 60 * 60
+RECIPE_CACHE_LOCK_TIMEOUT = 2
 
 
 # Password validation
@@ -151,6 +244,15 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+MEDIA_URL = 'media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# uploaded images are resized by manage.py process_images, sizes are the longest edge
+IMAGE_VARIANTS = {'thumbnail': 160, 'medium': 640, 'large': 1280}
+IMAGE_VARIANT_FORMATS = ['avif', 'webp']
+IMAGE_VARIANT_QUALITY = 80
+IMAGE_MAX_PIXELS = 40_000_000
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -161,4 +263,35 @@ PASSWORD_RESET_TIMEOUT = 60 * 60 * 24
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=30),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=7),
-}
\ No newline at end of file
+    # tokens carry a hash of the password hash, changing the password revokes them
+    "CHECK_REVOKE_TOKEN": True,
+    "TOKEN_OBTAIN_SERIALIZER": "api.serializers.TokenObtainPairSerializer",
+    "TOKEN_REFRESH_SERIALIZER": "api.serializers.TokenRefreshSerializer",
+    "TOKEN_USER_CLASS": "api.authentication.ClaimsUser",
+}
+
+# route the hot recipe reads through the coroutine views of api.async_views, for ASGI
+# servers only. Off by default: manage.py benchmark_reads has gunicorn's gthread
+# workers ahead of uvicorn with them, also with many slow clients.
+ASYNC_READ_VIEWS = os.environ.get('ASYNC_READ_VIEWS', '0') == '1'
+
+# api.trending: activity halves in worth every TRENDING_HALF_LIFE_HOURS, manage.py
+# refresh_trending recounts the scores over TRENDING_WINDOW_DAYS and has to run after
+# the half-life changes. The feeds keep the top TRENDING_SIZE recipes for
+# TRENDING_CACHE_SECONDS and show TRENDING_PAGE_SIZE unless ?limit= asks for more.
+TRENDING_HALF_LIFE_HOURS = float(os.environ.get('TRENDING_HALF_LIFE_HOURS', 72))
+TRENDING_WINDOW_DAYS = int(os.environ.get('TRENDING_WINDOW_DAYS', 30))
+TRENDING_SIZE = 100
+TRENDING_PAGE_SIZE = 20
+TRENDING_CACHE_SECONDS = 60
+
+# api.similarity: manage.py refresh_similar keeps the SIMILAR_RECIPES most similar recipes
+# of each, a shared category multiplies the similarity by 1 + SIMILAR_CATEGORY_BOOST, and
+# ingredients in more than SIMILAR_MAX_DOCUMENT_FREQUENCY of all recipes are left out.
+# Changes to these take a refresh_similar --full.
+SIMILAR_RECIPES = 20
+SIMILAR_CATEGORY_BOOST = float(os.environ.get('SIMILAR_CATEGORY_BOOST', 0.25))
+SIMILAR_MAX_DOCUMENT_FREQUENCY = 0.25
+
+# how long the active flag and password hash checked by api.authentication are cached
+AUTH_USER_CACHE_TIMEOUT = 300
\ No newline at end of file
@@ -14,29 +14,58 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path
+from api.instrumentation import metrics_view
+from api.async_views import (
+    AsyncListCreateCommentView, AsyncListCreateRatingView, AsyncRecipeDetailView, AsyncRecipeIngredientAPIView,
+    AsyncRecipeListCreateView,
+)
 from api.views import *
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView
 )
 
+if settings.ASYNC_READ_VIEWS:
+    recipe_list_view = AsyncRecipeListCreateView.as_view()
+    recipe_detail_view = AsyncRecipeDetailView.as_view()
+    comment_list_view = AsyncListCreateCommentView.as_view()
+    rating_list_view = AsyncListCreateRatingView.as_view()
+    recipe_ingredients_view = AsyncRecipeIngredientAPIView.as_view()
+else:
+    recipe_list_view = RecipeListCreateView.as_view()
+    recipe_detail_view = RecipeDetailView.as_view()
+    comment_list_view = ListCreateCommentView.as_view()
+    rating_list_view = ListCreateRatingView.as_view()
+    recipe_ingredients_view = RecipeIngredientAPIView.as_view()
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view),
     path('api/register', RegisterApiView.as_view()),
     path('api/token', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh', TokenRefreshView.as_view(), name='token_refresh'),
-    path('api/recipes/', RecipeListCreateView.as_view()),
-    path('api/recipes/<int:pk>', RecipeDetailView.as_view()),
-    path('api/recipes/<int:pk>/comments', ListCreateCommentView.as_view()),
-    path('api/recipes/<int:pk>/ratings', ListCreateRatingView.as_view()),
-    path('api/recipes/<int:pk>/ingredients', RecipeIngredientAPIView.as_view()),
+    path('api/recipes/', recipe_list_view),
+    path('api/recipes/cookable', CookableRecipeListView.as_view()),
+    path('api/recipes/trending', TrendingRecipeListView.as_view()),
+    path('api/recipes/cache-stats', RecipeCacheStatsView.as_view()),
+    path('api/db/pool-stats', DatabasePoolStatsView.as_view()),
+    path('api/recipes/import', RecipeImportView.as_view()),
+    path('api/recipes/export', RecipeExportView.as_view()),
+    path('api/recipes/<int:pk>', recipe_detail_view),
+    path('api/recipes/<int:pk>/comments', comment_list_view),
+    path('api/recipes/<int:pk>/ratings', rating_list_view),
+    path('api/recipes/<int:pk>/ingredients', recipe_ingredients_view),
+    path('api/recipes/<int:pk>/similar', SimilarRecipeListView.as_view()),
 
     path('api/ingredients', IngredientListView.as_view()),
 
     path('api/categories', CategoryListView.as_view()),
     path('api/categories/<int:pk>', CategoryDetailView.as_view()),
+    path('api/categories/<int:pk>/trending', CategoryTrendingRecipeListView.as_view()),
 
     path('api/comments/<int:pk>', CommentDetailView.as_view()),
 
@@ -45,4 +74,4 @@ urlpatterns = [
     path('api/activate/<uidb64>/<token>/', ActivateUserView.as_view(), name='activate'),
 
     path('api/activate-send', SendActivationEmailView.as_view()),
-]
+] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)